@@ -0,0 +1,278 @@
+__author__ = 'Steven Ogdahl'
+
+import heapq
+from datetime import datetime
+
+import mongo
+from models import Credential, CredentialKey, CMRequest
+from throttle import ThrottleEngine
+
+
+class CredentialSlot(object):
+    def __init__(self, credential, in_use=0):
+        self.credential = credential
+        self.in_use = in_use
+
+    @property
+    def id(self):
+        return self.credential.id
+
+    @property
+    def has_capacity(self):
+        # Only give out credentials if there are any available to give out
+        return self.credential.max_checkouts == 0 or self.in_use < self.credential.max_checkouts
+
+
+class AllocationState(object):
+    # In-memory view of every credential, grouped by key, along with how many
+    # times each one is currently checked out and its throttle window.  It
+    # is built once from the database and then kept up to date by the
+    # service as it makes its own transitions, so that deciding which
+    # credential to give out never has to go back to the database (only
+    # actually claiming it does; see Credential.claim()).
+
+    def __init__(self):
+        self.keys = {}
+        self.slots = {}
+        self.throttle = ThrottleEngine()
+        # key -> time before which none of its credentials can be given out
+        # (datetime.max when they're all at max_checkouts)
+        self.blocked_until = {}
+        # key -> lease_seconds, for the keys that have their own
+        self.lease_seconds = {}
+
+    def load(self, db):
+        self.keys = {}
+        self.slots = {}
+        self.throttle = ThrottleEngine()
+        self.blocked_until = {}
+        self.lease_seconds = {}
+        self.refresh_credentials(db)
+        self.load_history(db)
+
+    def load_history(self, db, keys=None):
+        # Replays the checkouts that are still inside somebody's throttle
+        # window (for just `keys`, e.g. ones taken over from another
+        # worker, or for everything)
+        filter = {
+            'status': {'$in': list(CMRequest.CHECKED_OUT_STATUSES)},
+            'checkout_timestamp': {'$gte': datetime.now() - self.throttle.longest_window()}
+        }
+        if keys is not None:
+            credential_ids = [slot.id for key in keys for slot in self.keys.get(key, [])]
+            for credential_id in credential_ids:
+                slot = self.slots[credential_id]
+                self.throttle.forget(credential_id)
+                self.throttle.configure(credential_id, slot.credential.throttle_seconds, slot.credential.throttle_burst)
+            filter['credential'] = {'$in': credential_ids}
+            for key in keys:
+                self.blocked_until.pop(key, None)
+        for cmr in db.cm_request.find(
+            filter=filter,
+            projection={'credential': True, 'checkout_timestamp': True},
+            sort=[('checkout_timestamp', mongo.ASCENDING)]
+        ):
+            self.throttle.record(cmr.get('credential'), cmr['checkout_timestamp'])
+
+    def refresh_credentials(self, db):
+        # Credentials are added, edited and deleted through the website, so
+        # pick up their current definitions.  Their checkouts counters are
+        # the final word on how many times each is in use (other workers
+        # may have been handing them out too).
+        keys = {}
+        slots = {}
+        for credential in Credential.find(db, sort=[('key', mongo.ASCENDING), ('_id', mongo.ASCENDING)]):
+            slot = self._track(credential)
+            slots[credential.id] = slot
+            keys.setdefault(credential.key, []).append(slot)
+        for credential_id, slot in self.slots.items():
+            if credential_id not in slots:
+                self.throttle.forget(credential_id)
+                self.blocked_until.pop(slot.credential.key, None)
+        self.keys = keys
+        self.slots = slots
+        self.lease_seconds = dict((k.key, k.lease_seconds) for k in CredentialKey.find(
+            db, filter={'lease_seconds': {'$gt': 0}}, projection={'lease_seconds': True}
+        ))
+
+    def refresh_credential(self, credential_id, credential):
+        # Same as refresh_credentials() for one credential that's just been
+        # read back (None if it's gone)
+        old_slot = self.slots.get(credential_id)
+        if credential is None:
+            if old_slot:
+                del self.slots[credential_id]
+                self.keys[old_slot.credential.key].remove(old_slot)
+                self.throttle.forget(credential_id)
+                self.blocked_until.pop(old_slot.credential.key, None)
+            return
+        slot = self._track(credential)
+        if old_slot and old_slot.credential.key == credential.key:
+            return
+        if old_slot:
+            self.keys[old_slot.credential.key].remove(old_slot)
+        self.slots[credential_id] = slot
+        self.keys.setdefault(credential.key, []).append(slot)
+
+    def _track(self, credential):
+        # Brings the slot for `credential` up to date with it, making one if
+        # need be
+        slot = self.slots.get(credential.id)
+        if slot:
+            if self._signature(slot.credential) != self._signature(credential):
+                self.blocked_until.pop(slot.credential.key, None)
+                self.blocked_until.pop(credential.key, None)
+            if credential.checkouts is not None and credential.checkouts < slot.in_use:
+                self.blocked_until.pop(credential.key, None)
+            if credential.last_checkout_timestamp and \
+                    credential.last_checkout_timestamp != slot.credential.last_checkout_timestamp:
+                # Given out by somebody else (e.g. the website's fast path)
+                self.throttle.record(credential.id, credential.last_checkout_timestamp)
+            slot.credential = credential
+        else:
+            slot = CredentialSlot(credential)
+            self.blocked_until.pop(credential.key, None)
+        if credential.checkouts is not None:
+            slot.in_use = credential.checkouts
+        self.throttle.configure(credential.id, credential.throttle_seconds, credential.throttle_burst)
+        return slot
+
+    @staticmethod
+    def _signature(credential):
+        return (credential.key, credential.max_checkouts, credential.throttle_seconds, credential.throttle_burst)
+
+    def has_key(self, key):
+        return key in self.keys
+
+    def credentials(self, key):
+        return self.keys.get(key, [])
+
+    def find_available(self, key, now=None):
+        now = now or datetime.now()
+        blocked_until = self.blocked_until.get(key)
+        if blocked_until is not None and now <= blocked_until:
+            return None
+
+        blocked_until = datetime.max
+        for slot in self.keys.get(key, []):
+            if not slot.has_capacity:
+                continue
+            eligible = self.throttle.next_eligible(slot.id, now)
+            if eligible is None:
+                self.blocked_until.pop(key, None)
+                return slot
+            blocked_until = min(blocked_until, eligible)
+        # Nothing free; remember when the first throttled credential frees
+        # up so that we don't go through them all again until then
+        self.blocked_until[key] = blocked_until
+        return None
+
+    def next_eligible(self):
+        # The soonest time that a throttled key will have a credential free
+        pending = [t for t in self.blocked_until.values() if t != datetime.max]
+        return min(pending) if pending else None
+
+    def checkout(self, credential_id, timestamp, claimed=None):
+        # `claimed` is the credential as Credential.claim() left it
+        slot = self.slots.get(credential_id)
+        if slot:
+            if claimed is not None:
+                slot.credential = claimed
+                slot.in_use = claimed.checkouts
+            else:
+                slot.in_use += 1
+            self.throttle.record(credential_id, timestamp)
+
+    def checkin(self, credential_id):
+        slot = self.slots.get(credential_id)
+        if slot and slot.in_use > 0:
+            slot.in_use -= 1
+            self.blocked_until.pop(slot.credential.key, None)
+
+
+class RequestQueue(object):
+    # The QUEUING requests, kept in memory as a heap per key in the order
+    # they get handed out (highest priority first, then first come, first
+    # served).  The service adds requests as it queues them, so after
+    # load() it never has to read the queue back from the database.
+    # Requests that stop queuing behind its back are found out when their
+    # transition to GIVEN_OUT doesn't go through.
+
+    def __init__(self):
+        self.heaps = {}
+        # id -> heap entry, for the requests still in a heap
+        self.entries = {}
+        self.depths = {}
+
+    def load(self, db, filter=None):
+        # Adds the QUEUING requests matching `filter` (e.g. for keys just
+        # taken over from another worker)
+        for cm_request in CMRequest.find(db, filter=dict(filter or {}, status=CMRequest.QUEUING), projection={
+            'key': True, 'priority': True, 'status': True, 'submission_timestamp': True, 'batch': True
+        }):
+            self.push(cm_request)
+
+    def push(self, cm_request):
+        if cm_request.id in self.entries:
+            return
+        entry = [(-(cm_request.priority or 0), cm_request.submission_timestamp, cm_request.id), cm_request]
+        self.entries[cm_request.id] = entry
+        self.depths[cm_request.key] = self.depths.get(cm_request.key, 0) + 1
+        heapq.heappush(self.heaps.setdefault(cm_request.key, []), entry)
+
+    def discard(self, cm_request_id):
+        entry = self.entries.pop(cm_request_id, None)
+        if entry:
+            # Left in the heap, to be skipped over when it gets to the top
+            self.depths[entry[1].key] -= 1
+            entry[1] = None
+
+    def peek(self, key):
+        heap = self.heaps.get(key)
+        while heap and heap[0][1] is None:
+            heapq.heappop(heap)
+        if not heap:
+            self.heaps.pop(key, None)
+            self.depths.pop(key, None)
+            return None
+        return heap[0][1]
+
+    def pop(self, key):
+        cm_request = self.peek(key)
+        if cm_request:
+            heapq.heappop(self.heaps[key])
+            del self.entries[cm_request.id]
+            self.depths[key] -= 1
+        return cm_request
+
+    def pop_group(self, key):
+        # The next request for `key`, along with the rest of its batch (if
+        # it's part of one) that comes right after it
+        cm_request = self.pop(key)
+        if not cm_request:
+            return []
+        group = [cm_request]
+        while cm_request.batch is not None:
+            following = self.peek(key)
+            if not following or following.batch != cm_request.batch:
+                break
+            group.append(self.pop(key))
+        return group
+
+    def retain(self, keys):
+        # Forgets every key not in `keys`
+        keys = set(keys)
+        for key in [key for key in self.heaps if key not in keys]:
+            for entry in self.heaps.pop(key):
+                if entry[1] is not None:
+                    del self.entries[entry[1].id]
+            self.depths.pop(key, None)
+
+    def keys(self):
+        return list(self.heaps)
+
+    def depth(self, key):
+        return self.depths.get(key, 0)
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,105 @@
+__author__ = 'Steven Ogdahl'
+
+from datetime import datetime, timedelta
+
+import pymongo.errors
+from pymongo import UpdateOne
+
+import mongo
+from models import CMRequest
+
+# Requests moved per round trip
+ARCHIVE_BATCH_SIZE = 1000
+
+
+class RequestArchiver(object):
+    # Moves finished requests out of cm_request so that the collection the
+    # service and website work against only ever holds the live ones.
+    #
+    # By default they go to cm_request_history as-is (optionally expiring
+    # from there after `retention_seconds` via a TTL index).  With `compact`
+    # they are instead rolled up into per-key, per-day, per-status counts in
+    # cm_request_summary and dropped.
+
+    def __init__(self, db, age_seconds, retention_seconds=None, compact=False, batch_size=ARCHIVE_BATCH_SIZE):
+        self.db = db
+        self.age = timedelta(seconds=age_seconds)
+        self.retention_seconds = retention_seconds
+        self.compact = compact
+        self.batch_size = batch_size
+
+    def ensure_ttl(self):
+        # Puts the history collection's TTL index in line with
+        # retention_seconds (or takes it away if there isn't one)
+        history = self.db.cm_request_history
+        existing = history.index_information().get('archived_ttl')
+        if not self.retention_seconds:
+            if existing:
+                history.drop_index('archived_ttl')
+            return
+        if existing and existing.get('expireAfterSeconds') != self.retention_seconds:
+            self.db.command('collMod', 'cm_request_history', index={
+                'name': 'archived_ttl', 'expireAfterSeconds': self.retention_seconds
+            })
+        elif not existing:
+            history.create_index(
+                [('archived_timestamp', mongo.ASCENDING)],
+                name='archived_ttl',
+                expireAfterSeconds=self.retention_seconds
+            )
+
+    def archive(self, filter=None, now=None, statuses=None):
+        # Returns how many requests were moved.  `statuses` narrows it down
+        # to some of the finished statuses.
+        now = now or datetime.now()
+        query = dict(filter or {})
+        query['status'] = {'$in': list(statuses or CMRequest.TERMINAL_STATUSES)}
+        query['submission_timestamp'] = {'$lt': now - self.age}
+
+        moved = 0
+        while True:
+            batch = list(self.db.cm_request.find(
+                filter=query, sort=[('submission_timestamp', mongo.ASCENDING)], limit=self.batch_size
+            ))
+            if not batch:
+                break
+            if self.compact:
+                self._summarize(batch)
+            else:
+                self._copy_to_history(batch, now)
+            # Copied first and removed second, so a crash in between leaves a
+            # duplicate behind rather than losing anything
+            self.db.cm_request.delete_many({
+                '_id': {'$in': [cmr['_id'] for cmr in batch]},
+                'status': {'$in': list(CMRequest.TERMINAL_STATUSES)}
+            })
+            moved += len(batch)
+            if len(batch) < self.batch_size:
+                break
+        return moved
+
+    def _copy_to_history(self, batch, now):
+        for cmr in batch:
+            cmr['archived_timestamp'] = now
+        try:
+            self.db.cm_request_history.insert_many(batch, ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            # Already copied by an earlier run that didn't get as far as
+            # deleting them is fine; anything else isn't
+            if any(error['code'] != 11000 for error in e.details.get('writeErrors', [])):
+                raise
+
+    def _summarize(self, batch):
+        counts = {}
+        for cmr in batch:
+            day = cmr['submission_timestamp'].strftime('%Y-%m-%d')
+            summary_id = (cmr.get('key'), day, cmr['status'])
+            counts[summary_id] = counts.get(summary_id, 0) + 1
+        self.db.cm_request_summary.bulk_write([
+            UpdateOne(
+                {'_id': {'key': key, 'date': day, 'status': status}},
+                {'$inc': {'count': count}},
+                upsert=True
+            )
+            for (key, day, status), count in counts.items()
+        ], ordered=False)
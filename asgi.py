@@ -0,0 +1,7 @@
+#!/usr/bin/env python3
+__author__ = 'Steven Ogdahl'
+from vinz_clortho_website.asgi import app
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host='0.0.0.0')
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+__author__ = 'Steven Ogdahl'
+
+# End-to-end load benchmark.  Runs the real website (wsgi:app, through
+# Flask's test client) and a real VCService in this process against a
+# scratch database, throws synthetic scrapers at them and reports how long
+# it took them to get their credentials.
+#
+#   ./benchmark.py --keys 20 --credentials 3 --max-checkouts 2 --rate 50 --duration 30
+#   ./benchmark.py --mongomock --output bench_output.txt
+#
+# Results are printed as JSON (or written to --output) so that runs can be
+# compared; a human-readable summary goes to stderr.  --mongomock needs the
+# mongomock package (see requirements.txt).
+
+import argparse
+import base64
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import metrics
+import mongo
+from models import CMRequest
+
+BENCHMARK_DATABASE = 'vinz_clortho_benchmark'
+BENCHMARK_USER = 'benchmark'
+BENCHMARK_PASSWORD = 'benchmark'
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(pct / 100.0 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def summarize(values):
+    return {
+        'count': len(values),
+        'mean': sum(values) / len(values) if values else None,
+        'p50': percentile(values, 50),
+        'p90': percentile(values, 90),
+        'p99': percentile(values, 99),
+        'max': max(values) if values else None,
+    }
+
+
+class ServiceRunner(threading.Thread):
+    # VCService.run() wants to own the main thread (it installs a SIGTERM
+    # handler), so drive setup()/run_once() ourselves the same way it does
+    def __init__(self, service, db, counter):
+        super(ServiceRunner, self).__init__(name='benchmark-service', daemon=True)
+        self.service = service
+        self.db = db
+        self.counter = counter
+        self.should_be_running = True
+        self.loop_durations = []
+        self.loop_commands = []
+
+    def run(self):
+        import vinz_clortho_service
+        self.service.setup(self.db)
+        while self.should_be_running:
+            self.service.wakeup.clear()
+            commands = self.counter.count(self.name) if self.counter else 0
+            start = time.time()
+            self.service.run_once()
+            self.loop_durations.append(time.time() - start)
+            if self.counter:
+                self.loop_commands.append(self.counter.count(self.name) - commands)
+            self.service.wakeup.wait(vinz_clortho_service.POLL_INTERVAL)
+
+
+class Scraper(object):
+    # One synthetic client: ask for a credential, wait for it, hold on to it
+    # for a while and give it back
+    def __init__(self, app, args, results):
+        self.app = app
+        self.args = args
+        self.results = results
+        self.headers = {
+            'Authorization': 'Basic ' + base64.b64encode(
+                '{0}:{1}'.format(BENCHMARK_USER, BENCHMARK_PASSWORD).encode('utf-8')).decode('ascii')
+        }
+
+    def get(self, url):
+        # Test clients keep state (cookies), so one per request
+        response = self.app.test_client().get(url, headers=self.headers)
+        return json.loads(response.get_data(as_text=True))
+
+    def __call__(self, key):
+        submitted = time.time()
+        status = self.get('/credential/request/{0}'.format(key))
+        ticket = status['ticket']
+        deadline = submitted + self.args.client_timeout
+        while 'username' not in status and time.time() < deadline and \
+                status['status'] in (CMRequest.SUBMITTED, CMRequest.QUEUING):
+            status = self.get('/credential/status/{0}?poll=true&poll_interval={1}&poll_timeout={2}'.format(
+                ticket, self.args.poll_interval, self.args.poll_timeout))
+        if 'username' not in status:
+            self.results.record_failure(status['status'])
+            self.get('/credential/release/{0}'.format(ticket))
+            return
+        checked_out = time.time()
+        time.sleep(random.expovariate(1.0 / self.args.hold) if self.args.hold > 0 else 0)
+        self.get('/credential/release/{0}'.format(ticket))
+        self.results.record_checkout(checked_out - submitted, time.time())
+
+
+class Results(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.failures = {}
+        self.last_release = None
+
+    def record_checkout(self, latency, released):
+        with self.lock:
+            self.latencies.append(latency)
+            self.last_release = released
+
+    def record_failure(self, status):
+        with self.lock:
+            self.failures[status] = self.failures.get(status, 0) + 1
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Load and latency benchmark for Vinz Clortho')
+    parser.add_argument('--mongo-uri', default=mongo.MONGO_CLIENT,
+                        help='MongoDB (or sqlite:///FILE) to run against (default: %(default)s)')
+    parser.add_argument('--database', default=BENCHMARK_DATABASE,
+                        help='Scratch database; it is dropped before and after (default: %(default)s)')
+    parser.add_argument('--mongomock', action='store_true',
+                        help='Use an in-process mongomock stand-in instead of a real server')
+    parser.add_argument('--keys', type=int, default=10)
+    parser.add_argument('--credentials', type=int, default=2, help='Credentials per key')
+    parser.add_argument('--max-checkouts', type=int, default=1)
+    parser.add_argument('--throttle-seconds', type=int, default=0)
+    parser.add_argument('--rate', type=float, default=20.0, help='Requests per second, across all keys')
+    parser.add_argument('--duration', type=float, default=20.0, help='Seconds to keep submitting requests')
+    parser.add_argument('--hold', type=float, default=0.5, help='Mean seconds a scraper holds its credential')
+    parser.add_argument('--clients', type=int, default=200, help='Most scrapers in flight at once')
+    parser.add_argument('--poll-interval', type=int, default=1)
+    parser.add_argument('--poll-timeout', type=int, default=30)
+    parser.add_argument('--client-timeout', type=float, default=120.0,
+                        help='Seconds a scraper waits for a credential before giving up')
+    parser.add_argument('--service-poll-interval', type=float, default=2)
+    parser.add_argument('--event-driven', action='store_true', help='Run the service with -e')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--label', default='', help='Free-form label stored with the results')
+    parser.add_argument('--output', default=None, help='Write the JSON results here instead of stdout')
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    random.seed(args.seed)
+
+    counter = None
+    if args.mongomock:
+        import mongomock
+        mongo.set_client(mongomock.MongoClient())
+    else:
+        # Listeners only apply to clients created after they're registered
+        counter = metrics.CommandCounter().register()
+        mongo.configure(MONGO_CLIENT=args.mongo_uri)
+    mongo.configure(MONGO_DATABASE=args.database)
+
+    client = mongo.get_client()
+    client.drop_database(args.database)
+    db = mongo.get_db()
+    keys = ['benchmark-{0}'.format(i) for i in range(args.keys)]
+    db.credential.insert_many([
+        {
+            'key': key,
+            'username': '{0}-{1}'.format(key, i),
+            'password': 'password',
+            'max_checkouts': args.max_checkouts,
+            'throttle_seconds': args.throttle_seconds,
+            'throttle_burst': 1,
+            'checkouts': 0
+        }
+        for key in keys for i in range(args.credentials)
+    ])
+
+    from werkzeug.security import generate_password_hash
+    from wsgi import app
+    import vinz_clortho_website
+    vinz_clortho_website.users[BENCHMARK_USER] = generate_password_hash(BENCHMARK_PASSWORD)
+    # mongomock has no change streams
+    app.config['TICKET_NOTIFICATIONS'] = not args.mongomock
+    app.config['CREDENTIAL_NOTIFICATIONS'] = not args.mongomock
+
+    from vinz_clortho_service import VCService
+    service = VCService(
+        logfile=os.devnull,
+        min_log_level=logging.CRITICAL,
+        POLL_INTERVAL=args.service_poll_interval,
+        EVENT_DRIVEN=args.event_driven
+    )
+    runner = ServiceRunner(service, db, counter)
+    runner.start()
+
+    results = Results()
+    scraper = Scraper(app, args, results)
+    started = time.time()
+    submitted = 0
+    with ThreadPoolExecutor(max_workers=args.clients, thread_name_prefix='benchmark-scraper') as pool:
+        next_arrival = started
+        while next_arrival - started < args.duration:
+            delay = next_arrival - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(scraper, random.choice(keys))
+            submitted += 1
+            next_arrival += random.expovariate(args.rate)
+    finished = results.last_release or time.time()
+
+    runner.should_be_running = False
+    service.wakeup.set()
+    runner.join(timeout=10)
+    client.drop_database(args.database)
+
+    elapsed = finished - started
+    report = {
+        'label': args.label,
+        'timestamp': datetime.now().isoformat(),
+        'parameters': dict((k, v) for k, v in vars(args).items() if k not in ('output',)),
+        'submitted': submitted,
+        'checked_out': len(results.latencies),
+        'failed': dict((str(status), count) for status, count in results.failures.items()),
+        'elapsed_seconds': elapsed,
+        'throughput_per_second': len(results.latencies) / elapsed if elapsed > 0 else None,
+        'checkout_latency_seconds': summarize(results.latencies),
+        'loop_duration_seconds': summarize(runner.loop_durations),
+        'queries_per_loop': summarize(runner.loop_commands) if counter else None,
+    }
+
+    encoded = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(encoded + '\n')
+    else:
+        print(encoded)
+
+    latency = report['checkout_latency_seconds']
+    print("{0} submitted, {1} checked out, {2} failed in {3:.1f}s ({4:.1f}/s)".format(
+        submitted, report['checked_out'], sum(results.failures.values()), elapsed,
+        report['throughput_per_second'] or 0), file=sys.stderr)
+    if latency['count']:
+        print("checkout latency p50 {0:.3f}s  p90 {1:.3f}s  p99 {2:.3f}s  max {3:.3f}s".format(
+            latency['p50'], latency['p90'], latency['p99'], latency['max']), file=sys.stderr)
+    loops = report['loop_duration_seconds']
+    if loops['count']:
+        print("{0} service loops, p50 {1:.4f}s  p99 {2:.4f}s".format(
+            loops['count'], loops['p50'], loops['p99']), file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,1109 @@
+__author__ = 'Steven Ogdahl'
+
+# Embedded storage for single-node installs: the part of pymongo's client,
+# database and collection API that the models, service and website use,
+# kept in a SQLite file in WAL mode.  mongo.get_client() hands one of
+# these out instead of a MongoClient when MONGO_CLIENT is a sqlite:// URI:
+#
+#   MONGO_CLIENT = 'sqlite:////var/lib/vinz_clortho/vinz_clortho.db'
+#   MONGO_CLIENT = 'sqlite:///:memory:'     (one process only, e.g. tests)
+#
+# The service and the website's workers all open the same file, so there's
+# no database server to run and no network hop in between.  Documents are
+# stored as BSON and matched in Python, each operation in a transaction of
+# its own, so conditional updates (Credential.claim(),
+# CMRequest.transition(), the key leases) are exactly as atomic as they are
+# against MongoDB.
+#
+# Lookups by _id go straight to the row.  Every field named in an index
+# (mongo.INDEXES, through ensure_indexes()) is also kept in a column of its
+# own, and each index is a real SQLite index over those columns, so any
+# other query narrows the rows down by its equality, $in and range
+# conditions on indexed fields before the documents are decoded and
+# matched.  Queries with nothing to narrow by on an indexed field still
+# read the whole collection.  A field holding an array or an embedded
+# document can't be kept in a column; an index over one is dropped (and
+# then shows up as missing in the index report) rather than used.  Index
+# usage isn't tracked, so the report lists every index as unused.
+#
+# TTL indexes are honoured whenever something is inserted into their
+# collection.  There are no change streams: watch() fails the same way it
+# does on a standalone mongod, so everything that follows them falls back
+# to polling.
+
+import asyncio
+import contextlib
+import copy
+import os
+import sqlite3
+import threading
+from datetime import datetime, timedelta, timezone
+
+import bson
+import pymongo.errors
+from bson.int64 import Int64
+from bson.objectid import ObjectId
+from pymongo import ReturnDocument
+from pymongo.operations import DeleteMany, DeleteOne, InsertOne, ReplaceOne, UpdateMany, UpdateOne
+from pymongo.results import BulkWriteResult, DeleteResult, InsertManyResult, InsertOneResult, UpdateResult
+
+URI_PREFIX = 'sqlite://'
+
+# Milliseconds to wait for another process to finish writing before
+# giving up
+BUSY_TIMEOUT_MS = 5000
+
+# Most _ids looked up in one statement (and most values in an $in
+# that's narrowed down by an index)
+ID_BATCH_SIZE = 500
+
+_MISSING = object()
+_UNINDEXABLE = object()
+
+
+def is_embedded(uri):
+    return isinstance(uri, str) and uri.startswith(URI_PREFIX)
+
+
+def _unsupported(what):
+    return pymongo.errors.OperationFailure("{0} is not supported by the embedded store".format(what))
+
+
+def _duplicate_key(collection, _id):
+    return pymongo.errors.DuplicateKeyError(
+        "E11000 duplicate key error collection: {0} index: _id_ dup key: {{ _id: {1!r} }}".format(
+            collection.full_name, _id), 11000)
+
+
+# -- Matching, sorting and updating documents, the way MongoDB does --------
+
+def _get(doc, path):
+    for part in path.split('.'):
+        if not isinstance(doc, dict) or part not in doc:
+            return _MISSING
+        doc = doc[part]
+    return doc
+
+
+def _set(doc, path, value):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        doc = doc.setdefault(part, {})
+    doc[parts[-1]] = value
+
+
+def _unset(doc, path):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        doc = doc.get(part)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(parts[-1], None)
+
+
+def _sort_key(value):
+    # Orders values of different types the way BSON does (null, numbers,
+    # strings, documents, arrays, binary, ObjectIds, booleans, dates)
+    if value is _MISSING or value is None:
+        return (1,)
+    if isinstance(value, bool):
+        return (8, value)
+    if isinstance(value, (int, float, Int64)):
+        return (2, value)
+    if isinstance(value, str):
+        return (3, value)
+    if isinstance(value, dict):
+        return (4, tuple((k, _sort_key(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return (5, tuple(_sort_key(v) for v in value))
+    if isinstance(value, bytes):
+        return (6, value)
+    if isinstance(value, ObjectId):
+        return (7, value.binary)
+    if isinstance(value, datetime):
+        return (9, value)
+    raise _unsupported("Comparing {0}".format(type(value).__name__))
+
+
+def _equals(value, other):
+    if other is None:
+        return value is _MISSING or value is None
+    if value is _MISSING:
+        return False
+    if isinstance(value, list) and not isinstance(other, list):
+        return any(_equals(v, other) for v in value)
+    return _sort_key(value) == _sort_key(other)
+
+
+def _compare(value, other, test):
+    # Query comparisons only match values of the same type
+    if value is _MISSING:
+        return False
+    a, b = _sort_key(value), _sort_key(other)
+    return a[0] == b[0] and test(a, b)
+
+
+_QUERY_OPERATORS = {
+    '$eq': lambda value, arg: _equals(value, arg),
+    '$ne': lambda value, arg: not _equals(value, arg),
+    '$in': lambda value, arg: any(_equals(value, a) for a in arg),
+    '$nin': lambda value, arg: not any(_equals(value, a) for a in arg),
+    '$lt': lambda value, arg: _compare(value, arg, lambda a, b: a < b),
+    '$lte': lambda value, arg: _compare(value, arg, lambda a, b: a <= b),
+    '$gt': lambda value, arg: _compare(value, arg, lambda a, b: a > b),
+    '$gte': lambda value, arg: _compare(value, arg, lambda a, b: a >= b),
+    '$exists': lambda value, arg: (value is not _MISSING) == bool(arg),
+}
+
+
+def _is_operator_expression(condition):
+    return isinstance(condition, dict) and bool(condition) and next(iter(condition)).startswith('$')
+
+
+def _matches(doc, filter):
+    for field, condition in filter.items():
+        if field == '$and':
+            if not all(_matches(doc, f) for f in condition):
+                return False
+        elif field == '$or':
+            if not any(_matches(doc, f) for f in condition):
+                return False
+        elif field == '$nor':
+            if any(_matches(doc, f) for f in condition):
+                return False
+        elif field == '$expr':
+            if not _truthy(_evaluate(condition, doc)):
+                return False
+        elif field.startswith('$'):
+            raise _unsupported(field)
+        elif _is_operator_expression(condition):
+            value = _get(doc, field)
+            for operator, arg in condition.items():
+                if operator not in _QUERY_OPERATORS:
+                    raise _unsupported(operator)
+                if not _QUERY_OPERATORS[operator](value, arg):
+                    return False
+        elif not _equals(_get(doc, field), condition):
+            return False
+    return True
+
+
+def _truthy(value):
+    if value is _MISSING or value is None or value is False:
+        return False
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value != 0
+    return True
+
+
+def _cond(doc, args):
+    if isinstance(args, dict):
+        args = [args['if'], args['then'], args['else']]
+    return _evaluate(args[1] if _truthy(_evaluate(args[0], doc)) else args[2], doc)
+
+
+def _if_null(doc, args):
+    for arg in args:
+        value = _evaluate(arg, doc)
+        if value is not _MISSING and value is not None:
+            return value
+    return None
+
+
+def _comparison(test):
+    return lambda doc, args: test(_sort_key(_evaluate(args[0], doc)), _sort_key(_evaluate(args[1], doc)))
+
+
+_EXPRESSION_OPERATORS = {
+    '$and': lambda doc, args: all(_truthy(_evaluate(arg, doc)) for arg in args),
+    '$or': lambda doc, args: any(_truthy(_evaluate(arg, doc)) for arg in args),
+    '$not': lambda doc, args: not _truthy(_evaluate(args[0] if isinstance(args, list) else args, doc)),
+    '$eq': _comparison(lambda a, b: a == b),
+    '$ne': _comparison(lambda a, b: a != b),
+    '$lt': _comparison(lambda a, b: a < b),
+    '$lte': _comparison(lambda a, b: a <= b),
+    '$gt': _comparison(lambda a, b: a > b),
+    '$gte': _comparison(lambda a, b: a >= b),
+    '$in': lambda doc, args: any(
+        _sort_key(_evaluate(args[0], doc)) == _sort_key(v) for v in _evaluate(args[1], doc)),
+    '$cond': _cond,
+    '$ifNull': _if_null,
+    '$add': lambda doc, args: sum(_evaluate(arg, doc) for arg in args),
+    '$subtract': lambda doc, args: _evaluate(args[0], doc) - _evaluate(args[1], doc),
+}
+
+
+def _evaluate(expression, doc):
+    # Aggregation expressions ($expr, $group); field paths that aren't
+    # there come back as _MISSING
+    if isinstance(expression, str) and expression.startswith('$'):
+        return _get(doc, expression[1:])
+    if _is_operator_expression(expression):
+        (operator, args), = expression.items()
+        if operator not in _EXPRESSION_OPERATORS:
+            raise _unsupported(operator)
+        return _EXPRESSION_OPERATORS[operator](doc, args)
+    if isinstance(expression, dict):
+        evaluated = {}
+        for field, value in expression.items():
+            value = _evaluate(value, doc)
+            if value is not _MISSING:
+                evaluated[field] = value
+        return evaluated
+    if isinstance(expression, list):
+        return [_evaluate(e, doc) for e in expression]
+    return expression
+
+
+def _sort(docs, sort):
+    # Stable sorts from the last key to the first
+    for field, direction in reversed(list(sort)):
+        docs.sort(key=lambda doc: _sort_key(_get(doc, field)), reverse=direction < 0)
+    return docs
+
+
+def _project(doc, projection):
+    if not projection:
+        return doc
+    if not isinstance(projection, dict):
+        projection = dict((field, True) for field in projection)
+    included = [field for field, value in projection.items() if value and field != '_id']
+    if included:
+        projected = {}
+        if projection.get('_id', True) and '_id' in doc:
+            projected['_id'] = doc['_id']
+        for field in included:
+            value = _get(doc, field)
+            if value is not _MISSING:
+                _set(projected, field, value)
+        return projected
+    projected = copy.deepcopy(doc)
+    for field, value in projection.items():
+        if not value:
+            _unset(projected, field)
+    return projected
+
+
+def _apply_update(doc, update, inserting=False):
+    # Returns `doc` as `update` leaves it
+    doc = copy.deepcopy(doc)
+    if not _is_operator_expression(update):
+        # A replacement
+        replaced = copy.deepcopy(update)
+        if '_id' in doc:
+            replaced['_id'] = doc['_id']
+        return replaced
+    for operator, fields in update.items():
+        if operator == '$set' or (operator == '$setOnInsert' and inserting):
+            for field, value in fields.items():
+                _set(doc, field, copy.deepcopy(value))
+        elif operator == '$setOnInsert':
+            continue
+        elif operator == '$unset':
+            for field in fields:
+                _unset(doc, field)
+        elif operator == '$inc':
+            for field, amount in fields.items():
+                value = _get(doc, field)
+                if value is _MISSING:
+                    value = 0
+                elif not isinstance(value, (int, float)) or isinstance(value, bool):
+                    raise pymongo.errors.WriteError(
+                        "Cannot apply $inc to a value of non-numeric type ({0})".format(field), 14)
+                _set(doc, field, value + amount)
+        else:
+            raise _unsupported(operator)
+    return doc
+
+
+def _upsert_document(filter, update):
+    # The document an upsert inserts: the filter's equality conditions,
+    # then the update applied to them
+    doc = {}
+    for field, condition in filter.items():
+        if field.startswith('$'):
+            continue
+        if _is_operator_expression(condition):
+            if '$eq' in condition:
+                _set(doc, field, copy.deepcopy(condition['$eq']))
+            continue
+        _set(doc, field, copy.deepcopy(condition))
+    if not _is_operator_expression(update):
+        replacement = copy.deepcopy(update)
+        if '_id' in doc:
+            replacement.setdefault('_id', doc['_id'])
+        doc = replacement
+    else:
+        doc = _apply_update(doc, update, inserting=True)
+    if '_id' not in doc:
+        doc['_id'] = ObjectId()
+    return doc
+
+
+def _id_lookup(filter):
+    # The _ids `filter` is limited to, if that can be told from it alone
+    # (None otherwise)
+    if '_id' in filter:
+        condition = filter['_id']
+        if not _is_operator_expression(condition):
+            return [condition]
+        if list(condition) == ['$in']:
+            return list(condition['$in'])
+        if list(condition) == ['$eq']:
+            return [condition['$eq']]
+    for clause in filter.get('$and', ()):
+        ids = _id_lookup(clause)
+        if ids is not None:
+            return ids
+    return None
+
+
+def _key(_id):
+    return bson.encode({'_id': _id})
+
+
+def _normalize_filter(filter):
+    if filter is None:
+        return {}
+    if not isinstance(filter, dict):
+        return {'_id': filter}
+    return filter
+
+
+# -- Indexed columns ------------------------------------------------------
+
+def _quote(name):
+    return '"{0}"'.format(name.replace('"', '""'))
+
+
+def _column(field):
+    # Field names can't start with '$', so these never clash with id or doc
+    return _quote('$' + field)
+
+
+def _column_value(value):
+    # What a field's column holds.  Within each BSON type this sorts the
+    # same way the value does; across types SQLite's order (numbers, then
+    # text, then blobs) only ever lets extra rows through, which _matches()
+    # then turns away.  _UNINDEXABLE for arrays, embedded documents and the
+    # like.
+    if value is _MISSING or value is None:
+        return None
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (int, float, Int64, str)):
+        return value
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value.strftime('%Y-%m-%dT%H:%M:%S.%f')
+    if isinstance(value, ObjectId):
+        return value.binary
+    if isinstance(value, bytes):
+        return value
+    return _UNINDEXABLE
+
+
+_SQL_COMPARISONS = {'$lt': '<', '$lte': '<=', '$gt': '>', '$gte': '>='}
+
+
+def _conditions(filter):
+    # (field, condition) for everything a document has to satisfy to match
+    # `filter`, as far as can be told without $or/$nor/$expr
+    for field, condition in filter.items():
+        if field == '$and':
+            for clause in condition:
+                yield from _conditions(clause)
+        elif not field.startswith('$'):
+            yield field, condition
+
+
+def _narrowing(filter, indexed):
+    # A WHERE clause over the `indexed` fields' columns that every document
+    # matching `filter` satisfies, and its parameters
+    clauses, params = [], []
+    for field, condition in _conditions(filter):
+        if field not in indexed:
+            continue
+        if not _is_operator_expression(condition):
+            condition = {'$eq': condition}
+        for operator, arg in condition.items():
+            if operator == '$eq':
+                value = _column_value(arg)
+                if value is None:
+                    clauses.append('{0} IS NULL'.format(_column(field)))
+                elif value is not _UNINDEXABLE:
+                    clauses.append('{0} = ?'.format(_column(field)))
+                    params.append(value)
+            elif operator == '$in':
+                values = [_column_value(a) for a in arg]
+                if values and len(values) <= ID_BATCH_SIZE and \
+                        not any(v is None or v is _UNINDEXABLE for v in values):
+                    clauses.append('{0} IN ({1})'.format(_column(field), ','.join('?' * len(values))))
+                    params.extend(values)
+            elif operator in _SQL_COMPARISONS:
+                value = _column_value(arg)
+                if value is not None and value is not _UNINDEXABLE:
+                    clauses.append('{0} {1} ?'.format(_column(field), _SQL_COMPARISONS[operator]))
+                    params.append(value)
+    return ' WHERE ' + ' AND '.join(clauses) if clauses else '', params
+
+
+# -- Client, database, collection -----------------------------------------
+
+class EmbeddedClient(object):
+
+    def __init__(self, path):
+        if path == ':memory:':
+            self.path = path
+        else:
+            self.path = os.path.abspath(path)
+        # One connection for the whole process (each worker process gets a
+        # client of its own from mongo.get_client()); other processes are
+        # kept in line by SQLite's own locking
+        self._lock = threading.RLock()
+        self._connection = sqlite3.connect(
+            self.path, timeout=BUSY_TIMEOUT_MS / 1000.0, isolation_level=None, check_same_thread=False)
+        self._connection.execute('PRAGMA busy_timeout = {0}'.format(BUSY_TIMEOUT_MS))
+        if self.path != ':memory:':
+            self._connection.execute('PRAGMA journal_mode = WAL')
+            # Safe with WAL; a power cut can lose the last few commits but
+            # never corrupt the file
+            self._connection.execute('PRAGMA synchronous = NORMAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS "_indexes" (collection TEXT, name TEXT, spec BLOB, PRIMARY KEY (collection, name))')
+        self._tables = set()
+        # Each collection's indexed columns and SQLite indexes, as of
+        # _layouts_version (the schema version, which any process adding or
+        # dropping a column or index bumps)
+        self._layouts = {}
+        self._layouts_version = None
+        self.admin = EmbeddedDatabase(self, 'admin')
+
+    @classmethod
+    def from_uri(cls, uri):
+        # sqlite:///relative/path, sqlite:////absolute/path or sqlite:///:memory:
+        path = uri[len(URI_PREFIX):]
+        if path.startswith('/'):
+            path = path[1:]
+        if not path:
+            raise pymongo.errors.ConfigurationError("No file given in '{0}'".format(uri))
+        return cls(path)
+
+    def __getitem__(self, name):
+        return EmbeddedDatabase(self, name)
+
+    def get_database(self, name):
+        return self[name]
+
+    def drop_database(self, name_or_database):
+        name = getattr(name_or_database, 'name', name_or_database)
+        with self._transaction() as connection:
+            for table in self._table_names(connection, name):
+                connection.execute('DROP TABLE "{0}"'.format(table.replace('"', '""')))
+                self._tables.discard(table)
+            connection.execute('DELETE FROM "_indexes" WHERE collection LIKE ?', (name + '.%',))
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    @staticmethod
+    def _table_names(connection, database):
+        return [row[0] for row in connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE ?", (database + '.%',))]
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # Takes the write lock up front, so that everything read inside is
+        # still true when it's written back
+        with self._lock:
+            try:
+                self._connection.execute('BEGIN IMMEDIATE')
+            except sqlite3.Error as e:
+                raise pymongo.errors.OperationFailure(str(e)) from e
+            try:
+                yield self._connection
+            except sqlite3.Error as e:
+                self._connection.execute('ROLLBACK')
+                raise pymongo.errors.OperationFailure(str(e)) from e
+            except BaseException:
+                self._connection.execute('ROLLBACK')
+                raise
+            try:
+                self._connection.execute('COMMIT')
+            except sqlite3.Error as e:
+                raise pymongo.errors.OperationFailure(str(e)) from e
+
+    @contextlib.contextmanager
+    def _reading(self):
+        with self._lock:
+            try:
+                yield self._connection
+            except sqlite3.Error as e:
+                raise pymongo.errors.OperationFailure(str(e)) from e
+
+
+class EmbeddedDatabase(object):
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def __getitem__(self, name):
+        return EmbeddedCollection(self, name)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def get_collection(self, name):
+        return self[name]
+
+    def list_collection_names(self):
+        with self.client._reading() as connection:
+            return [table[len(self.name) + 1:] for table in self.client._table_names(connection, self.name)]
+
+    def command(self, command, value=None, **kwargs):
+        if command == 'ping':
+            return {'ok': 1.0}
+        if command == 'collMod' and set(kwargs) == {'index'}:
+            self[value]._modify_index(kwargs['index'])
+            return {'ok': 1.0}
+        raise _unsupported("The {0} command".format(command))
+
+
+class EmbeddedCursor(object):
+
+    def __init__(self, collection, filter, projection, sort, limit, skip):
+        self.collection = collection
+        self._filter = filter
+        self._projection = projection
+        self._sort = sort
+        self._limit = limit
+        self._skip = skip
+        self._results = None
+
+    def sort(self, key_or_list, direction=None):
+        self._sort = [(key_or_list, direction or pymongo.ASCENDING)] if isinstance(key_or_list, str) else key_or_list
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def skip(self, skip):
+        self._skip = skip
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._results is None:
+            self._results = iter(self.collection._find(
+                self._filter, self._projection, self._sort, self._limit, self._skip))
+        return next(self._results)
+
+    def close(self):
+        self._results = iter(())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class EmbeddedCollection(object):
+
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.full_name = '{0}.{1}'.format(database.name, name)
+        self._table = '"{0}"'.format(self.full_name.replace('"', '""'))
+
+    @property
+    def _client(self):
+        return self.database.client
+
+    def _ensure_table(self, connection):
+        if self.full_name not in self._client._tables:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS {0} (id BLOB PRIMARY KEY, doc BLOB NOT NULL) WITHOUT ROWID'.format(
+                    self._table))
+            self._client._tables.add(self.full_name)
+
+    def _layout(self, connection):
+        # ([fields with a column], {SQLite index name: [fields]})
+        self._ensure_table(connection)
+        client = self._client
+        version = connection.execute('PRAGMA schema_version').fetchone()[0]
+        if version != client._layouts_version:
+            client._layouts = {}
+            client._layouts_version = version
+        layout = client._layouts.get(self.full_name)
+        if layout is None:
+            columns = [row[1][1:] for row in connection.execute('PRAGMA table_info({0})'.format(self._table))
+                       if row[1].startswith('$')]
+            indexes = {}
+            for row in connection.execute('PRAGMA index_list({0})'.format(self._table)).fetchall():
+                fields = [info[2][1:] for info in sorted(connection.execute(
+                    'PRAGMA index_info({0})'.format(_quote(row[1]))).fetchall())]
+                if row[3] == 'c':
+                    indexes[row[1]] = fields
+            layout = client._layouts[self.full_name] = (columns, indexes)
+        return layout
+
+    def _indexed(self, connection):
+        # The fields whose columns can be trusted in a query
+        return set(field for fields in self._layout(connection)[1].values() for field in fields)
+
+    def _sql_index(self, name):
+        # SQLite's index names are per database file, not per table
+        return '{0}.{1}'.format(self.full_name, name)
+
+    # Reading
+
+    def _load(self, connection, filter, sort=None, limit=0, skip=0):
+        # [(row id, document)] for the documents matching `filter`
+        self._ensure_table(connection)
+        ids = _id_lookup(filter)
+        if ids is not None:
+            rows = []
+            keys = list(dict.fromkeys(_key(_id) for _id in ids))
+            for i in range(0, len(keys), ID_BATCH_SIZE):
+                batch = keys[i:i + ID_BATCH_SIZE]
+                rows.extend(connection.execute('SELECT id, doc FROM {0} WHERE id IN ({1})'.format(
+                    self._table, ','.join('?' * len(batch))), batch).fetchall())
+        else:
+            where, params = _narrowing(filter, self._indexed(connection))
+            rows = connection.execute('SELECT id, doc FROM {0}{1}'.format(self._table, where), params)
+        # Without a sort, there's no need to look further than the page
+        wanted = (skip or 0) + limit if limit and not sort else None
+        matching = []
+        try:
+            for key, data in rows:
+                doc = bson.decode(data)
+                if _matches(doc, filter):
+                    matching.append((key, doc))
+                    if wanted is not None and len(matching) >= wanted:
+                        break
+        finally:
+            if isinstance(rows, sqlite3.Cursor):
+                rows.close()
+        if sort:
+            matching = [(_key(doc['_id']), doc) for doc in _sort([doc for _, doc in matching], sort)]
+        if skip:
+            matching = matching[skip:]
+        if limit:
+            matching = matching[:limit]
+        return matching
+
+    def _find(self, filter, projection=None, sort=None, limit=0, skip=0):
+        with self._client._reading() as connection:
+            matching = self._load(connection, _normalize_filter(filter), sort, limit, skip)
+        return [_project(doc, projection) for _, doc in matching]
+
+    def find(self, filter=None, projection=None, sort=None, limit=0, skip=0, **kwargs):
+        return EmbeddedCursor(self, filter, projection, sort, limit, skip)
+
+    def find_one(self, filter=None, *args, **kwargs):
+        kwargs['limit'] = 1
+        for doc in self.find(filter, *args, **kwargs):
+            return doc
+        return None
+
+    def count_documents(self, filter, **kwargs):
+        with self._client._reading() as connection:
+            return len(self._load(connection, _normalize_filter(filter), limit=kwargs.get('limit', 0),
+                                  skip=kwargs.get('skip', 0)))
+
+    def estimated_document_count(self):
+        with self._client._reading() as connection:
+            self._ensure_table(connection)
+            return connection.execute('SELECT COUNT(*) FROM {0}'.format(self._table)).fetchone()[0]
+
+    def distinct(self, key, filter=None):
+        values = []
+        for doc in self._find(filter):
+            value = _get(doc, key)
+            if value is not _MISSING and not any(_equals(value, v) for v in values):
+                values.append(value)
+        return values
+
+    def aggregate(self, pipeline, **kwargs):
+        stages = list(pipeline)
+        if stages and '$indexStats' in stages[0]:
+            # Index usage isn't tracked
+            return iter(())
+        filter = stages.pop(0)['$match'] if stages and '$match' in stages[0] else {}
+        docs = self._find(filter)
+        for stage in stages:
+            (name, spec), = stage.items()
+            if name == '$match':
+                docs = [doc for doc in docs if _matches(doc, spec)]
+            elif name == '$group':
+                docs = self._group(docs, spec)
+            elif name == '$sort':
+                docs = _sort(docs, spec.items())
+            elif name == '$skip':
+                docs = docs[spec:]
+            elif name == '$limit':
+                docs = docs[:spec]
+            elif name == '$project':
+                docs = [_project(doc, spec) for doc in docs]
+            elif name == '$count':
+                docs = [{spec: len(docs)}] if docs else []
+            else:
+                raise _unsupported(name)
+        return iter(docs)
+
+    @staticmethod
+    def _group(docs, spec):
+        groups = {}
+        for doc in docs:
+            _id = _evaluate(spec['_id'], doc)
+            _id = None if _id is _MISSING else _id
+            group = groups.get(_sort_key(_id))
+            if group is None:
+                group = groups[_sort_key(_id)] = {'_id': _id}
+            for field, accumulator in spec.items():
+                if field == '_id':
+                    continue
+                (operator, expression), = accumulator.items()
+                value = _evaluate(expression, doc)
+                if operator == '$sum':
+                    group[field] = group.get(field, 0) + (
+                        value if isinstance(value, (int, float)) and not isinstance(value, bool) else 0)
+                elif operator in ('$min', '$max'):
+                    if value is _MISSING or value is None:
+                        continue
+                    current = group.get(field)
+                    if current is None or (_sort_key(value) < _sort_key(current)) == (operator == '$min'):
+                        group[field] = value
+                elif operator == '$first':
+                    group.setdefault(field, None if value is _MISSING else value)
+                elif operator == '$last':
+                    group[field] = None if value is _MISSING else value
+                else:
+                    raise _unsupported(operator)
+        return list(groups.values())
+
+    # Writing
+
+    def _columns(self, connection, doc):
+        # ([fields with a column], [what goes in them for `doc`]).  An index
+        # over a field that `doc` has something unindexable in is dropped,
+        # since its column can no longer say which rows might match.
+        columns, indexes = self._layout(connection)
+        values = []
+        for field in columns:
+            value = _column_value(_get(doc, field))
+            if value is _UNINDEXABLE:
+                for name, fields in indexes.items():
+                    if field in fields:
+                        connection.execute('DROP INDEX IF EXISTS {0}'.format(_quote(name)))
+                value = None
+            values.append(value)
+        return columns, values
+
+    def _write(self, connection, key, doc):
+        columns, values = self._columns(connection, doc)
+        connection.execute('UPDATE {0} SET doc = ?{1} WHERE id = ?'.format(
+            self._table, ''.join(', {0} = ?'.format(_column(field)) for field in columns)
+        ), [bson.encode(doc)] + values + [key])
+
+    def _insert(self, connection, doc):
+        if '_id' not in doc:
+            doc['_id'] = ObjectId()
+        columns, values = self._columns(connection, doc)
+        try:
+            connection.execute('INSERT INTO {0} (id, doc{1}) VALUES (?, ?{2})'.format(
+                self._table, ''.join(', ' + _column(field) for field in columns), ', ?' * len(columns)
+            ), [_key(doc['_id']), bson.encode(doc)] + values)
+        except sqlite3.IntegrityError:
+            raise _duplicate_key(self, doc['_id'])
+        return doc['_id']
+
+    def _update(self, connection, filter, update, upsert=False, multi=False):
+        # Returns (matched, modified, upserted _id or None)
+        filter = _normalize_filter(filter)
+        matched = modified = 0
+        for key, doc in self._load(connection, filter, limit=0 if multi else 1):
+            matched += 1
+            updated = _apply_update(doc, update)
+            if updated != doc:
+                self._write(connection, key, updated)
+                modified += 1
+        if not matched and upsert:
+            return 0, 0, self._insert(connection, _upsert_document(filter, update))
+        return matched, modified, None
+
+    def _delete(self, connection, filter, multi=False):
+        deleted = 0
+        for key, _ in self._load(connection, _normalize_filter(filter), limit=0 if multi else 1):
+            connection.execute('DELETE FROM {0} WHERE id = ?'.format(self._table), (key,))
+            deleted += 1
+        return deleted
+
+    def _expire(self, connection):
+        # What a TTL monitor would have removed by now
+        for data, in connection.execute('SELECT spec FROM "_indexes" WHERE collection = ?', (self.full_name,)).fetchall():
+            spec = bson.decode(data)
+            if spec.get('expireAfterSeconds') is not None:
+                field = spec['key'][0][0]
+                self._delete(connection, {
+                    field: {'$lt': datetime.now() - timedelta(seconds=spec['expireAfterSeconds'])}
+                }, multi=True)
+
+    @staticmethod
+    def _update_result(matched, modified, upserted_id):
+        raw = {'n': matched if upserted_id is None else 1, 'nModified': modified, 'ok': 1.0}
+        if upserted_id is not None:
+            raw['upserted'] = upserted_id
+        return UpdateResult(raw, True)
+
+    def insert_one(self, document, **kwargs):
+        with self._client._transaction() as connection:
+            self._ensure_table(connection)
+            self._expire(connection)
+            return InsertOneResult(self._insert(connection, document), True)
+
+    def insert_many(self, documents, ordered=True, **kwargs):
+        documents = list(documents)
+        self.bulk_write([InsertOne(document) for document in documents], ordered=ordered)
+        return InsertManyResult([document['_id'] for document in documents], True)
+
+    def update_one(self, filter, update, upsert=False, **kwargs):
+        with self._client._transaction() as connection:
+            return self._update_result(*self._update(connection, filter, update, upsert))
+
+    def update_many(self, filter, update, upsert=False, **kwargs):
+        with self._client._transaction() as connection:
+            return self._update_result(*self._update(connection, filter, update, upsert, multi=True))
+
+    def replace_one(self, filter, replacement, upsert=False, **kwargs):
+        return self.update_one(filter, replacement, upsert)
+
+    def delete_one(self, filter, **kwargs):
+        with self._client._transaction() as connection:
+            return DeleteResult({'n': self._delete(connection, filter), 'ok': 1.0}, True)
+
+    def delete_many(self, filter, **kwargs):
+        with self._client._transaction() as connection:
+            return DeleteResult({'n': self._delete(connection, filter, multi=True), 'ok': 1.0}, True)
+
+    def find_one_and_update(self, filter, update, projection=None, sort=None, upsert=False,
+                            return_document=ReturnDocument.BEFORE, **kwargs):
+        filter = _normalize_filter(filter)
+        with self._client._transaction() as connection:
+            matching = self._load(connection, filter, sort, limit=1)
+            if not matching:
+                if not upsert:
+                    return None
+                _id = self._insert(connection, _upsert_document(filter, update))
+                if return_document != ReturnDocument.AFTER:
+                    return None
+                matching = self._load(connection, {'_id': _id})
+                return _project(matching[0][1], projection)
+            key, doc = matching[0]
+            updated = _apply_update(doc, update)
+            if updated != doc:
+                self._write(connection, key, updated)
+        return _project(updated if return_document == ReturnDocument.AFTER else doc, projection)
+
+    def bulk_write(self, requests, ordered=True, **kwargs):
+        # All of `requests` go in one transaction.  Like MongoDB, an ordered
+        # bulk stops at the first error and an unordered one carries on, and
+        # whatever went through before then is kept.
+        counts = {'nInserted': 0, 'nUpserted': 0, 'nMatched': 0, 'nModified': 0, 'nRemoved': 0}
+        upserted = []
+        errors = []
+        with self._client._transaction() as connection:
+            self._ensure_table(connection)
+            if any(isinstance(request, InsertOne) for request in requests):
+                self._expire(connection)
+            for index, request in enumerate(requests):
+                savepoint = 'bulk_{0}'.format(index)
+                connection.execute('SAVEPOINT {0}'.format(savepoint))
+                try:
+                    if isinstance(request, InsertOne):
+                        self._insert(connection, request._doc)
+                        counts['nInserted'] += 1
+                    elif isinstance(request, (UpdateOne, UpdateMany, ReplaceOne)):
+                        matched, modified, upserted_id = self._update(
+                            connection, request._filter, request._doc, request._upsert,
+                            multi=isinstance(request, UpdateMany))
+                        counts['nMatched'] += matched
+                        counts['nModified'] += modified
+                        if upserted_id is not None:
+                            counts['nUpserted'] += 1
+                            upserted.append({'index': index, '_id': upserted_id})
+                    elif isinstance(request, (DeleteOne, DeleteMany)):
+                        counts['nRemoved'] += self._delete(
+                            connection, request._filter, multi=isinstance(request, DeleteMany))
+                    else:
+                        raise _unsupported(type(request).__name__)
+                except (pymongo.errors.DuplicateKeyError, pymongo.errors.WriteError) as e:
+                    connection.execute('ROLLBACK TO {0}'.format(savepoint))
+                    errors.append({'index': index, 'code': e.code, 'errmsg': str(e)})
+                    if ordered:
+                        break
+                finally:
+                    connection.execute('RELEASE {0}'.format(savepoint))
+        result = dict(counts, upserted=upserted, writeErrors=errors, writeConcernErrors=[])
+        if errors:
+            raise pymongo.errors.BulkWriteError(result)
+        return BulkWriteResult(result, True)
+
+    # Indexes (recorded in _indexes, and built over indexed columns)
+
+    def create_indexes(self, indexes, **kwargs):
+        names = []
+        with self._client._transaction() as connection:
+            for index in indexes:
+                document = dict(index.document)
+                spec = {'key': [list(pair) for pair in document.pop('key').items()]}
+                if document.get('expireAfterSeconds') is not None:
+                    spec['expireAfterSeconds'] = document['expireAfterSeconds']
+                connection.execute('INSERT OR REPLACE INTO "_indexes" (collection, name, spec) VALUES (?, ?, ?)',
+                                   (self.full_name, document['name'], bson.encode(spec)))
+                self._build_index(connection, document['name'], spec['key'])
+                names.append(document['name'])
+        return names
+
+    def _build_index(self, connection, name, keys):
+        # Fills in the columns of the fields in `keys` for every document and
+        # indexes them, unless some document has something unindexable in
+        # one of them
+        columns = self._layout(connection)[0]
+        fields = [field for field, _ in keys]
+        for field in fields:
+            if field not in columns:
+                connection.execute('ALTER TABLE {0} ADD COLUMN {1}'.format(self._table, _column(field)))
+        indexable = True
+        for key, data in connection.execute('SELECT id, doc FROM {0}'.format(self._table)).fetchall():
+            doc = bson.decode(data)
+            values = [_column_value(_get(doc, field)) for field in fields]
+            if _UNINDEXABLE in values:
+                indexable = False
+                values = [None if value is _UNINDEXABLE else value for value in values]
+            connection.execute('UPDATE {0} SET {1} WHERE id = ?'.format(
+                self._table, ', '.join('{0} = ?'.format(_column(field)) for field in fields)
+            ), values + [key])
+        connection.execute('DROP INDEX IF EXISTS {0}'.format(_quote(self._sql_index(name))))
+        if indexable:
+            connection.execute('CREATE INDEX {0} ON {1} ({2})'.format(
+                _quote(self._sql_index(name)), self._table, ', '.join(
+                    _column(field) + (' DESC' if isinstance(direction, int) and direction < 0 else '')
+                    for field, direction in keys
+                )
+            ))
+
+    def create_index(self, keys, **kwargs):
+        return self.create_indexes([pymongo.IndexModel(keys, **kwargs)])[0]
+
+    def index_information(self):
+        # Only the indexes that are actually built
+        information = {'_id_': {'key': [('_id', 1)], 'v': 2}}
+        with self._client._reading() as connection:
+            built = self._layout(connection)[1]
+            for name, data in connection.execute(
+                    'SELECT name, spec FROM "_indexes" WHERE collection = ?', (self.full_name,)).fetchall():
+                if self._sql_index(name) not in built:
+                    continue
+                spec = bson.decode(data)
+                spec['key'] = [tuple(pair) for pair in spec['key']]
+                spec['v'] = 2
+                information[name] = spec
+        return information
+
+    def drop_index(self, name):
+        with self._client._transaction() as connection:
+            if not connection.execute('DELETE FROM "_indexes" WHERE collection = ? AND name = ?',
+                                      (self.full_name, name)).rowcount:
+                raise pymongo.errors.OperationFailure("index not found with name [{0}]".format(name), 27)
+            connection.execute('DROP INDEX IF EXISTS {0}'.format(_quote(self._sql_index(name))))
+
+    def _modify_index(self, index):
+        with self._client._transaction() as connection:
+            row = connection.execute('SELECT spec FROM "_indexes" WHERE collection = ? AND name = ?',
+                                     (self.full_name, index['name'])).fetchone()
+            if not row:
+                raise pymongo.errors.OperationFailure("cannot find index {0}".format(index['name']), 27)
+            spec = bson.decode(row[0])
+            spec.update((k, v) for k, v in index.items() if k != 'name')
+            connection.execute('UPDATE "_indexes" SET spec = ? WHERE collection = ? AND name = ?',
+                               (bson.encode(spec), self.full_name, index['name']))
+
+    def watch(self, *args, **kwargs):
+        raise pymongo.errors.OperationFailure(
+            "The $changeStream stage is only supported on replica sets", 40573)
+
+
+# -- For the async web tier -------------------------------------------------
+
+class AsyncEmbeddedClient(object):
+    # Enough of motor's interface over an EmbeddedClient for
+    # vinz_clortho_website/asgi.py.  Each call runs in a worker thread.
+
+    def __init__(self, client):
+        self.delegate = client
+        self.admin = AsyncEmbeddedDatabase(client.admin)
+
+    def __getitem__(self, name):
+        return AsyncEmbeddedDatabase(self.delegate[name])
+
+
+class AsyncEmbeddedDatabase(object):
+
+    def __init__(self, database):
+        self.delegate = database
+        self.name = database.name
+
+    def __getitem__(self, name):
+        return AsyncEmbeddedCollection(self.delegate[name])
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    async def command(self, *args, **kwargs):
+        return await asyncio.to_thread(self.delegate.command, *args, **kwargs)
+
+
+class AsyncEmbeddedCollection(object):
+
+    def __init__(self, collection):
+        self.delegate = collection
+        self.name = collection.name
+
+    def find(self, *args, **kwargs):
+        return AsyncEmbeddedCursor(self.delegate.find(*args, **kwargs))
+
+    def watch(self, *args, **kwargs):
+        return self.delegate.watch(*args, **kwargs)
+
+    def __getattr__(self, name):
+        method = getattr(self.delegate, name)
+
+        async def call(*args, **kwargs):
+            return await asyncio.to_thread(method, *args, **kwargs)
+        return call
+
+
+class AsyncEmbeddedCursor(object):
+
+    def __init__(self, cursor):
+        self.delegate = cursor
+
+    async def to_list(self, length=None):
+        results = await asyncio.to_thread(list, self.delegate)
+        return results[:length] if length else results
+
+    async def __aiter__(self):
+        for doc in await self.to_list():
+            yield doc
@@ -0,0 +1,133 @@
+__author__ = 'Steven Ogdahl'
+
+import hashlib
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta
+
+import pymongo.errors
+
+# Seconds a worker's leases (and its entry in the worker registry) last
+# without being renewed
+LEASE_SECONDS = 30
+
+
+class KeyLeases(object):
+    # Used when only one service process is running: it owns every key
+
+    partitioned = False
+
+    def refresh(self, keys):
+        # Returns the keys that were newly picked up
+        return set()
+
+    def owns(self, key):
+        return True
+
+    def owned_keys(self):
+        return None
+
+    def leads(self):
+        # Whether this worker looks after the work that belongs to no key
+        return True
+
+    def release_all(self):
+        pass
+
+
+class MongoKeyLeases(KeyLeases):
+    # Splits keys between however many service processes are running.
+    #
+    # Every worker heartbeats into `scheduler_worker`.  Each key is preferred
+    # by one live worker (rendezvous hashing over the live workers, so adding
+    # or losing a worker only moves the keys that have to move), and the
+    # preferred worker takes a lease on it in `scheduler_lease`.  A lease can
+    # only be taken once the previous holder's has expired (or been given
+    # up), so a worker that dies simply stops renewing and its keys move on
+    # after LEASE_SECONDS.
+    #
+    # Leases keep workers from doing each other's work; they aren't what
+    # keeps a credential from going over max_checkouts.  That's done by the
+    # conditional updates in Credential.claim() and CMRequest.transition().
+
+    partitioned = True
+
+    def __init__(self, db, worker_id=None, lease_seconds=LEASE_SECONDS):
+        self.db = db
+        self.worker_id = worker_id or '{0}:{1}:{2}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.lease = timedelta(seconds=lease_seconds)
+        self.owned = {}
+        self.workers = [self.worker_id]
+        self.renew_at = datetime.min
+
+    def refresh(self, keys):
+        now = datetime.now()
+        if now < self.renew_at and all(key in self.owned for key in keys if self._preferred(key) == self.worker_id):
+            return set()
+        self.renew_at = now + self.lease / 3
+        expires = now + self.lease
+
+        self.db.scheduler_worker.update_one(
+            {'_id': self.worker_id},
+            {'$set': {'heartbeat': now, 'expires': expires}},
+            upsert=True
+        )
+        self.workers = sorted(w['_id'] for w in self.db.scheduler_worker.find(
+            filter={'expires': {'$gt': now}}, projection={'_id': True}
+        ))
+
+        # Renew everything we still hold, then see what actually stuck
+        self.db.scheduler_lease.update_many(
+            {'owner': self.worker_id, 'expires': {'$gt': now}},
+            {'$set': {'expires': expires}}
+        )
+        held = set(lease['_id'] for lease in self.db.scheduler_lease.find(
+            filter={'owner': self.worker_id, 'expires': {'$gt': now}}, projection={'_id': True}
+        ))
+
+        newly_acquired = set()
+        for key in keys:
+            if self._preferred(key) != self.worker_id:
+                # Hand it over to whoever should have it now
+                if key in held:
+                    self.db.scheduler_lease.delete_one({'_id': key, 'owner': self.worker_id})
+                    held.discard(key)
+                continue
+            if key in held:
+                continue
+            try:
+                self.db.scheduler_lease.update_one(
+                    {'_id': key, '$or': [{'expires': {'$lte': now}}, {'owner': self.worker_id}]},
+                    {'$set': {'owner': self.worker_id, 'expires': expires, 'acquired': now}},
+                    upsert=True
+                )
+            except pymongo.errors.DuplicateKeyError:
+                # Still held by somebody else; try again next time around
+                continue
+            held.add(key)
+            newly_acquired.add(key)
+
+        self.owned = dict((key, expires) for key in held)
+        return newly_acquired
+
+    def _preferred(self, key):
+        return max(self.workers, key=lambda worker: hashlib.md5('{0}|{1}'.format(worker, key).encode('utf-8')).digest())
+
+    def owns(self, key):
+        expires = self.owned.get(key)
+        return expires is not None and datetime.now() < expires
+
+    def owned_keys(self):
+        now = datetime.now()
+        return [key for key, expires in self.owned.items() if now < expires]
+
+    def leads(self):
+        # The first live worker does (the others may briefly disagree about
+        # who that is while one comes or goes)
+        return self.workers[0] == self.worker_id
+
+    def release_all(self):
+        self.db.scheduler_lease.delete_many({'owner': self.worker_id})
+        self.db.scheduler_worker.delete_one({'_id': self.worker_id})
+        self.owned = {}
@@ -0,0 +1,226 @@
+__author__ = 'Steven Ogdahl'
+
+# Just enough of a metrics library to export counters, gauges and
+# histograms in the Prometheus text format, from both the service (via
+# MetricsServer) and the website (via its /metrics route).  Every process
+# keeps its own numbers, so under gunicorn each worker reports only on
+# itself.
+
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from pymongo import monitoring
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return repr(int(value))
+    return repr(value)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(
+        name, str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+    ) for name, value in pairs) + '}'
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError("{0} takes labels {1}, got {2}".format(self.name, self.labelnames, sorted(labels)))
+        return tuple(labels[name] for name in self.labelnames)
+
+    def clear(self):
+        with self.lock:
+            self.values = {}
+
+    def render(self):
+        lines = [
+            '# HELP {0} {1}'.format(self.name, self.documentation),
+            '# TYPE {0} {1}'.format(self.name, self.type)
+        ]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return ['{0}{1} {2}'.format(self.name, _format_labels(self.labelnames, key), _format_value(value))]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        super(Counter, self).__init__(name, documentation, labelnames, registry)
+        if not self.labelnames:
+            self.values[()] = 0
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        super(Gauge, self).__init__(name, documentation, labelnames, registry)
+        if not self.labelnames:
+            self.values[()] = 0
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def replace(self, values):
+        # Swaps in a whole new set of {label values tuple: value}, dropping
+        # label combinations that have gone away (e.g. deleted keys)
+        with self.lock:
+            self.values = dict(values)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), registry=None, buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state['buckets'][i] += 1
+            state['sum'] += value
+            state['count'] += 1
+
+    def _render_value(self, key, state):
+        lines = []
+        for bound, count in zip(self.buckets, state['buckets']):
+            lines.append('{0}_bucket{1} {2}'.format(
+                self.name, _format_labels(self.labelnames, key, [('le', _format_value(float(bound)))]), count))
+        labels = _format_labels(self.labelnames, key)
+        lines.append('{0}_sum{1} {2}'.format(self.name, labels, _format_value(state['sum'])))
+        lines.append('{0}_count{1} {2}'.format(self.name, labels, state['count']))
+        return lines
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class CommandCounter(monitoring.CommandListener):
+    # Counts the commands each thread sends to Mongo.  Only clients created
+    # after register() is called are counted.
+
+    def __init__(self):
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def register(self):
+        monitoring.register(self)
+        return self
+
+    def started(self, event):
+        name = threading.current_thread().name
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+    def count(self, thread_name=None):
+        with self.lock:
+            return self.counts.get(thread_name or threading.current_thread().name, 0)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MetricsServer(threading.Thread):
+    # Serves a registry on http://<address>:<port>/metrics in the background
+
+    def __init__(self, port, address='', registry=None):
+        super(MetricsServer, self).__init__(name='metrics-server', daemon=True)
+        handler = type('MetricsHandler', (_MetricsHandler,), {'registry': registry or REGISTRY})
+        self.server = _ThreadingHTTPServer((address, port), handler)
+
+    def run(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
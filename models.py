@@ -1,23 +1,92 @@
 __author__ = 'Steven Ogdahl'
 
 from datetime import datetime, timedelta
-import pymongo
+from pymongo import ReturnDocument, UpdateOne
 #from django.db import models
 
-def dict_iterator(cursor, col_names):
-    for row in cursor.fetchall():
-        yield dict(zip(col_names, row))
+# Maximum number of operations to send in a single bulk_write
+BULK_BATCH_SIZE = 500
+
+class RunningStatistics(object):
+    # Count, mean and standard deviation of a series of durations (in
+    # seconds), kept as running sums so that adding a sample is a single $inc
+    # and reading them back never has to look at the history.
+
+    def __init__(self, count=0, total=0.0, total_squares=0.0):
+        self.count = count
+        self.total = total
+        self.total_squares = total_squares
+
+    @staticmethod
+    def increments(prefix, value, increments=None):
+        increments = increments if increments is not None else {}
+        for field, amount in (('count', 1), ('total', value), ('total_squares', value * value)):
+            name = '{0}.{1}'.format(prefix, field)
+            increments[name] = increments.get(name, 0) + amount
+        return increments
+
+    @property
+    def mean(self):
+        if self.count == 0:
+            return 0.0
+        return self.total / self.count
+
+    @property
+    def stddev(self):
+        # Sample standard deviation, same as the old STDDEV() query
+        if self.count < 2:
+            return 0.0
+        variance = (self.total_squares - self.total * self.total / self.count) / (self.count - 1)
+        return max(variance, 0.0) ** 0.5
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'mean': self.mean,
+            'stddev': self.stddev
+        }
+
+
+def statistics_increments(cm_request, increments=None):
+    # $inc for the wait and usage statistics of a COMPLETED request
+    increments = RunningStatistics.increments(
+        'statistics.wait',
+        (cm_request.checkout_timestamp - cm_request.submission_timestamp).total_seconds(),
+        increments
+    )
+    return RunningStatistics.increments(
+        'statistics.usage',
+        (cm_request.checkin_timestamp - cm_request.checkout_timestamp).total_seconds(),
+        increments
+    )
+
 
 class Credential(object):
-    def __init__(self, key, username=None, password=None, max_checkouts=0, throttle_seconds=0, **kwargs):
+    def __init__(self, key, username=None, password=None, max_checkouts=0, throttle_seconds=0, throttle_burst=1,
+                 **kwargs):
         self.id = kwargs.get('_id', None)
         self.key = key
         self.username = username
         self.password = password
         self.max_checkouts = max_checkouts
         self.throttle_seconds = throttle_seconds
+        # How many checkouts are allowed within any throttle_seconds window
+        self.throttle_burst = throttle_burst
+        # Running count of requests holding this credential, kept by claim()
+        # and release_many()
+        self.checkouts = kwargs.get('checkouts', None)
+        # When claim() last gave it out (from anywhere)
+        self.last_checkout_timestamp = kwargs.get('last_checkout_timestamp', None)
+        # Bumped whenever the credential itself is edited (not on checkouts)
+        self.version = kwargs.get('version', 0)
+        statistics = kwargs.get('statistics') or {}
+        self.wait_statistics = RunningStatistics(**statistics.get('wait', {}))
+        self.usage_statistics = RunningStatistics(**statistics.get('usage', {}))
 
         self.db = kwargs.get('db', None)
+        # Filled in by load_counts() to save a query per property
+        self._pending = None
+        self._in_use = None
 
     @property
     def throttle_timespan(self):
@@ -25,95 +94,45 @@ class Credential(object):
 
     @property
     def pending(self):
-        if not self.db:
+        if self._pending is not None:
+            return self._pending
+        if self.db is None:
             return None
-        return self.db.cm_request.count(
+        return self.db.cm_request.count_documents(
             filter={
                 'key': self.key,
-                'status': {
-                    '$in': [
-                        CMRequest.SUBMITTED,
-                        CMRequest.QUEUING,
-                        CMRequest.CANCEL,
-                        CMRequest.GIVEN_OUT
-                    ]
-                }
+                'status': {'$in': list(CMRequest.PENDING_STATUSES)}
             }
         )
 
-    def _retrieve_statistics(self):
-        ## TODO -- refactor this for MongoDB
-        pass
-        # from django.db import connection
-        # cursor = connection.cursor()
-        # cursor.execute(u'''
-        #     SELECT
-        #     AVG(checkout_timestamp - submission_timestamp) AS avg_wait,
-        #     AVG(checkin_timestamp - checkout_timestamp) AS avg_usage,
-        #     STDDEV(extract(epoch from checkout_timestamp - submission_timestamp)) * INTERVAL '1 second' AS stddev_wait,
-        #     STDDEV(extract(epoch from checkin_timestamp - checkout_timestamp)) * INTERVAL '1 second' AS stddev_usage
-        #     FROM "scrapeService_cmrequest"
-        #     WHERE credential_id = {0} AND status = {1}
-        #     '''.format(self.id, CMRequest.COMPLETED))
-        # items = list(dict_iterator(cursor, ['avg_wait', 'avg_usage', 'stddev_wait', 'stddev_usage']))
-        # self._average_wait_time = (items[0]['avg_wait'] or timedelta()).total_seconds()
-        # self._average_usage_time = (items[0]['avg_usage'] or timedelta()).total_seconds()
-        # self._stddev_wait_time = (items[0]['stddev_wait'] or timedelta()).total_seconds()
-        # self._stddev_usage_time = (items[0]['stddev_usage'] or timedelta()).total_seconds()
-
     @property
     def in_use(self):
-        if not self.db:
+        if self._in_use is not None:
+            return self._in_use
+        if self.db is None:
             return None
-        return self.db.cm_request.count(
+        return self.db.cm_request.count_documents(
             filter={
                 'credential': self.id,
-                'status': {
-                    '$in': [
-                        CMRequest.CANCEL,
-                        CMRequest.GIVEN_OUT,
-                        CMRequest.IN_USE,
-                        CMRequest.RETURNED
-                    ]
-                }
+                'status': {'$in': list(CMRequest.IN_USE_STATUSES)}
             }
         )
 
     @property
     def average_wait_time(self):
-        if self._average_wait_time == -1:
-            self._retrieve_statistics()
-        return self._average_wait_time
+        return self.wait_statistics.mean
 
     @property
     def average_usage_time(self):
-        if self._average_usage_time == -1:
-            self._retrieve_statistics()
-        return self._average_usage_time
+        return self.usage_statistics.mean
 
     @property
     def stddev_wait_time(self):
-        if self._stddev_wait_time == -1:
-            self._retrieve_statistics()
-        return self._stddev_wait_time
+        return self.wait_statistics.stddev
 
     @property
     def stddev_usage_time(self):
-        if self._stddev_usage_time == -1:
-            self._retrieve_statistics()
-        return self._stddev_usage_time
-
-    @property
-    def last_checkout_timestamp(self):
-        if not self.db:
-            return None
-        request = self.db.cm_request.find_one(
-            filter={ 'credential': self.id },
-            sort=[('submission_timestamp', pymongo.DESCENDING)]
-        )
-        if request:
-            return request['submission_timestamp']
-        return None
+        return self.usage_statistics.stddev
 
     def to_dict(self):
         return {
@@ -123,8 +142,13 @@ class Credential(object):
             'password': self.password,
             'max_checkouts': self.max_checkouts,
             'throttle_seconds': self.throttle_seconds,
+            'throttle_burst': self.throttle_burst,
             'pending': self.pending,
-            'in_use': self.in_use
+            'in_use': self.in_use,
+            'statistics': {
+                'wait': self.wait_statistics.to_dict(),
+                'usage': self.usage_statistics.to_dict()
+            }
         }
 
 
@@ -133,13 +157,154 @@ class Credential(object):
             self.db = kwargs.pop('db')
         self.db.credential.update_one(
             filter={'_id': self.id},
-            update={'$set': kwargs}
+            update={'$set': kwargs, '$inc': {'version': 1}}
         )
+        for attr, value in kwargs.items():
+            setattr(self, attr, value)
+        self.version += 1
+        self._pending = None
+        self._in_use = None
+
+    @staticmethod
+    def load_counts(db, credentials):
+        # Works out `pending` and `in_use` for a whole list of credentials
+        # with a single aggregation, grouped by key and credential, instead
+        # of two count queries per credential.
+        if not credentials:
+            return credentials
+        keys = list(set(c.key for c in credentials))
+        pending = dict((key, 0) for key in keys)
+        in_use = {}
+        for row in db.cm_request.aggregate([
+            {'$match': {
+                '$or': [
+                    {'key': {'$in': keys}},
+                    {'credential': {'$in': [c.id for c in credentials]}}
+                ],
+                'status': {'$in': list(set(CMRequest.PENDING_STATUSES + CMRequest.IN_USE_STATUSES))}
+            }},
+            {'$group': {
+                '_id': {'key': '$key', 'credential': '$credential'},
+                'pending': {'$sum': {'$cond': [{'$in': ['$status', list(CMRequest.PENDING_STATUSES)]}, 1, 0]}},
+                'in_use': {'$sum': {'$cond': [{'$in': ['$status', list(CMRequest.IN_USE_STATUSES)]}, 1, 0]}}
+            }}
+        ]):
+            key = row['_id'].get('key')
+            credential = row['_id'].get('credential')
+            if key in pending:
+                pending[key] += row['pending']
+            if credential is not None:
+                in_use[credential] = in_use.get(credential, 0) + row['in_use']
+        for c in credentials:
+            c._pending = pending.get(c.key, 0)
+            c._in_use = in_use.get(c.id, 0)
+        return credentials
+
+    @staticmethod
+    def claim(db, credential, timestamp):
+        # Atomically takes one checkout of `credential`, but only if that
+        # doesn't put it over max_checkouts.  For throttled credentials,
+        # also only if nobody else has given it out since it was read (going
+        # by last_checkout_timestamp), so that the service and the website
+        # can both go by what they last saw of its throttle.  Returns the
+        # updated Credential, or None if it was full or taken.
+        filter, update = Credential.claim_query(credential, timestamp)
+        c = db.credential.find_one_and_update(filter=filter, update=update, return_document=ReturnDocument.AFTER)
+        if c:
+            c = Credential(db=db, **c)
+        return c
+
+    @staticmethod
+    def claim_query(credential, timestamp):
+        # The filter and update behind claim(), for callers that have to
+        # run it themselves (e.g. through motor)
+        filter = {
+            '_id': credential.id,
+            '$expr': {'$or': [
+                {'$eq': ['$max_checkouts', 0]},
+                {'$lt': [{'$ifNull': ['$checkouts', 0]}, '$max_checkouts']}
+            ]}
+        }
+        if credential.throttle_seconds > 0:
+            filter['last_checkout_timestamp'] = credential.last_checkout_timestamp
+        return filter, {'$inc': {'checkouts': 1}, '$set': {'last_checkout_timestamp': timestamp}}
+
+    @staticmethod
+    def unclaim(db, credential, timestamp):
+        # Undoes a claim() at `timestamp` that didn't end up being handed
+        # out: gives the checkout back, and puts last_checkout_timestamp back
+        # to what `credential` (as read before the claim) had, unless it's
+        # been claimed again since
+        for filter, update in Credential.unclaim_queries(credential, timestamp):
+            db.credential.update_one(filter, update)
+
+    @staticmethod
+    def unclaim_queries(credential, timestamp):
+        # The (filter, update)s behind unclaim(), in order
+        return [
+            ({'_id': credential.id}, {'$inc': {'checkouts': -1}}),
+            ({'_id': credential.id, 'last_checkout_timestamp': timestamp},
+             {'$set': {'last_checkout_timestamp': credential.last_checkout_timestamp}}),
+        ]
+
+    @staticmethod
+    def release_many(db, credential_ids, increments=None):
+        # Gives back one checkout for every entry in `credential_ids` (which
+        # may repeat), in a single bulk_write.  `increments` can carry more
+        # $inc fields per credential (e.g. statistics) to go along with it.
+        updates = dict((credential_id, dict(fields)) for credential_id, fields in (increments or {}).items())
+        for credential_id in credential_ids:
+            if credential_id is not None:
+                fields = updates.setdefault(credential_id, {})
+                fields['checkouts'] = fields.get('checkouts', 0) - 1
+        if updates:
+            db.credential.bulk_write([
+                UpdateOne({'_id': credential_id}, {'$inc': fields})
+                for credential_id, fields in updates.items()
+            ], ordered=False)
+
+    @staticmethod
+    def recount_checkouts(db):
+        # Seeds the checkouts counter on credentials that don't have one yet
+        # (i.e. ones from before it existed) from cm_request
+        missing = [c['_id'] for c in db.credential.find(
+            filter={'checkouts': {'$exists': False}}, projection={'_id': True}
+        )]
+        if not missing:
+            return
+        counts = Credential.count_holders(db, missing)
+        db.credential.bulk_write([
+            UpdateOne({'_id': credential_id, 'checkouts': {'$exists': False}},
+                      {'$set': {'checkouts': counts.get(credential_id, 0)}})
+            for credential_id in missing
+        ], ordered=False)
+
+    @staticmethod
+    def count_holders(db, credential_ids):
+        # How many requests are actually holding each of `credential_ids`,
+        # i.e. what their checkouts counters should say
+        return dict((row['_id'], row['in_use']) for row in db.cm_request.aggregate([
+            {'$match': {'credential': {'$in': credential_ids}, 'status': {'$in': list(CMRequest.IN_USE_STATUSES)}}},
+            {'$group': {'_id': '$credential', 'in_use': {'$sum': 1}}}
+        ]))
+
+    @staticmethod
+    def correct_checkouts(db, credential_id, observed, checkouts):
+        # Sets the checkouts counter to `checkouts`, unless it has moved on
+        # from `observed` in the meantime.  Returns whether it was set.
+        result = db.credential.update_one(
+            {'_id': credential_id, 'checkouts': observed}, {'$set': {'checkouts': checkouts}}
+        )
+        return result.matched_count > 0
 
     @staticmethod
     def find(db, **kwargs):
         return [Credential(db=db, **c) for c in db.credential.find(**kwargs)]
 
+    @staticmethod
+    def find_with_counts(db, **kwargs):
+        return Credential.load_counts(db, Credential.find(db, **kwargs))
+
     @staticmethod
     def find_one(db, **kwargs):
         c = db.credential.find_one(**kwargs)
@@ -147,6 +312,74 @@ class Credential(object):
             c = Credential(db=db, **c)
         return c
 
+    @staticmethod
+    def find_one_with_counts(db, **kwargs):
+        c = Credential.find_one(db, **kwargs)
+        if c:
+            Credential.load_counts(db, [c])
+        return c
+
+
+class CredentialKey(object):
+    # Per-key bookkeeping that doesn't belong to any one credential, kept in
+    # the credential_key collection with the key as its _id
+
+    # Lease for checkouts of keys without a lease_seconds of their own,
+    # unless the service is started with another USING_TIMEOUT
+    DEFAULT_LEASE_SECONDS = 600
+
+    def __init__(self, _id, **kwargs):
+        self.key = _id
+        # How long a checkout of this key lasts before it times out (unless
+        # heartbeated); None for the service's USING_TIMEOUT
+        self.lease_seconds = kwargs.get('lease_seconds', None)
+        statistics = kwargs.get('statistics') or {}
+        self.wait_statistics = RunningStatistics(**statistics.get('wait', {}))
+        self.usage_statistics = RunningStatistics(**statistics.get('usage', {}))
+
+        self.db = kwargs.get('db', None)
+
+    def to_dict(self):
+        return {
+            'key': self.key,
+            'lease_seconds': self.lease_seconds,
+            'statistics': {
+                'wait': self.wait_statistics.to_dict(),
+                'usage': self.usage_statistics.to_dict()
+            }
+        }
+
+    def update(self, **kwargs):
+        if 'db' in kwargs:
+            self.db = kwargs.pop('db')
+        self.db.credential_key.update_one(
+            filter={'_id': self.key},
+            update={'$set': kwargs},
+            upsert=True
+        )
+        for attr, value in kwargs.items():
+            setattr(self, attr, value)
+
+    @staticmethod
+    def increment_many(db, increments):
+        # `increments` maps key -> $inc fields
+        if increments:
+            db.credential_key.bulk_write([
+                UpdateOne({'_id': key}, {'$inc': fields}, upsert=True)
+                for key, fields in increments.items()
+            ], ordered=False)
+
+    @staticmethod
+    def find(db, **kwargs):
+        return [CredentialKey(db=db, **k) for k in db.credential_key.find(**kwargs)]
+
+    @staticmethod
+    def find_one(db, key):
+        k = db.credential_key.find_one({'_id': key})
+        if k:
+            k = CredentialKey(db=db, **k)
+        return k
+
 
 class CMRequest(object):
     UNKNOWN = 0
@@ -179,8 +412,17 @@ class CMRequest(object):
         (NO_SUCH_KEY, 'No such key found')
     )
 
+    # Requests that are still waiting on a credential for their key
+    PENDING_STATUSES = (SUBMITTED, QUEUING, CANCEL, GIVEN_OUT)
+    # Requests that are holding on to their credential
+    IN_USE_STATUSES = (CANCEL, GIVEN_OUT, IN_USE, RETURNED)
+    # Requests that had a credential handed out to them (used for throttling)
+    CHECKED_OUT_STATUSES = (GIVEN_OUT, TIMED_OUT_WAITING, IN_USE, TIMED_OUT_USING, RETURNED, COMPLETED)
+    # Requests that are finished with for good
+    TERMINAL_STATUSES = (CANCELED, COMPLETED, TIMED_OUT_WAITING, TIMED_OUT_USING, FAILED, NO_SUCH_KEY)
+
     def __init__(self, credential=None, client='', key='', priority=0, status=UNKNOWN, submission_timestamp=None,
-                 checkout_timestamp=None, checkin_timestamp=None, **kwargs):
+                 checkout_timestamp=None, checkin_timestamp=None, batch=None, **kwargs):
         self.id = kwargs.get('_id', None)
         self.credential = credential
         self.client = client
@@ -190,6 +432,15 @@ class CMRequest(object):
         self.submission_timestamp = submission_timestamp or datetime.now()
         self.checkout_timestamp = checkout_timestamp
         self.checkin_timestamp = checkin_timestamp
+        # Shared by every request submitted together through the batch API
+        self.batch = batch
+        # Bumped on every change, so clients can tell whether anything has
+        # (see the ETags in the website)
+        self.version = kwargs.get('version', 0)
+        # When a checked out credential times out, and how far a heartbeat
+        # may push that out (both set when it's given out)
+        self.deadline = kwargs.get('deadline', None)
+        self.lease_seconds = kwargs.get('lease_seconds', None)
 
         self.db = kwargs.get('db', None)
 
@@ -204,7 +455,9 @@ class CMRequest(object):
             'status': self.status,
             'submission_timestamp': self.submission_timestamp,
             'checkout_timestamp': self.checkout_timestamp,
-            'checkin_timestamp': self.checkin_timestamp
+            'checkin_timestamp': self.checkin_timestamp,
+            'deadline': self.deadline,
+            'batch': self.batch
         }
 
     def update(self, **kwargs):
@@ -212,8 +465,82 @@ class CMRequest(object):
             self.db = kwargs.pop('db')
         self.db.cm_request.update_one(
             filter={'_id': self.id},
-            update={'$set': kwargs}
+            update={'$set': kwargs, '$inc': {'version': 1}}
+        )
+
+    def transition(self, expected_status, **kwargs):
+        # Like update(), but only if the request is still in
+        # `expected_status`.  Returns whether it was.
+        result = self.db.cm_request.update_one(
+            filter={'_id': self.id, 'status': expected_status},
+            update={'$set': kwargs, '$inc': {'version': 1}}
         )
+        if result.matched_count == 0:
+            return False
+        for attr, value in kwargs.items():
+            setattr(self, attr, value)
+        self.version += 1
+        return True
+
+    @staticmethod
+    def bulk_update(db, transitions):
+        # Applies many status transitions at once.  `transitions` is a list of
+        # (cm_request, expected_status, fields) and each update only goes
+        # through if the request is still in `expected_status`, so anything
+        # a client changed in the meantime is left alone.  Returns the ids of
+        # the requests that were *not* updated.
+        if not transitions:
+            return set()
+        matched = 0
+        for i in range(0, len(transitions), BULK_BATCH_SIZE):
+            result = db.cm_request.bulk_write([
+                UpdateOne({'_id': cm_request.id, 'status': expected_status}, {'$set': fields, '$inc': {'version': 1}})
+                for cm_request, expected_status, fields in transitions[i:i + BULK_BATCH_SIZE]
+            ], ordered=True)
+            matched += result.matched_count
+        if matched == len(transitions):
+            return set()
+
+        # Somebody beat us to some of them; find out which ones
+        statuses = {
+            cmr['_id']: cmr['status'] for cmr in db.cm_request.find(
+                filter={'_id': {'$in': [cm_request.id for cm_request, _, _ in transitions]}},
+                projection={'status': True}
+            )
+        }
+        return set(
+            cm_request.id for cm_request, _, fields in transitions
+            if statuses.get(cm_request.id) != fields.get('status')
+        )
+
+    @staticmethod
+    def update_many(db, filter, **kwargs):
+        # Server-side version of update() for every request matching
+        # `filter`.  Only the matching requests' ids, keys and credentials
+        # are read (to hand back for logging and bookkeeping), and the
+        # update re-applies `filter` so it can't touch anything that
+        # stopped matching in between.  Returns the requests that were
+        # actually updated.
+        matching = CMRequest.find(db, filter=filter, projection={
+            'key': True, 'credential': True, 'status': True, 'submission_timestamp': True, 'checkout_timestamp': True,
+            'version': True
+        })
+        if not matching:
+            return []
+        ids = [cm_request.id for cm_request in matching]
+        result = db.cm_request.update_many(
+            {'$and': [filter, {'_id': {'$in': ids}}]}, {'$set': kwargs, '$inc': {'version': 1}}
+        )
+        if result.modified_count != len(ids):
+            updated = set(cmr['_id'] for cmr in db.cm_request.find(
+                filter=dict(kwargs, _id={'$in': ids}), projection={'_id': True}
+            ))
+            matching = [cm_request for cm_request in matching if cm_request.id in updated]
+        for cm_request in matching:
+            for attr, value in kwargs.items():
+                setattr(cm_request, attr, value)
+            cm_request.version += 1
+        return matching
 
     @staticmethod
     def find(db, **kwargs):
@@ -225,4 +552,21 @@ class CMRequest(object):
         cmr = db.cm_request.find_one(**kwargs)
         if cmr:
             cmr = CMRequest(db=db, **cmr)
-        return cmr
\ No newline at end of file
+        return cmr
+
+    @staticmethod
+    def find_archived(db, id):
+        # Finished requests get moved to cm_request_history by the archiver
+        cmr = db.cm_request_history.find_one({'_id': id})
+        if cmr:
+            cmr.pop('archived_timestamp', None)
+            cmr = CMRequest(db=db, **cmr)
+        return cmr
+
+    @staticmethod
+    def find_archived_many(db, ids):
+        archived = []
+        for cmr in db.cm_request_history.find({'_id': {'$in': list(ids)}}):
+            cmr.pop('archived_timestamp', None)
+            archived.append(CMRequest(db=db, **cmr))
+        return archived
\ No newline at end of file
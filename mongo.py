@@ -1,11 +1,214 @@
 __author__ = 'Steven Ogdahl'
 
+import os
+import threading
+
 import pymongo
-from pymongo import ASCENDING, DESCENDING
+import pymongo.errors
+from pymongo import ASCENDING, DESCENDING, IndexModel
+
+import embedded
 
 #MONGO_CLIENT = 'mongodb://192.168.3.5/'
+# A sqlite:///PATH URI stores everything in that file instead, for
+# single-node installs with no MongoDB (see embedded.py)
 MONGO_CLIENT = 'mongodb://127.0.0.1/'
+MONGO_DATABASE = 'vinz_clortho'
+
+# Connection pool settings for the shared client (see configure())
+MONGO_MAX_POOL_SIZE = 100
+MONGO_MIN_POOL_SIZE = 0
+MONGO_MAX_IDLE_TIME_MS = 60000
+MONGO_CONNECT_TIMEOUT_MS = 5000
+MONGO_SERVER_SELECTION_TIMEOUT_MS = 5000
+MONGO_SOCKET_TIMEOUT_MS = None
+MONGO_WAIT_QUEUE_TIMEOUT_MS = 5000
+# How often the driver checks on the server(s) in the background
+MONGO_HEARTBEAT_FREQUENCY_MS = 10000
+
+_client = None
+_client_pid = None
+_async_client = None
+_async_client_pid = None
+_client_lock = threading.Lock()
+
+# Indexes backing the queries that the service and website run all the time.
+# Names are fixed so that they can be checked for by name later on.
+INDEXES = {
+    'cm_request': [
+        # Status sweeps, plus the queue in the order it gets handed out
+        IndexModel(
+            [('status', ASCENDING), ('priority', DESCENDING), ('submission_timestamp', ASCENDING), ('_id', ASCENDING)],
+            name='status_queue_order'
+        ),
+        # In-use counts and throttling for a single credential
+        IndexModel(
+            [('credential', ASCENDING), ('status', ASCENDING), ('checkout_timestamp', DESCENDING)],
+            name='credential_status_checkout'
+        ),
+        # Timeout sweeps, which only need to look at the expired tickets
+        IndexModel([('status', ASCENDING), ('checkout_timestamp', ASCENDING)], name='status_checkout'),
+        IndexModel([('status', ASCENDING), ('deadline', ASCENDING)], name='status_deadline'),
+        # Archiving finished requests by age
+        IndexModel([('status', ASCENDING), ('submission_timestamp', ASCENDING)], name='status_submission'),
+        # Pending counts for a key
+        IndexModel([('key', ASCENDING), ('status', ASCENDING)], name='key_status'),
+        # /credential/request/list
+        IndexModel(
+            [('priority', DESCENDING), ('submission_timestamp', ASCENDING), ('_id', ASCENDING)],
+            name='queue_order'
+        ),
+        # /credential/request/list?key=...
+        IndexModel(
+            [('key', ASCENDING), ('priority', DESCENDING), ('submission_timestamp', ASCENDING), ('_id', ASCENDING)],
+            name='key_queue_order'
+        ),
+    ],
+    'credential': [
+        IndexModel([('key', ASCENDING), ('_id', ASCENDING)], name='key_id'),
+    ],
+    # Multi-worker mode (see leases.py)
+    'scheduler_lease': [
+        IndexModel([('owner', ASCENDING), ('expires', ASCENDING)], name='owner_expires'),
+    ],
+    'scheduler_worker': [
+        IndexModel([('expires', ASCENDING)], name='expires'),
+    ],
+}
+
+def configure(**settings):
+    # Overrides any of the MONGO_* settings above, e.g. from the website's
+    # config.  Only affects clients created afterwards.
+    for name, value in settings.items():
+        if not name.startswith('MONGO_') or name not in globals():
+            raise KeyError("Unknown Mongo setting '{0}'".format(name))
+        globals()[name] = value
 
 def connect_db():
-    mongoclient = pymongo.MongoClient(MONGO_CLIENT)
+    if embedded.is_embedded(MONGO_CLIENT):
+        return embedded.EmbeddedClient.from_uri(MONGO_CLIENT)
+    mongoclient = pymongo.MongoClient(
+        MONGO_CLIENT,
+        maxPoolSize=MONGO_MAX_POOL_SIZE,
+        minPoolSize=MONGO_MIN_POOL_SIZE,
+        maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+        connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+        serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+        waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        heartbeatFrequencyMS=MONGO_HEARTBEAT_FREQUENCY_MS,
+        connect=False
+    )
     return mongoclient
+
+def get_client():
+    # One pooled client per process.  MongoClient isn't fork-safe, so a
+    # process that was forked after the client was made (e.g. a gunicorn
+    # worker) gets a fresh one of its own.
+    global _client, _client_pid
+    with _client_lock:
+        if _client is None or _client_pid != os.getpid():
+            _client = connect_db()
+            _client_pid = os.getpid()
+        return _client
+
+def set_client(client):
+    # Swaps in a client of the caller's choosing for this process (e.g. an
+    # in-process stand-in for benchmarks)
+    global _client, _client_pid
+    with _client_lock:
+        _client = client
+        _client_pid = os.getpid()
+
+def get_db():
+    return get_client()[MONGO_DATABASE]
+
+def get_async_client():
+    # Same as get_client(), but a motor client for the async web tier (see
+    # vinz_clortho_website/asgi.py).  motor is only needed there, so it's
+    # only imported here.
+    global _async_client, _async_client_pid
+    if embedded.is_embedded(MONGO_CLIENT):
+        # Goes through this process's EmbeddedClient
+        client = get_client()
+        with _client_lock:
+            if getattr(_async_client, 'delegate', None) is not client:
+                _async_client = embedded.AsyncEmbeddedClient(client)
+                _async_client_pid = os.getpid()
+            return _async_client
+    from motor.motor_asyncio import AsyncIOMotorClient
+    with _client_lock:
+        if _async_client is None or _async_client_pid != os.getpid():
+            _async_client = AsyncIOMotorClient(
+                MONGO_CLIENT,
+                maxPoolSize=MONGO_MAX_POOL_SIZE,
+                minPoolSize=MONGO_MIN_POOL_SIZE,
+                maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+                connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+                serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+                socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+                waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+                heartbeatFrequencyMS=MONGO_HEARTBEAT_FREQUENCY_MS
+            )
+            _async_client_pid = os.getpid()
+        return _async_client
+
+def set_async_client(client):
+    global _async_client, _async_client_pid
+    with _client_lock:
+        _async_client = client
+        _async_client_pid = os.getpid()
+
+def get_async_db():
+    return get_async_client()[MONGO_DATABASE]
+
+def is_healthy(client=None):
+    try:
+        (client if client is not None else get_client()).admin.command('ping')
+        return True
+    except pymongo.errors.PyMongoError:
+        return False
+
+def ensure_indexes(db):
+    # Creates whichever of INDEXES are missing.  An index that exists under
+    # one of our names but with different keys is left alone and reported
+    # back, since rebuilding it on a live collection is not something to do
+    # behind anybody's back.
+    problems = []
+    for collection, indexes in INDEXES.items():
+        existing = db[collection].index_information()
+        missing = []
+        for index in indexes:
+            document = index.document
+            if document['name'] not in existing:
+                missing.append(index)
+            elif list(existing[document['name']]['key']) != list(document['key'].items()):
+                problems.append('{0}.{1} exists with keys {2}, expected {3}'.format(
+                    collection, document['name'], existing[document['name']]['key'], list(document['key'].items())
+                ))
+        if missing:
+            db[collection].create_indexes(missing)
+    return problems
+
+def check_indexes(db):
+    # Reports, per collection, which of INDEXES are missing or mismatched,
+    # and which indexes (ours or not) have not been used since the server
+    # last started.
+    report = {}
+    for collection, indexes in INDEXES.items():
+        existing = db[collection].index_information()
+        expected = dict((index.document['name'], list(index.document['key'].items())) for index in indexes)
+        usage = dict(
+            (stats['name'], stats['accesses']['ops'])
+            for stats in db[collection].aggregate([{'$indexStats': {}}])
+        )
+        report[collection] = {
+            'missing': [name for name in expected if name not in existing],
+            'mismatched': [
+                name for name in expected
+                if name in existing and list(existing[name]['key']) != expected[name]
+            ],
+            'unused': [name for name in existing if name != '_id_' and usage.get(name, 0) == 0],
+            'unknown': [name for name in existing if name != '_id_' and name not in expected],
+        }
+    return report
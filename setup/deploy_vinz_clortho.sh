@@ -1,8 +1,11 @@
 #!/bin/bash
 
+# vinz-clortho-asgi to run the async web tier instead
+WEB_SERVICE=${WEB_SERVICE:-vinz-clortho-web}
+
 pushd /home/vdatas/git/vinz_clortho
 
-sudo systemctl stop vinz-clortho-web
+sudo systemctl stop $WEB_SERVICE
 sudo systemctl stop vinz-clortho
 
 git clean -f
@@ -11,8 +14,9 @@ git pull origin ${1:-master}
 
 chmod +x vinz_clortho
 chmod +x wsgi.py
+chmod +x asgi.py
 sudo rsync -av --delete --quiet . /opt/vinz_clortho/ --exclude setup/ --exclude .git/ --exclude .gitignore
 sudo systemctl start vinz-clortho
-sudo systemctl start vinz-clortho-web
+sudo systemctl start $WEB_SERVICE
 
 popd
@@ -0,0 +1,78 @@
+__author__ = 'Steven Ogdahl'
+
+from collections import deque
+from datetime import timedelta
+
+
+class SlidingWindow(object):
+    # Allows at most `burst` checkouts in any `seconds`-long window.  Only
+    # the last `burst` checkout times are ever kept, so every check is O(1).
+    # A throttle of 0 seconds means no throttling at all.
+
+    def __init__(self, seconds=0, burst=1):
+        self.checkouts = deque()
+        self.configure(seconds, burst)
+
+    def configure(self, seconds, burst=1):
+        self.seconds = seconds
+        self.window = timedelta(seconds=seconds)
+        self.burst = max(1, burst or 1)
+        self.checkouts = deque(self.checkouts, maxlen=self.burst)
+
+    def next_eligible(self, now):
+        # Returns None if a checkout is allowed right now, otherwise the time
+        # after which it will be.
+        if self.seconds == 0 or len(self.checkouts) < self.burst:
+            return None
+        # The oldest of the last `burst` checkouts is the one that has to
+        # drop out of the window first
+        eligible = self.checkouts[0] + self.window
+        if now > eligible:
+            return None
+        return eligible
+
+    def allow(self, now):
+        return self.next_eligible(now) is None
+
+    def record(self, timestamp):
+        # Checkouts almost always arrive in order; the odd straggler (e.g.
+        # while loading history) is slotted into place
+        if not self.checkouts or timestamp >= self.checkouts[-1]:
+            self.checkouts.append(timestamp)
+        else:
+            self.checkouts = deque(sorted(list(self.checkouts) + [timestamp])[-self.burst:], maxlen=self.burst)
+
+
+class ThrottleEngine(object):
+    # Rate limits for every credential, keyed by credential id
+
+    def __init__(self):
+        self.windows = {}
+
+    def configure(self, credential_id, seconds, burst=1):
+        window = self.windows.get(credential_id)
+        if window:
+            window.configure(seconds, burst)
+        else:
+            self.windows[credential_id] = SlidingWindow(seconds, burst)
+
+    def forget(self, credential_id):
+        self.windows.pop(credential_id, None)
+
+    def allow(self, credential_id, now):
+        window = self.windows.get(credential_id)
+        return window is None or window.allow(now)
+
+    def next_eligible(self, credential_id, now):
+        window = self.windows.get(credential_id)
+        if window is None:
+            return None
+        return window.next_eligible(now)
+
+    def record(self, credential_id, timestamp):
+        window = self.windows.get(credential_id)
+        if window:
+            window.record(timestamp)
+
+    def longest_window(self):
+        return max([window.window for window in self.windows.values()] or [timedelta()])
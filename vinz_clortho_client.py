@@ -0,0 +1,481 @@
+__author__ = 'Steven Ogdahl'
+
+# Client for the website's ticket API, so that scrapers don't each have to
+# write their own.  It keeps its connections open between calls, waits
+# for credentials with the server's long-polling (backing off when the
+# server or the network isn't cooperating), and hands credentials out
+# through a context manager that always gives them back:
+#
+#   client = VinzClorthoClient('https://vinz-clortho.titleapi.com', 'user', 'password')
+#   with client.lease('some-key', heartbeat=True) as ticket:
+#       log_in(ticket.username, ticket.password)
+#
+# AsyncVinzClorthoClient does the same for asyncio code:
+#
+#   async with AsyncVinzClorthoClient(url, 'user', 'password') as client:
+#       async with client.lease('some-key') as ticket:
+#           ...
+#
+# Only needs `requests` (or `httpx` for the async client), not anything
+# else from this repository.
+
+import asyncio
+import contextlib
+import logging
+import random
+import threading
+import time
+from datetime import datetime
+
+# Ticket statuses, as in models.CMRequest
+UNKNOWN = 0
+SUBMITTED = 1
+QUEUING = 2
+GIVEN_OUT = 5
+IN_USE = 6
+
+WAITING_STATUSES = (SUBMITTED, QUEUING)
+
+# Seconds the server is asked to hold on to each long-poll.  Kept well
+# under the proxy's read timeout (60s for nginx).
+POLL_TIMEOUT = 30
+# Seconds to allow for connecting, and for a response on top of however
+# long it was asked to wait
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 30
+# Seconds between retries when the server can't be reached (or isn't
+# long-polling), doubling up to MAX_BACKOFF
+MIN_BACKOFF = 0.5
+MAX_BACKOFF = 30
+# Connections kept open to the server
+POOL_SIZE = 10
+# Tries at giving a credential back before leaving it to time out
+RELEASE_ATTEMPTS = 3
+
+
+class VinzClorthoError(Exception):
+    pass
+
+
+class ServiceUnavailable(VinzClorthoError):
+    # The server couldn't be reached or answered with a 5xx; worth trying
+    # again
+    pass
+
+
+class CredentialUnavailable(VinzClorthoError):
+    # The ticket stopped waiting (or we stopped waiting for it) without a
+    # credential being given out
+
+    def __init__(self, ticket):
+        super(CredentialUnavailable, self).__init__(
+            "No credential for {0} (ticket {1}, status {2})".format(ticket.key, ticket.ticket, ticket.status))
+        self.ticket = ticket
+
+
+class Ticket(object):
+    # A ticket's status as the server last described it
+
+    def __init__(self, data, etag=None):
+        self.data = data
+        self.etag = etag
+
+    @property
+    def ticket(self):
+        return self.data.get('ticket')
+
+    @property
+    def key(self):
+        return self.data.get('key')
+
+    @property
+    def status(self):
+        return self.data.get('status', UNKNOWN)
+
+    @property
+    def username(self):
+        return self.data.get('username')
+
+    @property
+    def password(self):
+        return self.data.get('password')
+
+    @property
+    def checkout(self):
+        return self._timestamp('checkout')
+
+    @property
+    def deadline(self):
+        return self._timestamp('deadline')
+
+    @property
+    def waiting(self):
+        return self.status in WAITING_STATUSES
+
+    @property
+    def checked_out(self):
+        return self.status in (GIVEN_OUT, IN_USE) and 'username' in self.data
+
+    @property
+    def lease_seconds(self):
+        # How long the server lets the credential go without a heartbeat
+        # (None if it doesn't keep deadlines)
+        if self.checkout and self.deadline:
+            return (self.deadline - self.checkout).total_seconds()
+        return None
+
+    def _timestamp(self, field):
+        value = self.data.get(field)
+        return datetime.fromisoformat(value) if value else None
+
+    def __repr__(self):
+        return 'Ticket({0!r}, key={1!r}, status={2})'.format(self.ticket, self.key, self.status)
+
+
+class Backoff(object):
+    # Exponential backoff with jitter, so a fleet of clients that lost the
+    # server at the same moment don't all come back at the same moment
+
+    def __init__(self, minimum=MIN_BACKOFF, maximum=MAX_BACKOFF):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.current = minimum
+
+    def reset(self):
+        self.current = self.minimum
+
+    def next(self):
+        delay = random.uniform(self.current / 2, self.current)
+        self.current = min(self.current * 2, self.maximum)
+        return delay
+
+
+class _ClientBase(object):
+    # What the two clients have in common; subclasses do the actual I/O
+
+    def __init__(self, url, username, password, poll_timeout=POLL_TIMEOUT, pool_size=POOL_SIZE):
+        self.url = url.rstrip('/')
+        self.auth = (username, password)
+        self.poll_timeout = poll_timeout
+        self.pool_size = pool_size
+
+    def _request_args(self, key, priority, poll_timeout):
+        path = '/credential/request/{0}'.format(key)
+        params = self._poll_params(poll_timeout)
+        if priority is not None:
+            params['priority'] = priority
+        return path, params
+
+    @staticmethod
+    def _poll_params(poll_timeout):
+        if not poll_timeout:
+            return {}
+        return {'poll': 'true', 'poll_timeout': poll_timeout}
+
+    def _next_poll(self, deadline):
+        # Seconds to long-poll for next (0 once `deadline` has passed)
+        if deadline is None:
+            return self.poll_timeout
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return 0
+        return max(1, int(min(self.poll_timeout, remaining)))
+
+    @staticmethod
+    def _held(started, poll_timeout):
+        # Whether the server actually held on to a poll that came back
+        # still waiting (an older server, or one not following the
+        # database's changes, answers straight away)
+        return time.time() - started >= poll_timeout / 2
+
+    def _parse(self, status_code, headers, body, previous=None):
+        if status_code == 304 and previous is not None:
+            return previous
+        if status_code >= 500:
+            raise ServiceUnavailable("{0} answered {1}".format(self.url, status_code))
+        if status_code != 200:
+            raise VinzClorthoError("{0} answered {1}".format(self.url, status_code))
+        data = body()
+        if isinstance(data, list):
+            return [Ticket(d) for d in data]
+        return Ticket(data, headers.get('ETag'))
+
+    @staticmethod
+    def _heartbeat_interval(ticket):
+        lease_seconds = ticket.lease_seconds
+        return max(1, lease_seconds / 3) if lease_seconds else None
+
+    @staticmethod
+    def _log_release_failure(ticket, e):
+        logging.log(logging.WARNING, "Could not release ticket {0}; it will time out instead: {1}".format(
+            ticket.ticket, e))
+
+
+class VinzClorthoClient(_ClientBase):
+
+    def __init__(self, url, username, password, poll_timeout=POLL_TIMEOUT, pool_size=POOL_SIZE):
+        import requests
+        import requests.adapters
+        super(VinzClorthoClient, self).__init__(url, username, password, poll_timeout, pool_size)
+        self._requests = requests
+        self.session = requests.Session()
+        self.session.auth = self.auth
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _call(self, method, path, params=None, data=None, wait=0, previous=None):
+        headers = {}
+        if previous is not None and previous.etag:
+            headers['If-None-Match'] = previous.etag
+        try:
+            response = self.session.request(
+                method, self.url + path, params=params, data=data, headers=headers,
+                timeout=(CONNECT_TIMEOUT, wait + READ_TIMEOUT)
+            )
+        except (self._requests.ConnectionError, self._requests.Timeout) as e:
+            raise ServiceUnavailable(str(e)) from e
+        return self._parse(response.status_code, response.headers, response.json, previous)
+
+    def request(self, key, priority=None, poll_timeout=0):
+        # Submits a request for a credential for `key`, optionally waiting
+        # up to `poll_timeout` seconds for it to be given out
+        path, params = self._request_args(key, priority, poll_timeout)
+        return self._call('GET', path, params, wait=poll_timeout)
+
+    def status(self, ticket, poll_timeout=0):
+        # `ticket` is a Ticket (whose ETag is then used to skip the body if
+        # nothing has changed) or a ticket id
+        previous = ticket if isinstance(ticket, Ticket) else None
+        return self._call('GET', '/credential/status/{0}'.format(getattr(ticket, 'ticket', ticket)),
+                          self._poll_params(poll_timeout), wait=poll_timeout, previous=previous)
+
+    def release(self, ticket):
+        # Gives the credential back (or cancels the request if it's still
+        # waiting)
+        return self._call('GET', '/credential/release/{0}'.format(getattr(ticket, 'ticket', ticket)))
+
+    def heartbeat(self, ticket, seconds=None):
+        # Pushes the ticket's deadline out by `seconds` (by default, as far
+        # as its lease allows)
+        data = {'seconds': seconds} if seconds is not None else {}
+        return self._call('POST', '/credential/heartbeat/{0}'.format(getattr(ticket, 'ticket', ticket)), data=data)
+
+    def wait(self, ticket, timeout=None):
+        # Long-polls until `ticket` stops waiting or `timeout` seconds have
+        # gone by, and returns it as it was last seen
+        deadline = time.time() + timeout if timeout is not None else None
+        backoff = Backoff()
+        while ticket.waiting:
+            poll_timeout = self._next_poll(deadline)
+            if not poll_timeout:
+                break
+            started = time.time()
+            try:
+                ticket = self.status(ticket, poll_timeout)
+            except ServiceUnavailable as e:
+                logging.log(logging.INFO, "Retrying ticket {0}: {1}".format(ticket.ticket, e))
+                time.sleep(min(backoff.next(), poll_timeout))
+                continue
+            if ticket.waiting and not self._held(started, poll_timeout):
+                time.sleep(min(backoff.next(), poll_timeout))
+            else:
+                backoff.reset()
+        return ticket
+
+    def checkout(self, key, priority=None, timeout=None):
+        # Requests a credential and waits for it.  Raises
+        # CredentialUnavailable (having cancelled the request) if none is
+        # given out within `timeout` seconds.
+        ticket = self.request(key, priority, self._next_poll(time.time() + timeout if timeout is not None else None))
+        try:
+            ticket = self.wait(ticket, timeout)
+        except BaseException:
+            self.release_quietly(ticket)
+            raise
+        if not ticket.checked_out:
+            self.release_quietly(ticket)
+            raise CredentialUnavailable(ticket)
+        return ticket
+
+    def release_quietly(self, ticket):
+        # release(), retried a few times and logged rather than raised if
+        # it still doesn't go through
+        backoff = Backoff()
+        for attempt in range(RELEASE_ATTEMPTS):
+            try:
+                return self.release(ticket)
+            except VinzClorthoError as e:
+                if attempt == RELEASE_ATTEMPTS - 1:
+                    self._log_release_failure(ticket, e)
+                else:
+                    time.sleep(backoff.next())
+        return None
+
+    @contextlib.contextmanager
+    def lease(self, key, priority=None, timeout=None, heartbeat=False):
+        # checkout() on the way in and release on the way out, however the
+        # block is left.  With `heartbeat` the credential is kept alive in
+        # the background for as long as the block takes.
+        ticket = self.checkout(key, priority, timeout)
+        heartbeats = None
+        try:
+            interval = self._heartbeat_interval(ticket)
+            if heartbeat and interval:
+                heartbeats = _Heartbeats(self, ticket, interval)
+                heartbeats.start()
+            yield ticket
+        finally:
+            if heartbeats:
+                heartbeats.stop()
+            self.release_quietly(ticket)
+
+
+class _Heartbeats(threading.Thread):
+
+    def __init__(self, client, ticket, interval):
+        super(_Heartbeats, self).__init__(name='vinz-clortho-heartbeat-{0}'.format(ticket.ticket), daemon=True)
+        self.client = client
+        self.ticket = ticket
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.client.heartbeat(self.ticket)
+            except VinzClorthoError as e:
+                logging.log(logging.WARNING, "Heartbeat for ticket {0} failed: {1}".format(self.ticket.ticket, e))
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class AsyncVinzClorthoClient(_ClientBase):
+    # VinzClorthoClient for asyncio, through httpx
+
+    def __init__(self, url, username, password, poll_timeout=POLL_TIMEOUT, pool_size=POOL_SIZE):
+        import httpx
+        super(AsyncVinzClorthoClient, self).__init__(url, username, password, poll_timeout, pool_size)
+        self._httpx = httpx
+        self.session = httpx.AsyncClient(
+            auth=self.auth,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        )
+
+    async def close(self):
+        await self.session.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def _call(self, method, path, params=None, data=None, wait=0, previous=None):
+        headers = {}
+        if previous is not None and previous.etag:
+            headers['If-None-Match'] = previous.etag
+        try:
+            response = await self.session.request(
+                method, self.url + path, params=params, data=data, headers=headers,
+                timeout=self._httpx.Timeout(wait + READ_TIMEOUT, connect=CONNECT_TIMEOUT)
+            )
+        except self._httpx.TransportError as e:
+            raise ServiceUnavailable(str(e)) from e
+        return self._parse(response.status_code, response.headers, response.json, previous)
+
+    async def request(self, key, priority=None, poll_timeout=0):
+        path, params = self._request_args(key, priority, poll_timeout)
+        return await self._call('GET', path, params, wait=poll_timeout)
+
+    async def status(self, ticket, poll_timeout=0):
+        previous = ticket if isinstance(ticket, Ticket) else None
+        return await self._call('GET', '/credential/status/{0}'.format(getattr(ticket, 'ticket', ticket)),
+                                self._poll_params(poll_timeout), wait=poll_timeout, previous=previous)
+
+    async def release(self, ticket):
+        return await self._call('GET', '/credential/release/{0}'.format(getattr(ticket, 'ticket', ticket)))
+
+    async def heartbeat(self, ticket, seconds=None):
+        data = {'seconds': seconds} if seconds is not None else {}
+        return await self._call('POST', '/credential/heartbeat/{0}'.format(getattr(ticket, 'ticket', ticket)),
+                                data=data)
+
+    async def wait(self, ticket, timeout=None):
+        deadline = time.time() + timeout if timeout is not None else None
+        backoff = Backoff()
+        while ticket.waiting:
+            poll_timeout = self._next_poll(deadline)
+            if not poll_timeout:
+                break
+            started = time.time()
+            try:
+                ticket = await self.status(ticket, poll_timeout)
+            except ServiceUnavailable as e:
+                logging.log(logging.INFO, "Retrying ticket {0}: {1}".format(ticket.ticket, e))
+                await asyncio.sleep(min(backoff.next(), poll_timeout))
+                continue
+            if ticket.waiting and not self._held(started, poll_timeout):
+                await asyncio.sleep(min(backoff.next(), poll_timeout))
+            else:
+                backoff.reset()
+        return ticket
+
+    async def checkout(self, key, priority=None, timeout=None):
+        ticket = await self.request(
+            key, priority, self._next_poll(time.time() + timeout if timeout is not None else None))
+        try:
+            ticket = await self.wait(ticket, timeout)
+        except BaseException:
+            # Shielded so that being cancelled still cancels the request
+            await asyncio.shield(self.release_quietly(ticket))
+            raise
+        if not ticket.checked_out:
+            await self.release_quietly(ticket)
+            raise CredentialUnavailable(ticket)
+        return ticket
+
+    async def release_quietly(self, ticket):
+        backoff = Backoff()
+        for attempt in range(RELEASE_ATTEMPTS):
+            try:
+                return await self.release(ticket)
+            except VinzClorthoError as e:
+                if attempt == RELEASE_ATTEMPTS - 1:
+                    self._log_release_failure(ticket, e)
+                else:
+                    await asyncio.sleep(backoff.next())
+        return None
+
+    @contextlib.asynccontextmanager
+    async def lease(self, key, priority=None, timeout=None, heartbeat=False):
+        ticket = await self.checkout(key, priority, timeout)
+        heartbeats = None
+        try:
+            interval = self._heartbeat_interval(ticket)
+            if heartbeat and interval:
+                heartbeats = asyncio.get_running_loop().create_task(self._heartbeats(ticket, interval))
+            yield ticket
+        finally:
+            if heartbeats:
+                heartbeats.cancel()
+            await asyncio.shield(self.release_quietly(ticket))
+
+    async def _heartbeats(self, ticket, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.heartbeat(ticket)
+            except VinzClorthoError as e:
+                logging.log(logging.WARNING, "Heartbeat for ticket {0} failed: {1}".format(ticket.ticket, e))
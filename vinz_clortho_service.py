@@ -2,15 +2,54 @@ import sys
 import time
 import logging
 import signal
-from datetime import datetime
+import threading
+from datetime import datetime, timedelta
 
-from models import Credential, CMRequest
+from allocation import AllocationState, RequestQueue
+from archiver import RequestArchiver
+from leases import KeyLeases, MongoKeyLeases
+from models import Credential, CredentialKey, CMRequest, statistics_increments
+from watcher import ChangeWatcher
+import metrics
 import mongo
 
-# Seconds to use as a timeout
+# Seconds to use as a timeout.  USING_TIMEOUT is the lease given to keys
+# that don't have a lease_seconds of their own (see CredentialKey).
 WAITING_TIMEOUT = 90
-USING_TIMEOUT = 600
+USING_TIMEOUT = CredentialKey.DEFAULT_LEASE_SECONDS
 POLL_INTERVAL = 2
+# React to database changes as they happen (POLL_INTERVAL then only sets how
+# often a full sweep runs as a safety net)
+EVENT_DRIVEN = False
+# Split keys with any other service processes running against the same
+# database (see leases.MongoKeyLeases)
+PARTITIONED = False
+# Move finished requests older than this many seconds out of cm_request
+# (0 = never), keep them for RETENTION seconds (0 = forever), or only keep
+# daily counts of them with ARCHIVE_COMPACT
+ARCHIVE_AGE = 0
+ARCHIVE_RETENTION = 0
+ARCHIVE_COMPACT = False
+ARCHIVE_INTERVAL = 300
+# Seconds between checks of every credential's checkouts counter against
+# the requests actually holding it (0 = never)
+RECONCILE_INTERVAL = 300
+# Port to serve Prometheus metrics on (0 = don't)
+METRICS_PORT = 0
+
+QUEUE_DEPTH = metrics.Gauge('vinz_clortho_queue_depth', 'Requests queuing for a credential', ['key'])
+CREDENTIALS_IN_USE = metrics.Gauge('vinz_clortho_credentials_in_use', 'Checkouts currently held', ['key'])
+PHASE_DURATION = metrics.Histogram(
+    'vinz_clortho_phase_duration_seconds', 'Time spent in each phase of the service loop', ['phase'])
+LOOP_DURATION = metrics.Histogram('vinz_clortho_loop_duration_seconds', 'Time spent on a full service loop')
+LOOP_MONGO_COMMANDS = metrics.Histogram(
+    'vinz_clortho_loop_mongo_commands', 'MongoDB round trips made by a service loop',
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000))
+CHECKOUT_WAIT = metrics.Histogram(
+    'vinz_clortho_checkout_wait_seconds', 'Time from a request being submitted to it being given a credential')
+CHECKOUT_USAGE = metrics.Histogram(
+    'vinz_clortho_checkout_usage_seconds', 'Time from a credential being given out to it being returned')
+TIMEOUTS = metrics.Counter('vinz_clortho_timeouts_total', 'Requests timed out', ['status'])
 
 class VCService:
     timestamp_format = '%Y-%m-%d %H:%M:%S'
@@ -22,6 +61,19 @@ class VCService:
     PROCESS_COUNT = 0
     PROCESS_INDEX = 0
     dn = None
+    allocation = None
+    queue = None
+    leases = None
+    archiver = None
+    command_counter = None
+    metrics_server = None
+    next_archive = None
+    next_reconcile = None
+    # credential id -> (checkouts, holders) for counters found off on the
+    # last reconciliation
+    checkout_drift = None
+    wakeup = None
+    watchers = ()
 
     def __init__(self, *args, **kwargs):
         self.min_log_level = kwargs.get('min_log_level', logging.WARNING)
@@ -35,6 +87,27 @@ class VCService:
         if 'POLL_INTERVAL' in kwargs:
             global POLL_INTERVAL
             POLL_INTERVAL = kwargs['POLL_INTERVAL']
+        if 'EVENT_DRIVEN' in kwargs:
+            global EVENT_DRIVEN
+            EVENT_DRIVEN = kwargs['EVENT_DRIVEN']
+        if 'PARTITIONED' in kwargs:
+            global PARTITIONED
+            PARTITIONED = kwargs['PARTITIONED']
+        if 'ARCHIVE_AGE' in kwargs:
+            global ARCHIVE_AGE
+            ARCHIVE_AGE = kwargs['ARCHIVE_AGE']
+        if 'ARCHIVE_RETENTION' in kwargs:
+            global ARCHIVE_RETENTION
+            ARCHIVE_RETENTION = kwargs['ARCHIVE_RETENTION']
+        if 'ARCHIVE_COMPACT' in kwargs:
+            global ARCHIVE_COMPACT
+            ARCHIVE_COMPACT = kwargs['ARCHIVE_COMPACT']
+        if 'METRICS_PORT' in kwargs:
+            global METRICS_PORT
+            METRICS_PORT = kwargs['METRICS_PORT']
+        if 'RECONCILE_INTERVAL' in kwargs:
+            global RECONCILE_INTERVAL
+            RECONCILE_INTERVAL = kwargs['RECONCILE_INTERVAL']
         logging.basicConfig(
             filename=self.logfile,
             level=self.min_log_level,
@@ -66,6 +139,8 @@ class VCService:
             previous_step = self.PROCESS_STEP
             self.log(logging.DEBUG, "Going to sleep for {0} seconds".format(GRACE_WAIT))
             time.sleep(GRACE_WAIT)
+        if self.leases:
+            self.leases.release_all()
         self.log(logging.INFO, "Gracefully terminated.")
         sys.exit(0)
 
@@ -73,51 +148,187 @@ class VCService:
         self.log(logging.INFO, "Running with a polling interval of {0} seconds".format(POLL_INTERVAL))
         self.log(logging.INFO, "Credential waiting timeout is {0} seconds".format(WAITING_TIMEOUT))
         self.log(logging.INFO, "Credential using timeout is {0} seconds".format(USING_TIMEOUT))
+        self.log(logging.INFO, "Event-driven scheduling is {0}".format('on' if EVENT_DRIVEN else 'off'))
+        self.log(logging.INFO, "Key partitioning is {0}".format('on' if PARTITIONED else 'off'))
+        if ARCHIVE_AGE:
+            self.log(logging.INFO, "Archiving finished requests after {0} seconds".format(ARCHIVE_AGE))
 
-        connection = mongo.connect_db()
-        self.db = connection.vinz_clortho
+        self.setup()
 
         signal.signal(signal.SIGTERM, self.graceful_term)
         self.SHOULD_BE_RUNNING = True
 
         while self.SHOULD_BE_RUNNING:
             self.IS_RUNNING = True
+            # Anything that changes from here on needs another pass
+            self.wakeup.clear()
 
-            self._process_new_requests()
-            self._process_cancelled_requests()
-            self._process_returned_requests()
-            self._process_pending_requests()
-            self._process_in_use_credentials()
-            self._process_request_queue()
-
-            if self.PROCESS_COUNT > 0:
-                self.log(logging.DEBUG, "Done checking credentials to give out for queued requests")
+            self.run_once()
 
             self.IS_RUNNING = False
-            self.log(logging.DEBUG, "Going to sleep for {0} seconds".format(POLL_INTERVAL))
-            time.sleep(POLL_INTERVAL)
+            sleep_for = POLL_INTERVAL
+            if self.watchers:
+                # No need to sit out the whole interval if a throttled
+                # credential frees up before then
+                next_eligible = self.allocation.next_eligible()
+                if next_eligible:
+                    sleep_for = max(0, min(sleep_for, (next_eligible - datetime.now()).total_seconds() + 0.01))
+            self.log(logging.DEBUG, "Going to sleep for {0} seconds".format(sleep_for))
+            # The watchers (if any) cut this short as soon as something happens
+            if self.wakeup.wait(sleep_for):
+                self.log(logging.DEBUG, "Woken up by a change")
+
+    def setup(self, db=None):
+        if METRICS_PORT:
+            # Has to be in place before the client is made to see its commands
+            self.command_counter = metrics.CommandCounter().register()
+            self.metrics_server = metrics.MetricsServer(METRICS_PORT)
+            self.metrics_server.start()
+            self.log(logging.INFO, "Serving metrics on port {0}".format(METRICS_PORT))
+        self.db = db if db is not None else mongo.get_db()
+        for problem in mongo.ensure_indexes(self.db):
+            self.log(logging.WARNING, "Index problem: {0}".format(problem))
+
+        Credential.recount_checkouts(self.db)
+        self.allocation = AllocationState()
+        self.allocation.load(self.db)
+        if PARTITIONED:
+            self.leases = MongoKeyLeases(self.db)
+            self.log(logging.INFO, "Running as worker {0}".format(self.leases.worker_id))
+        else:
+            self.leases = KeyLeases()
+        self.queue = RequestQueue()
+        self.queue.load(self.db, self._owned({}))
+
+        if ARCHIVE_AGE:
+            self.archiver = RequestArchiver(
+                self.db, ARCHIVE_AGE, retention_seconds=ARCHIVE_RETENTION or None, compact=ARCHIVE_COMPACT
+            )
+            self.archiver.ensure_ttl()
+            self.next_archive = datetime.now()
+        if RECONCILE_INTERVAL:
+            self.next_reconcile = datetime.now()
+            self.checkout_drift = {}
+
+        self.wakeup = threading.Event()
+        if EVENT_DRIVEN:
+            self._start_watchers()
+
+    def run_once(self):
+        # One full pass over everything that needs doing
+        self.allocation.refresh_credentials(self.db)
+        acquired = self.leases.refresh(list(self.allocation.keys))
+        if acquired:
+            self.log(logging.INFO, "Took over keys: {0}".format(', '.join(sorted(acquired))))
+            self.allocation.load_history(self.db, acquired)
+            self.queue.load(self.db, {'key': {'$in': list(acquired)}})
+        owned_keys = self.leases.owned_keys()
+        if owned_keys is not None:
+            self.queue.retain(owned_keys)
+        loop_start = time.time()
+        commands = self.command_counter.count() if self.command_counter else 0
+        for phase in (
+            self._process_new_requests,
+            self._process_cancelled_requests,
+            self._process_returned_requests,
+            self._process_pending_requests,
+            self._process_in_use_credentials,
+            self._process_request_queue
+        ):
+            phase_start = time.time()
+            phase()
+            PHASE_DURATION.observe(time.time() - phase_start, phase=phase.__name__[len('_process_'):])
+
+        if self.PROCESS_COUNT > 0:
+            self.log(logging.DEBUG, "Done checking credentials to give out for queued requests")
+
+        if self.archiver and datetime.now() >= self.next_archive:
+            self._archive_requests()
+
+        if self.next_reconcile and datetime.now() >= self.next_reconcile:
+            self._reconcile_checkouts()
+
+        LOOP_DURATION.observe(time.time() - loop_start)
+        if self.command_counter:
+            LOOP_MONGO_COMMANDS.observe(self.command_counter.count() - commands)
+        in_use = {}
+        for key, slots in self.allocation.keys.items():
+            in_use[(key,)] = sum(slot.in_use for slot in slots)
+        CREDENTIALS_IN_USE.replace(in_use)
+
+    def _start_watchers(self):
+        self.watchers = (
+            # New tickets, and the clients' own transitions that the service
+            # has to act on.  Our own writes are left out so that they don't
+            # wake us straight back up again.
+            ChangeWatcher(self.db.cm_request, self._on_change, pipeline=[
+                {'$match': {'$or': [
+                    {'operationType': {'$in': ['insert', 'replace']}},
+                    {
+                        'operationType': 'update',
+                        'updateDescription.updatedFields.status': {'$in': [CMRequest.CANCEL, CMRequest.RETURNED]}
+                    }
+                ]}}
+            ]),
+            # Edits to credentials (but not our own checkouts bookkeeping)
+            ChangeWatcher(self.db.credential, self._on_change, pipeline=[
+                {'$match': {'$or': [
+                    {'operationType': {'$in': ['insert', 'replace', 'delete']}},
+                    {'updateDescription.updatedFields.key': {'$exists': True}},
+                    {'updateDescription.updatedFields.max_checkouts': {'$exists': True}},
+                    {'updateDescription.updatedFields.throttle_seconds': {'$exists': True}},
+                    {'updateDescription.updatedFields.throttle_burst': {'$exists': True}}
+                ]}}
+            ]),
+        )
+        for watcher in self.watchers:
+            watcher.start()
+
+    def _on_change(self, change):
+        self.wakeup.set()
+
+    def _owned(self, filter):
+        # Narrows a cm_request filter down to the keys this worker holds
+        owned_keys = self.leases.owned_keys()
+        if owned_keys is not None:
+            filter['key'] = {'$in': owned_keys}
+        return filter
 
 
     def _process_new_requests(self):
-        new_requests = CMRequest.find(self.db, filter={'status': CMRequest.SUBMITTED})
+        filter = {'status': CMRequest.SUBMITTED}
+        if self.leases.partitioned:
+            # Requests for keys that nobody has credentials for belong to
+            # nobody, so whoever gets to them first turns them away
+            filter['$or'] = [
+                {'key': {'$in': self.leases.owned_keys()}},
+                {'key': {'$nin': list(self.allocation.keys)}}
+            ]
+        new_requests = CMRequest.find(self.db, filter=filter)
         self.PROCESS_STEP = "New Requests"
         self.PROCESS_COUNT = len(new_requests)
         self.PROCESS_INDEX = 0
         if self.PROCESS_COUNT > 0:
             self.log(logging.DEBUG, "Processing {0} new requests".format(self.PROCESS_COUNT))
             self.log(logging.DEBUG, "Ids: {0}".format(', '.join([str(r.id) for r in new_requests])))
+        transitions = []
+        queuing = set()
         for new_request in new_requests:
             self.PROCESS_INDEX += 1
-            credentials = Credential.find(self.db, filter={'key': new_request.key})
 
             # If we didn't find any credentials, then error out this request
-            if len(credentials) == 0:
+            if not self.allocation.has_key(new_request.key):
                 self.log(logging.ERROR, "No such key found: {0}".format(new_request.key), new_request)
-                new_request.update(status=CMRequest.NO_SUCH_KEY)
+                transitions.append((new_request, CMRequest.SUBMITTED, {'status': CMRequest.NO_SUCH_KEY}))
                 continue
 
             self.log(logging.INFO, "Putting into queue", new_request)
-            new_request.update(status=CMRequest.QUEUING)
+            transitions.append((new_request, CMRequest.SUBMITTED, {'status': CMRequest.QUEUING}))
+            queuing.add(new_request.id)
+        for new_request in self._commit_transitions(transitions):
+            if new_request.id in queuing:
+                new_request.status = CMRequest.QUEUING
+                self.queue.push(new_request)
         if self.PROCESS_COUNT > 0:
             self.log(logging.DEBUG, "Done processing new requests")
 
@@ -126,140 +337,283 @@ class VCService:
         # This is mainly a formality, but just mark all the ones that are a
         # status of CANCEL to CANCELED instead.  This indicates that the
         # server acknowledged the order to cancel
-        cancel_requests = CMRequest.find(self.db, filter={'status': CMRequest.CANCEL})
+        cancel_requests = CMRequest.find(self.db, filter=self._owned({'status': CMRequest.CANCEL}))
         self.PROCESS_STEP = "Cancel Requests"
         self.PROCESS_COUNT = len(cancel_requests)
         self.PROCESS_INDEX = 0
         if self.PROCESS_COUNT > 0:
             self.log(logging.DEBUG, "Processing {0} cancel requests".format(self.PROCESS_COUNT))
             self.log(logging.DEBUG, "Ids: {0}".format(', '.join([str(r.id) for r in cancel_requests])))
+        transitions = []
         for cancel_request in cancel_requests:
             self.PROCESS_INDEX += 1
             self.log(logging.INFO, "Canceled by client", cancel_request)
-            cancel_request.update(status=CMRequest.CANCELED)
+            self.queue.discard(cancel_request.id)
+            transitions.append((cancel_request, CMRequest.CANCEL, {'status': CMRequest.CANCELED}))
+        # A request can only be cancelled while it's waiting, but one that
+        # got a credential regardless (e.g. from before the website guarded
+        # its releases) still has to give it back
+        self._release(self._commit_transitions(transitions))
         if self.PROCESS_COUNT > 0:
             self.log(logging.DEBUG, "Done processing cancel requests")
 
 
     def _process_returned_requests(self):
-        returned_credentials = CMRequest.find(self.db, filter={'status': CMRequest.RETURNED})
+        returned_credentials = CMRequest.find(self.db, filter=self._owned({'status': CMRequest.RETURNED}))
         self.PROCESS_STEP = "Returned Credentials"
         self.PROCESS_COUNT = len(returned_credentials)
         self.PROCESS_INDEX = 0
         if self.PROCESS_COUNT > 0:
             self.log(logging.DEBUG, "Processing {0} returned credentials".format(self.PROCESS_COUNT))
             self.log(logging.DEBUG, "Ids: {0}".format(', '.join([str(r.id) for r in returned_credentials])))
+        transitions = []
         for returned_credential in returned_credentials:
             self.PROCESS_INDEX += 1
-            credential = Credential.find_one(self.db, filter={'_id': returned_credential.credential})
             returned_credential.status = CMRequest.COMPLETED
             returned_credential.checkin_timestamp = datetime.now()
             self.log(logging.INFO, "CredentialId {0} returned by client (Elapsed: {1:.1f}s)".format(
-                credential.id,
+                returned_credential.credential,
                 (returned_credential.checkin_timestamp - returned_credential.checkout_timestamp).total_seconds()
             ), returned_credential)
-            returned_credential.update(status=CMRequest.COMPLETED, checkin_timestamp=datetime.now())
+            transitions.append((returned_credential, CMRequest.RETURNED, {
+                'status': CMRequest.COMPLETED,
+                'checkin_timestamp': returned_credential.checkin_timestamp
+            }))
+        self._release(self._commit_transitions(transitions), completed=True)
         if self.PROCESS_COUNT > 0:
             self.log(logging.DEBUG, "Done processing returned credentials")
 
 
     def _process_pending_requests(self):
-        pending_credentials = CMRequest.find(self.db, filter={'status': CMRequest.GIVEN_OUT})
         self.PROCESS_STEP = "Pending Credentials"
-        self.PROCESS_COUNT = len(pending_credentials)
+        self.PROCESS_COUNT = 0
         self.PROCESS_INDEX = 0
+        timed_out = CMRequest.update_many(self.db, self._owned({
+            'status': CMRequest.GIVEN_OUT,
+            'checkout_timestamp': {'$lt': datetime.now() - timedelta(seconds=WAITING_TIMEOUT)}
+        }), status=CMRequest.TIMED_OUT_WAITING)
+        self.PROCESS_COUNT = self.PROCESS_INDEX = len(timed_out)
         if self.PROCESS_COUNT > 0:
-            self.log(logging.DEBUG, "Testing {0} given out credentials for time-out".format(self.PROCESS_COUNT))
-            self.log(logging.DEBUG, "Ids: {0}".format(', '.join([str(r.id) for r in pending_credentials])))
-        for pending_credential in pending_credentials:
-            self.PROCESS_INDEX += 1
-            if (datetime.now() - pending_credential.checkout_timestamp).total_seconds() > WAITING_TIMEOUT:
-                self.log(logging.WARNING, "Timed out waiting for client to receive credentials", pending_credential)
-                pending_credential.update(status=CMRequest.TIMED_OUT_WAITING)
-        if self.PROCESS_COUNT > 0:
-            self.log(logging.DEBUG, "Done testing given-out credentials for time-out")
+            self.log(logging.DEBUG, "Timed out {0} given out credentials".format(self.PROCESS_COUNT))
+            self.log(logging.DEBUG, "Ids: {0}".format(', '.join([str(r.id) for r in timed_out])))
+        for pending_credential in timed_out:
+            self.log(logging.WARNING, "Timed out waiting for client to receive credentials", pending_credential)
+        TIMEOUTS.inc(len(timed_out), status='waiting')
+        self._release(timed_out)
 
 
     def _process_in_use_credentials(self):
-        in_use_credentials = CMRequest.find(self.db, filter={
-            'status': {'$in': (CMRequest.IN_USE, CMRequest.CANCEL)},
-            'checkout_timestamp': {'$exists': True}
-        })
         self.PROCESS_STEP = "In-use Credentials"
-        self.PROCESS_COUNT = len(in_use_credentials)
+        self.PROCESS_COUNT = 0
         self.PROCESS_INDEX = 0
+        now = datetime.now()
+        timed_out = CMRequest.update_many(self.db, self._owned({
+            'status': {'$in': [CMRequest.IN_USE, CMRequest.CANCEL]},
+            '$or': [
+                {'deadline': {'$lt': now}},
+                # Given out before tickets had deadlines
+                {'deadline': None, 'checkout_timestamp': {'$lt': now - timedelta(seconds=USING_TIMEOUT)}}
+            ]
+        }), status=CMRequest.TIMED_OUT_USING)
+        self.PROCESS_COUNT = self.PROCESS_INDEX = len(timed_out)
         if self.PROCESS_COUNT > 0:
-            self.log(logging.DEBUG, "Testing {0} in-use credentials for time-out".format(self.PROCESS_COUNT))
-            self.log(logging.DEBUG, "Ids: {0}".format(', '.join([str(r.id) for r in in_use_credentials])))
-        for in_use_credential in in_use_credentials:
-            self.PROCESS_INDEX += 1
-            if (datetime.now() - in_use_credential.checkout_timestamp).total_seconds() > USING_TIMEOUT:
-                self.log(logging.WARNING, "Timed out waiting for client to return credentials", in_use_credential)
-                in_use_credential.update(status=CMRequest.TIMED_OUT_USING)
-        if self.PROCESS_COUNT > 0:
-            self.log(logging.DEBUG, "Done testing in-use credentials for time-out")
+            self.log(logging.DEBUG, "Timed out {0} in-use credentials".format(self.PROCESS_COUNT))
+            self.log(logging.DEBUG, "Ids: {0}".format(', '.join([str(r.id) for r in timed_out])))
+        for in_use_credential in timed_out:
+            self.log(logging.WARNING, "Timed out waiting for client to return credentials", in_use_credential)
+        TIMEOUTS.inc(len(timed_out), status='using')
+        self._release(timed_out)
+
+
+    def _archive_requests(self):
+        self.PROCESS_STEP = "Archive Requests"
+        self.PROCESS_COUNT = 0
+        self.PROCESS_INDEX = 0
+        self.next_archive = datetime.now() + timedelta(seconds=ARCHIVE_INTERVAL)
+        moved = self.archiver.archive(self._owned({}))
+        if self.leases.partitioned and self.leases.leads():
+            # Requests turned away for a key nobody has credentials for
+            # aren't under anybody's key leases
+            moved += self.archiver.archive(statuses=[CMRequest.NO_SUCH_KEY])
+        if moved > 0:
+            self.log(logging.INFO, "Archived {0} finished requests".format(moved))
+
+
+    def _reconcile_checkouts(self):
+        # Puts checkouts counters that have drifted from the requests really
+        # holding each credential back in line.  A counter is only corrected
+        # once it's been off by the same amount two checks running, so that
+        # a checkout whose request is still being written (e.g. by the
+        # website's fast path) isn't mistaken for drift.
+        self.PROCESS_STEP = "Reconcile Checkouts"
+        self.PROCESS_COUNT = 0
+        self.PROCESS_INDEX = 0
+        self.next_reconcile = datetime.now() + timedelta(seconds=RECONCILE_INTERVAL)
+        credential_ids = [
+            slot.id for key, slots in self.allocation.keys.items() if self.leases.owns(key) for slot in slots
+        ]
+        if not credential_ids:
+            self.checkout_drift = {}
+            return
+        # Counters first, so that a checkout landing in between shows up as
+        # a holder without a count rather than the other way around
+        checkouts = dict((c['_id'], c.get('checkouts')) for c in self.db.credential.find(
+            filter={'_id': {'$in': credential_ids}}, projection={'checkouts': True}
+        ))
+        holders = Credential.count_holders(self.db, credential_ids)
+        drift = {}
+        for credential_id, observed in checkouts.items():
+            if observed is not None and observed != holders.get(credential_id, 0):
+                drift[credential_id] = (observed, holders.get(credential_id, 0))
+        for credential_id, (observed, held) in drift.items():
+            if self.checkout_drift.get(credential_id) != (observed, held):
+                continue
+            if Credential.correct_checkouts(self.db, credential_id, observed, held):
+                self.log(logging.WARNING, "CredentialId {0} was counted as checked out {1} times, but {2} requests "
+                                          "hold it; corrected".format(credential_id, observed, held))
+                self.allocation.refresh_credential(
+                    credential_id, Credential.find_one(self.db, filter={'_id': credential_id}))
+        self.checkout_drift = drift
+
+    def _release(self, cm_requests, completed=False):
+        # Hands back the credentials held by requests that we just finished,
+        # and for COMPLETED ones, adds them to the wait/usage statistics
+        cm_requests = [cm_request for cm_request in cm_requests if cm_request.credential is not None]
+        credential_increments = {}
+        key_increments = {}
+        if completed:
+            for cm_request in cm_requests:
+                CHECKOUT_USAGE.observe((cm_request.checkin_timestamp - cm_request.checkout_timestamp).total_seconds())
+                statistics_increments(cm_request, credential_increments.setdefault(cm_request.credential, {}))
+                statistics_increments(cm_request, key_increments.setdefault(cm_request.key, {}))
+        Credential.release_many(self.db, [cm_request.credential for cm_request in cm_requests], credential_increments)
+        CredentialKey.increment_many(self.db, key_increments)
+        for cm_request in cm_requests:
+            self.allocation.checkin(cm_request.credential)
+
+    def _commit_transitions(self, transitions):
+        # Writes out a phase's worth of transitions in bulk and hands back the
+        # requests that actually made it.
+        skipped = CMRequest.bulk_update(self.db, transitions)
+        committed = []
+        for cm_request, _, fields in transitions:
+            if cm_request.id in skipped:
+                self.log(logging.INFO, "Status changed by client before it could be set to {0}; skipping".format(
+                    fields['status']), cm_request)
+            else:
+                committed.append(cm_request)
+        return committed
 
 
     def _process_request_queue(self):
         # This is the meat of the big loop.  This section is the one that
         # will be doling out the credentials on a first-come, first-serve
-        # basis, with priority overriding that.
-        queued_requests = CMRequest.find(self.db, filter={'status': CMRequest.QUEUING}, sort=
-            [('priority', mongo.DESCENDING), ('submission_timestamp', mongo.ASCENDING), ('_id', mongo.ASCENDING)]
-        )
+        # basis, with priority overriding that.  Each key's waiters are
+        # kept in their own heap (see RequestQueue), and a key with nothing
+        # free is passed over without looking at any of them, so a pass
+        # costs about as much as the credentials it gives out.
         self.PROCESS_STEP = "Queued Requests"
-        self.PROCESS_COUNT = len(queued_requests)
+        self.PROCESS_COUNT = len(self.queue)
         self.PROCESS_INDEX = 0
         if self.PROCESS_COUNT > 0:
             self.log(logging.DEBUG, "Checking credentials to give out for {0} queued requests".format(
                 self.PROCESS_COUNT)
             )
-            self.log(logging.DEBUG, "Ids: {0}".format(', '.join([str(r.id) for r in queued_requests])))
-        for queued_request in queued_requests:
-            self.PROCESS_INDEX += 1
-            available_credentials = Credential.find(self.db, filter={'key': queued_request.key})
-            if len(available_credentials) > 0:
-                self.log(logging.DEBUG, "Testing {0} available credentials for queued request".format(
-                    len(available_credentials)
-                ), queued_request)
-                self.log(logging.DEBUG, "Ids: {0}".format(', '.join([str(c.id) for c in available_credentials])))
-            for available_credential in available_credentials:
-                # Only give out credentials if there are any available to give out
-                in_use_credentials = available_credential.in_use
-
-                # Also, throttle how frequently we are allowed to give out this credential
-                credential_frequency = len(CMRequest.find(self.db, filter={
-                    'credential': available_credential.id,
-                    'status': {
-                        '$in': (
-                            CMRequest.GIVEN_OUT,
-                            CMRequest.TIMED_OUT_WAITING,
-                            CMRequest.IN_USE,
-                            CMRequest.TIMED_OUT_USING,
-                            CMRequest.RETURNED,
-                            CMRequest.COMPLETED
-                        )
-                    },
-                    'checkout_timestamp': {
-                        '$gte': datetime.now() - available_credential.throttle_timespan
-                    }
-                }))
-
-                if (available_credential.max_checkouts == 0 or
-                        in_use_credentials < available_credential.max_checkouts) and \
-                        (available_credential.throttle_seconds == 0 or credential_frequency == 0):
-                    # We found a credential available to be used! Yay!
-                    queued_request.credential = available_credential.id
-                    queued_request.status = CMRequest.GIVEN_OUT
-                    queued_request.checkout_timestamp = datetime.now()
-                    self.log(logging.INFO, "Assigning CredentialId: {0} to client (waited {1:.1f}s)".format(
-                        available_credential.id,
-                        (queued_request.checkout_timestamp - queued_request.submission_timestamp).total_seconds()
-                    ), queued_request)
-                    queued_request.update(
-                        credential=available_credential.id,
-                        status=CMRequest.GIVEN_OUT,
-                        checkout_timestamp=datetime.now()
-                    )
+        now = datetime.now()
+        for key in self.queue.keys():
+            while self.allocation.find_available(key, now):
+                # Requests submitted together through the batch API are
+                # handed out together
+                group = self.queue.pop_group(key)
+                if not group:
+                    break
+                self.PROCESS_INDEX += len(group)
+                waiting = self._assign_credentials(group)
+                if waiting:
+                    # Ran out part way through; they're still first in line
+                    for cm_request in waiting:
+                        self.queue.push(cm_request)
                     break
+        QUEUE_DEPTH.replace(dict(((key,), self.queue.depth(key)) for key in self.allocation.keys))
+
+    def _assign_credentials(self, queued_requests):
+        # Gives a credential to as many of `queued_requests` (all for the
+        # same key) as there are free, and writes all of their transitions
+        # out in one go.  Returns the ones that are still waiting.
+        key = queued_requests[0].key
+        available_credentials = self.allocation.credentials(key)
+        if len(available_credentials) > 0:
+            self.log(logging.DEBUG, "Testing {0} available credentials for {1} queued request(s)".format(
+                len(available_credentials), len(queued_requests)
+            ), queued_requests[0])
+            self.log(logging.DEBUG, "Ids: {0}".format(', '.join([str(c.id) for c in available_credentials])))
+        now = datetime.now()
+        lease_seconds = self.allocation.lease_seconds.get(key) or USING_TIMEOUT
+        deadline = now + timedelta(seconds=lease_seconds)
+        assignments = []
+        for queued_request in queued_requests:
+            available_credential = self._claim_credential(key, now, queued_request)
+            if not available_credential:
+                # Nothing left for this key; the rest wait for the next pass
+                break
+            assignments.append((queued_request, available_credential))
+        waiting = queued_requests[len(assignments):]
+        if not assignments:
+            return waiting
+
+        skipped = CMRequest.bulk_update(self.db, [
+            (queued_request, CMRequest.QUEUING, {
+                'credential': available_credential.id,
+                'status': CMRequest.GIVEN_OUT,
+                'checkout_timestamp': now,
+                'deadline': deadline,
+                'lease_seconds': lease_seconds
+            })
+            for queued_request, available_credential in assignments
+        ])
+        unassigned = []
+        for queued_request, available_credential in assignments:
+            if queued_request.id in skipped:
+                self.log(logging.INFO, "No longer queuing; not assigning CredentialId {0}".format(
+                    available_credential.id), queued_request)
+                unassigned.append(available_credential.id)
+                # The throttle window keeps the checkout, which errs on the
+                # side of giving the credential a rest
+                self.allocation.checkin(available_credential.id)
+                continue
+
+            # We found a credential available to be used! Yay!
+            queued_request.credential = available_credential.id
+            queued_request.status = CMRequest.GIVEN_OUT
+            queued_request.checkout_timestamp = now
+            queued_request.deadline = deadline
+            queued_request.lease_seconds = lease_seconds
+            self.log(logging.INFO, "Assigning CredentialId: {0} to client (waited {1:.1f}s)".format(
+                available_credential.id,
+                (queued_request.checkout_timestamp - queued_request.submission_timestamp).total_seconds()
+            ), queued_request)
+            CHECKOUT_WAIT.observe((now - queued_request.submission_timestamp).total_seconds())
+        Credential.release_many(self.db, unassigned)
+        return waiting
+
+    def _claim_credential(self, key, now, queued_request):
+        while True:
+            available_credential = self.allocation.find_available(key, now)
+            if not available_credential:
+                return None
+
+            # Claim it in the database first; that's what keeps it from
+            # going over max_checkouts when other workers (or the
+            # website) are handing it out too
+            claimed = Credential.claim(self.db, available_credential.credential, now)
+            if not claimed:
+                # Filled up or given out elsewhere; see where it's really at
+                self.log(logging.DEBUG, "CredentialId {0} was given out elsewhere".format(
+                    available_credential.id), queued_request)
+                self.allocation.refresh_credential(
+                    available_credential.id, Credential.find_one(self.db, filter={'_id': available_credential.id})
+                )
+                continue
 
+            self.allocation.checkout(available_credential.id, now, claimed)
+            return available_credential
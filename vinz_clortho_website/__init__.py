@@ -1,23 +1,70 @@
 __author__ = 'Steven Ogdahl'
 
-# You must call patch_all() *before* importing any other modules
+# You must call patch_all() *before* importing any other modules.  When running
+# under gunicorn's gevent worker class (see setup/vinz-clortho-web.service) the
+# worker already does this, which is what lets long-polling requests park
+# cheaply while waiting on the ticket notifier.
 #from gevent import monkey
 #monkey.patch_all()
 
+import base64
+import binascii
+import hashlib
+import hmac
+import os
+import bson.errors
 import bson.objectid
 from datetime import datetime, timedelta
 import json
-from flask import Flask, request, make_response, g
+from flask import Flask, Response, request, make_response, g, url_for
 from flask_cors import CORS
 from flask_httpauth import HTTPBasicAuth
 from http import HTTPStatus
 from werkzeug.security import generate_password_hash, check_password_hash
+import pymongo.errors
+import threading
 import time
 
 from models import *
+from cache import TTLCache
+import metrics
 import mongo
+from vinz_clortho_website.credential_cache import CredentialCache
+from vinz_clortho_website.notifier import TicketNotifier
 
 #DEBUG = True
+# Wake long-polling status requests through a change stream on cm_request
+# (see notifier.py).  Without it they re-check every poll_interval.
+TICKET_NOTIFICATIONS = True
+# Most tickets that can be asked for, looked at or released in one batch call
+MAX_BATCH_SIZE = 100
+# Largest page /credential/request/list will hand out when asked for one
+MAX_PAGE_SIZE = 1000
+# How long (in seconds) a username/password that passed check_password_hash
+# is taken at its word without hashing it again, and how many are kept
+AUTH_CACHE_TTL = 300
+AUTH_CACHE_SIZE = 1024
+# Give credentials out straight away at submission when the key has one free
+# and nobody is queuing for it, instead of waiting on the service
+FAST_PATH = False
+# Lease for fast-path checkouts of keys without a lease_seconds of their
+# own; should match the service's USING_TIMEOUT (-u)
+DEFAULT_LEASE_SECONDS = CredentialKey.DEFAULT_LEASE_SECONDS
+# Per-process cache of credentials for the status routes (see
+# credential_cache.py); edits are picked up through a change stream on
+# the credential collection if CREDENTIAL_NOTIFICATIONS, or else by checking
+# each hit's version
+CREDENTIAL_CACHE_TTL = 60
+CREDENTIAL_CACHE_SIZE = 1024
+CREDENTIAL_NOTIFICATIONS = True
+
+REQUEST_DURATION = metrics.Histogram(
+    'vinz_clortho_web_request_duration_seconds', 'Time spent answering requests', ['endpoint', 'status'])
+LONG_POLLS = metrics.Gauge('vinz_clortho_web_long_polls', 'Status requests currently long-polling')
+LONG_POLL_DURATION = metrics.Histogram(
+    'vinz_clortho_web_long_poll_seconds', 'Time long-polling status requests spent waiting')
+FAST_PATH_CHECKOUTS = metrics.Counter(
+    'vinz_clortho_web_fast_path_checkouts_total', 'Credentials given out at submission without queuing')
 
 class JSONEncoder(json.JSONEncoder):
     def default(self, o):
@@ -33,25 +80,35 @@ app.config.from_envvar('VINZ_CLORTHO_SETTINGS', silent=True)
 # The 'origins' list should be more restrictive than "all" in a production environment
 CORS(app, origins=['*'])
 auth = HTTPBasicAuth()
+ticket_notifier = TicketNotifier()
+credential_cache = CredentialCache(
+    maxsize=app.config['CREDENTIAL_CACHE_SIZE'], ttl=app.config['CREDENTIAL_CACHE_TTL'])
+auth_cache = TTLCache(maxsize=app.config['AUTH_CACHE_SIZE'], ttl=app.config['AUTH_CACHE_TTL'])
+# Passwords are never kept, only an HMAC of them under a key that lives
+# and dies with this process
+auth_cache_key = os.urandom(32)
 
 users = {
     "vanguard": generate_password_hash("Usgh3Ntq^62j3$")
 }
 
-def connect_db():
-    return mongo.connect_db()
-
 def init_db():
     db = get_db()
     # Do any initialization stuff here
+    for problem in mongo.ensure_indexes(db):
+        app.logger.warning("Index problem: %s", problem)
 
 def get_client():
-    if not hasattr(g, 'mongo_client'):
-        g.mongo_client = connect_db()
-    return g.mongo_client
+    # Shared by every request in this worker process
+    return mongo.get_client()
 
 def get_db():
-    return get_client().vinz_clortho
+    return get_client()[mongo.MONGO_DATABASE]
+
+def get_cached_credential(db, credential_id):
+    if app.config['CREDENTIAL_NOTIFICATIONS']:
+        credential_cache.start(db)
+    return credential_cache.get(db, credential_id)
 
 def jsonify_status(status=HTTPStatus.NO_CONTENT):
     response = make_response('', status)
@@ -59,14 +116,39 @@ def jsonify_status(status=HTTPStatus.NO_CONTENT):
  
     return response
 
-@app.teardown_appcontext
-def close_db(error):
-    if hasattr(g, 'mongo_client'):
-        g.mongo_client.close()
+mongo.configure(**dict((k, v) for k, v in app.config.items() if k.startswith('MONGO_')))
+
+with app.app_context():
+    try:
+        init_db()
+    except pymongo.errors.PyMongoError as e:
+        app.logger.error("Unable to provision indexes: %s", e)
+
+@app.before_request
+def start_timer():
+    g.request_start = time.time()
+
+@app.after_request
+def record_request(response):
+    if hasattr(g, 'request_start'):
+        REQUEST_DURATION.observe(
+            time.time() - g.request_start, endpoint=request.endpoint or 'unknown', status=response.status_code)
+    return response
 
 @auth.verify_password
 def verify_password(username, password):
-    if username in users and check_password_hash(users.get(username), password):
+    password_hash = users.get(username)
+    if password_hash is None:
+        return None
+    digest = hmac.new(
+        auth_cache_key, '{0}\0{1}'.format(username, password).encode('utf-8'), hashlib.sha256
+    ).digest()
+    # Only good for as long as the user's password hash hasn't changed, so
+    # editing or removing a user takes effect straight away
+    if auth_cache.get(digest) == password_hash:
+        return username
+    if check_password_hash(password_hash, password):
+        auth_cache.set(digest, password_hash)
         return username
 
 @app.route('/credential/add', methods=['POST'])
@@ -78,7 +160,9 @@ def add_credential():
         'username': request.form['username'],
         'password': request.form['password'],
         'max_checkouts': int(request.form['max_checkouts']),
-        'throttle_seconds': int(request.form['throttle_seconds'])
+        'throttle_seconds': int(request.form['throttle_seconds']),
+        'throttle_burst': int(request.form.get('throttle_burst', 1)),
+        'checkouts': 0
     })
     return JSONEncoder().encode(result.inserted_id)
 
@@ -87,8 +171,35 @@ def add_credential():
 def get_credential(cred_id):
     db = get_db()
     id = bson.objectid.ObjectId(cred_id)
-    credential = Credential.find_one(db, filter=id)
-    return JSONEncoder().encode(credential.to_dict())
+    if request.if_none_match:
+        # Only the fields that go into the ETag
+        credential = Credential.find_one(db, filter=id, projection={
+            'key': True, 'version': True, 'checkouts': True, 'statistics.wait.count': True
+        })
+        if credential and request.if_none_match.contains_weak(_credential_etag(credential)):
+            return _not_modified(_credential_etag(credential), weak=True)
+    credential = Credential.find_one_with_counts(db, filter=id)
+    if not credential:
+        return jsonify_status(HTTPStatus.NOT_FOUND)
+    return _with_etag(JSONEncoder().encode(credential.to_dict()), _credential_etag(credential), weak=True)
+
+def _credential_etag(credential):
+    # Only what's stored on the credential (edits, checkouts and completed
+    # requests), so a conditional read never has to count anything.  The
+    # key's pending count can move without it, hence a weak ETag.
+    return '{0}-{1}-{2}-{3}'.format(
+        credential.id, credential.version, credential.checkouts, credential.wait_statistics.count
+    )
+
+def _with_etag(body, etag, weak=False):
+    response = make_response(body)
+    response.set_etag(etag, weak=weak)
+    return response.make_conditional(request)
+
+def _not_modified(etag, weak=False):
+    response = make_response('', HTTPStatus.NOT_MODIFIED)
+    response.set_etag(etag, weak=weak)
+    return response
 
 @app.route('/credential/<cred_id>', methods=['PUT'])
 @auth.login_required
@@ -105,9 +216,12 @@ def update_credential(cred_id):
         username=request.form['username'],
         password=request.form['password'],
         max_checkouts=int(request.form['max_checkouts']),
-        throttle_seconds=int(request.form['throttle_seconds'])
+        throttle_seconds=int(request.form['throttle_seconds']),
+        throttle_burst=int(request.form.get('throttle_burst', credential.throttle_burst))
     )
+    credential_cache.invalidate(credential.id)
 
+    Credential.load_counts(db, [credential])
     return JSONEncoder().encode(credential.to_dict())
 
 @app.route('/credential/<cred_id>', methods=['DELETE'])
@@ -116,8 +230,34 @@ def delete_credential(cred_id):
     db = get_db()
     id = bson.objectid.ObjectId(cred_id)
     db.credential.delete_one({ '_id': id })
+    credential_cache.invalidate(id)
     return jsonify_status()
 
+@app.route('/credential/key/<key>', methods=['GET'])
+@app.route('/credential/key/<key>/statistics', methods=['GET'])
+@auth.login_required
+def get_key(key):
+    # Its settings and statistics are the same document
+    db = get_db()
+    credential_key = CredentialKey.find_one(db, key) or CredentialKey(key)
+    return JSONEncoder().encode(credential_key.to_dict())
+
+@app.route('/credential/key/<key>', methods=['PUT'])
+@auth.login_required
+def update_key(key):
+    # lease_seconds: how long checkouts of this key last without a
+    # heartbeat (blank or 0 for the service's default)
+    db = get_db()
+    credential_key = CredentialKey.find_one(db, key) or CredentialKey(key, db=db)
+    try:
+        lease_seconds = int(request.form.get('lease_seconds') or 0)
+    except ValueError:
+        return jsonify_status(HTTPStatus.BAD_REQUEST)
+    if lease_seconds < 0:
+        return jsonify_status(HTTPStatus.BAD_REQUEST)
+    credential_key.update(lease_seconds=lease_seconds or None)
+    return JSONEncoder().encode(credential_key.to_dict())
+
 @app.route('/credential/list', methods=['GET'])
 @auth.login_required
 def list_credentials():
@@ -136,18 +276,78 @@ def list_credentials():
         else:
             s_key = (request.args['sort_by'], mongo.ASCENDING)
         sort_by.insert(0, s_key)
-    for c in db.credential.find(filter=filter, sort=sort_by):
-        c['db'] = db
-        cred = Credential(**c)
+    for cred in Credential.find_with_counts(db, filter=filter, sort=sort_by):
         credentials.append(cred.to_dict())
     return JSONEncoder().encode(credentials)
 
 
+REQUEST_LIST_SORT = [
+    ('priority', mongo.DESCENDING),
+    ('submission_timestamp', mongo.ASCENDING),
+    ('_id', mongo.ASCENDING)
+]
+
 @app.route('/credential/request/list', methods=['GET'])
 @auth.login_required
 def list_credential_requests():
+    # Streams the requests out one at a time rather than building the whole
+    # list in memory.  Filters: pending, status (comma-separated), key,
+    # since/until (ISO submission times); `fields` picks which fields come
+    # back.  With `limit` only that many are returned, and the cursor for
+    # the next page comes back in the X-Next-Cursor and Link headers.
     db = get_db()
-    requests = []
+    try:
+        filter = _request_list_filter()
+        limit = int(request.args['limit']) if 'limit' in request.args else 0
+        after = _decode_cursor(request.args['cursor']) if 'cursor' in request.args else None
+    except (ValueError, KeyError, TypeError, binascii.Error, bson.errors.InvalidId):
+        return jsonify_status(HTTPStatus.BAD_REQUEST)
+    if limit < 0 or limit > app.config['MAX_PAGE_SIZE']:
+        return jsonify_status(HTTPStatus.BAD_REQUEST)
+    if after:
+        priority, submission_timestamp, id = after
+        filter = {'$and': [filter, {'$or': [
+            {'priority': {'$lt': priority}},
+            {'priority': priority, 'submission_timestamp': {'$gt': submission_timestamp}},
+            {'priority': priority, 'submission_timestamp': submission_timestamp, '_id': {'$gt': id}}
+        ]}]}
+
+    fields = None
+    projection = None
+    if request.args.get('fields'):
+        fields = set(field for field in request.args['fields'].split(',') if field)
+        projection = dict((field, True) for field in fields if field != 'id')
+        projection.update((field, True) for field, _ in REQUEST_LIST_SORT)
+
+    cursor = db.cm_request.find(filter=filter, projection=projection, sort=REQUEST_LIST_SORT)
+    headers = {}
+    if limit:
+        # One extra to find out whether there's another page
+        page = list(cursor.limit(limit + 1))
+        if len(page) > limit:
+            page = page[:limit]
+            next_cursor = _encode_cursor(page[-1])
+            args = request.args.to_dict(flat=False)
+            args['cursor'] = next_cursor
+            headers['X-Next-Cursor'] = next_cursor
+            headers['Link'] = '<{0}>; rel="next"'.format(url_for('list_credential_requests', _external=True, **args))
+        cursor = page
+
+    def generate():
+        encoder = JSONEncoder()
+        yield '['
+        for i, c in enumerate(cursor):
+            c['db'] = db
+            cm_request = CMRequest(**c).to_dict()
+            if fields is not None:
+                cm_request = dict((k, v) for k, v in cm_request.items() if k in fields)
+            yield (',' if i else '') + encoder.encode(cm_request)
+        yield ']'
+
+    return Response(generate(), mimetype='application/json', headers=headers)
+
+
+def _request_list_filter():
     filter = {}
     if 'pending' in request.args:
         filter['status'] = {
@@ -158,16 +358,33 @@ def list_credential_requests():
                 CMRequest.GIVEN_OUT
             ]
         }
-    sort_by = [
-        ('priority', mongo.DESCENDING),
-        ('submission_timestamp', mongo.ASCENDING),
-        ('_id', mongo.ASCENDING)
-    ]
-    for c in db.cm_request.find(filter=filter, sort=sort_by):
-        c['db'] = db
-        cred = CMRequest(**c)
-        requests.append(cred.to_dict())
-    return JSONEncoder().encode(requests)
+    if request.args.get('status'):
+        statuses = [int(status) for status in request.args['status'].split(',')]
+        if 'status' in filter:
+            statuses = [status for status in statuses if status in filter['status']['$in']]
+        filter['status'] = {'$in': statuses}
+    if 'key' in request.args:
+        filter['key'] = request.args['key']
+    submitted = {}
+    if request.args.get('since'):
+        submitted['$gte'] = datetime.fromisoformat(request.args['since'])
+    if request.args.get('until'):
+        submitted['$lt'] = datetime.fromisoformat(request.args['until'])
+    if submitted:
+        filter['submission_timestamp'] = submitted
+    return filter
+
+
+def _encode_cursor(cmr):
+    # The sort key of the last request on a page
+    return base64.urlsafe_b64encode(JSONEncoder().encode(
+        [cmr.get('priority'), cmr.get('submission_timestamp'), cmr['_id']]
+    ).encode('utf-8')).decode('ascii')
+
+
+def _decode_cursor(cursor):
+    priority, submission_timestamp, id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    return priority, datetime.fromisoformat(submission_timestamp), bson.objectid.ObjectId(id)
 
 
 @app.route('/credential/request/<key>', methods=['GET'])
@@ -178,6 +395,10 @@ def credentials_request(key):
         priority = int(request.args.get('priority', 10))
     except:
         priority = 10
+    if app.config['FAST_PATH']:
+        ticket = _fast_path_request(db, key, priority)
+        if ticket:
+            return credentials_ticket_status(str(ticket))
     result = db.cm_request.insert_one({
         'key': key,
         'client': '{0} :: {1}'.format(request.remote_addr, request.url),
@@ -189,74 +410,204 @@ def credentials_request(key):
     return credentials_ticket_status(str(result.inserted_id))
 
 
+def _fast_path_request(db, key, priority):
+    # Claims a free, unthrottled credential for `key` and makes a ticket
+    # that already has it, if nobody is waiting ahead.  Returns the ticket's
+    # id, or None to go through the queue as usual.  Credential.claim()
+    # keeps this from going over max_checkouts or a throttle even with the
+    # service handing the same credentials out.
+    if db.cm_request.find_one({
+        'key': key, 'status': {'$in': [CMRequest.SUBMITTED, CMRequest.QUEUING]}
+    }, projection={'_id': True}):
+        return None
+    now = datetime.now()
+    for credential in Credential.find(db, filter={'key': key}, sort=[('checkouts', mongo.ASCENDING)]):
+        if credential.checkouts is None:
+            # Not counted yet (the service does that when it starts)
+            continue
+        if credential.max_checkouts and credential.checkouts >= credential.max_checkouts:
+            continue
+        # A checkout anywhere inside the throttle window rules it out,
+        # whatever its throttle_burst, since only the last one is known here
+        if credential.throttle_seconds > 0 and credential.last_checkout_timestamp and \
+                now - credential.last_checkout_timestamp < credential.throttle_timespan:
+            continue
+        if not Credential.claim(db, credential, now):
+            continue
+
+        credential_key = CredentialKey.find_one(db, key)
+        lease_seconds = (credential_key and credential_key.lease_seconds) or app.config['DEFAULT_LEASE_SECONDS']
+        try:
+            result = db.cm_request.insert_one({
+                'key': key,
+                'client': '{0} :: {1}'.format(request.remote_addr, request.url),
+                'submission_timestamp': now,
+                'priority': priority,
+                'status': CMRequest.GIVEN_OUT,
+                'credential': credential.id,
+                'checkout_timestamp': now,
+                'deadline': now + timedelta(seconds=lease_seconds),
+                'lease_seconds': lease_seconds
+            })
+        except pymongo.errors.PyMongoError:
+            Credential.unclaim(db, credential, now)
+            raise
+        FAST_PATH_CHECKOUTS.inc()
+        return result.inserted_id
+    return None
+
+
 @app.route('/credential/status/<ticket>', methods=['GET'])
 @auth.login_required
 def credentials_ticket_status(ticket):
+    poll, poll_interval, poll_timeout = _poll_args(request.args)
+
+    response_data = {
+        'key': '',
+        'ticket': ticket,
+        'status': 0,
+    }
+
+    db = get_db()
+    id = bson.objectid.ObjectId(ticket)
+    if request.if_none_match and not poll:
+        # Answered from the versions alone if nothing has changed
+        etag = _ticket_etag(*_ticket_versions(db, id))
+        if etag and request.if_none_match.contains(etag):
+            return _not_modified(etag)
+
+    waiter = None
+    cm_request = credential = None
+    if poll:
+        # Subscribe before the first read so that a change in between
+        # isn't missed
+        if app.config['TICKET_NOTIFICATIONS']:
+            ticket_notifier.start(db)
+        waiter = ticket_notifier.subscribe(id)
+        LONG_POLLS.inc()
+    poll_start = time.time()
+    try:
+        cm_request = CMRequest.find_one(db, filter=id) or CMRequest.find_archived(db, id)
+        if cm_request:
+            cm_request, credential = _wait_for_ticket(
+                db, id, cm_request, response_data, waiter, poll_interval, poll_timeout)
+    finally:
+        if waiter:
+            ticket_notifier.unsubscribe(id, waiter)
+            LONG_POLLS.dec()
+            LONG_POLL_DURATION.observe(time.time() - poll_start)
+
+    body = JSONEncoder().encode(response_data)
+    etag = _ticket_etag(cm_request, credential)
+    if not etag:
+        return body
+    return _with_etag(body, etag)
+
+
+def _ticket_versions(db, id):
+    # Just enough of a ticket, and of the credential it's showing, to work
+    # out its ETag
+    cm_request = CMRequest.find_one(db, filter=id, projection={'status': True, 'credential': True, 'version': True}) \
+        or CMRequest.find_archived(db, id)
+    credential = None
+    if cm_request and _shows_credential(cm_request):
+        credential = get_cached_credential(db, cm_request.credential)
+    return cm_request, credential
+
+
+def _ticket_etag(cm_request, credential):
+    if not cm_request or cm_request.status == CMRequest.GIVEN_OUT:
+        # Reading a GIVEN_OUT ticket is what moves it on to IN_USE, so
+        # those always get the full treatment
+        return None
+    if _shows_credential(cm_request):
+        if not credential:
+            return None
+        return '{0}-{1}-{2}'.format(cm_request.id, cm_request.version, credential.version)
+    return '{0}-{1}'.format(cm_request.id, cm_request.version)
+
+
+def _poll_args(args):
     poll = False
     poll_interval = 5
     poll_timeout = 60
-    if request.args.get('poll', '').lower() in ('1', 'yes', 'true', 'y'):
+    if args.get('poll', '').lower() in ('1', 'yes', 'true', 'y'):
         poll = True
         try:
-            poll_interval = int(request.args.get('poll_interval', 5))
+            poll_interval = int(args.get('poll_interval', 5))
         except:
             pass
         try:
-            poll_timeout = int(request.args.get('poll_timeout', 60))
+            poll_timeout = int(args.get('poll_timeout', 60))
         except:
             pass
+    return poll, poll_interval, poll_timeout
 
-    response_data = {
-        'key': '',
-        'ticket': ticket,
-        'status': 0,
-    }
 
-    db = get_db()
-    id = bson.objectid.ObjectId(ticket)
-    cm_request = CMRequest.find_one(db, filter=id)
+def _shows_credential(cm_request):
+    # Credentials should only be returned if the status is proper
+    return cm_request.credential and cm_request.status in (
+        CMRequest.GIVEN_OUT,
+        CMRequest.IN_USE
+    )
 
-    if cm_request:
-        start_time = datetime.now()
-        while True:
 
-            if cm_request.status == CMRequest.GIVEN_OUT:
-                cm_request.update(status=CMRequest.IN_USE)
+def _describe_ticket(response_data, cm_request, credential=None):
+    response_data['key'] = cm_request.key
+    response_data['status'] = cm_request.status
+    response_data['submitted'] = cm_request.submission_timestamp
 
-            response_data['key'] = cm_request.key
-            response_data['status'] = cm_request.status
-            response_data['submitted'] = cm_request.submission_timestamp
+    if cm_request.checkout_timestamp:
+        response_data['checkout'] = cm_request.checkout_timestamp
+    if cm_request.checkin_timestamp:
+        response_data['checkin'] = cm_request.checkin_timestamp
+    if cm_request.batch:
+        response_data['batch'] = cm_request.batch
+    if cm_request.deadline and cm_request.status in (CMRequest.GIVEN_OUT, CMRequest.IN_USE):
+        response_data['deadline'] = cm_request.deadline
 
-            if cm_request.checkout_timestamp:
-                response_data['checkout'] = cm_request.checkout_timestamp
-            if cm_request.checkin_timestamp:
-                response_data['checkin'] = cm_request.checkin_timestamp
+    if credential and _shows_credential(cm_request):
+        response_data['username'] = credential.username
+        response_data['password'] = credential.password
 
-            # Credentials should only be returned if the status is proper
-            if cm_request.credential and cm_request.status in (
-                    CMRequest.GIVEN_OUT,
-                    CMRequest.IN_USE
-                ):
-                credential = Credential.find_one(db, filter={'_id': cm_request.credential})
-                response_data['username'] = credential.username
-                response_data['password'] = credential.password
 
-            if datetime.now() - start_time > timedelta(seconds=poll_timeout):
-                break
+def _wait_for_ticket(db, id, cm_request, response_data, waiter, poll_interval, poll_timeout):
+    # Fills in response_data and hands back the ticket and credential it
+    # was filled in from
+    start_time = datetime.now()
+    while True:
+
+        if cm_request.status == CMRequest.GIVEN_OUT and \
+                not cm_request.transition(CMRequest.GIVEN_OUT, status=CMRequest.IN_USE):
+            # Timed out or released in the meantime; go by what it is now
+            cm_request = CMRequest.find_one(db, filter=id) or cm_request
 
-            elif poll and cm_request.status in (
-                    CMRequest.SUBMITTED,
-                    CMRequest.QUEUING
-                ):
-                time.sleep(poll_interval)
-                cm_request = CMRequest.find_one(db, filter=id)
-                if not cm_request:
-                    break
+        credential = None
+        if _shows_credential(cm_request):
+            credential = get_cached_credential(db, cm_request.credential)
+        _describe_ticket(response_data, cm_request, credential)
+        result = cm_request, credential
 
-            else:
+        if datetime.now() - start_time >= timedelta(seconds=poll_timeout):
+            break
+
+        elif waiter and cm_request.status in (
+                CMRequest.SUBMITTED,
+                CMRequest.QUEUING
+            ):
+            # Woken up as soon as the ticket changes; poll_interval is
+            # only how long to go without re-checking if no
+            # notification arrives
+            remaining = poll_timeout - (datetime.now() - start_time).total_seconds()
+            waiter.wait(max(0, min(poll_interval, remaining)))
+            waiter.clear()
+            cm_request = CMRequest.find_one(db, filter=id)
+            if not cm_request:
                 break
 
-    return JSONEncoder().encode(response_data)
+        else:
+            break
+    return result
 
 
 @app.route('/credential/release/<ticket>', methods=['GET'])
@@ -264,25 +615,235 @@ def credentials_ticket_status(ticket):
 def credentials_release(ticket):
     db = get_db()
     id = bson.objectid.ObjectId(ticket)
-    cm_req = db.cm_request.find_one(filter=id)
+    cm_request = CMRequest.find_one(db, filter=id)
 
-    if cm_req:
-        cm_request = CMRequest(db=db, **cm_req)
+    # Only moved on from the status it was just read in, so that a request
+    # the service gives a credential to (or times out) in between is looked
+    # at again rather than cancelled with the credential still on it
+    while cm_request:
+        status = _release_status(cm_request.status)
+        if status is None or cm_request.transition(cm_request.status, status=status):
+            break
+        cm_request = CMRequest.find_one(db, filter=id)
+
+    return credentials_ticket_status(ticket)
 
-        if cm_request.status in (
-            CMRequest.IN_USE,
-            CMRequest.GIVEN_OUT
-        ):
-            cm_request.update(status=CMRequest.RETURNED)
 
-        elif cm_request.status in (
-            CMRequest.QUEUING,
-            CMRequest.SUBMITTED
-        ):
-            cm_request.update(status=CMRequest.CANCEL)
+def _release_status(status):
+    # What releasing a request in `status` moves it on to (None if it's
+    # past that)
+    if status in (
+        CMRequest.IN_USE,
+        CMRequest.GIVEN_OUT
+    ):
+        return CMRequest.RETURNED
+    elif status in (
+        CMRequest.QUEUING,
+        CMRequest.SUBMITTED
+    ):
+        return CMRequest.CANCEL
+    return None
+
+
+@app.route('/credential/heartbeat/<ticket>', methods=['GET', 'POST'])
+@auth.login_required
+def credentials_heartbeat(ticket):
+    # Lets a client that's still using its credential push its deadline
+    # out, by `seconds` or (at most, and by default) the lease it was given
+    db = get_db()
+    id = bson.objectid.ObjectId(ticket)
+    cm_request = CMRequest.find_one(db, filter=id)
+    if cm_request and cm_request.status == CMRequest.IN_USE and cm_request.lease_seconds:
+        try:
+            seconds = int(request.values.get('seconds', cm_request.lease_seconds))
+        except ValueError:
+            return jsonify_status(HTTPStatus.BAD_REQUEST)
+        deadline = datetime.now() + timedelta(seconds=max(0, min(seconds, cm_request.lease_seconds)))
+        if not cm_request.deadline or deadline > cm_request.deadline:
+            cm_request.transition(CMRequest.IN_USE, deadline=deadline)
 
     return credentials_ticket_status(ticket)
 
+def _batch_ticket_ids(values):
+    # Tickets come as repeated and/or comma-separated `ticket` parameters,
+    # in the query string or a form body
+    ids = []
+    for value in values:
+        ids.extend(bson.objectid.ObjectId(ticket) for ticket in value.split(',') if ticket)
+    if not ids or len(ids) > app.config['MAX_BATCH_SIZE']:
+        raise ValueError("Between 1 and {0} tickets are needed".format(app.config['MAX_BATCH_SIZE']))
+    return ids
+
+
+@app.route('/credential/batch/request/<key>', methods=['GET'])
+@auth.login_required
+def credentials_batch_request(key):
+    # Submits `count` requests for the same key at once.  The service hands
+    # them out together as far as the key's capacity allows.
+    try:
+        count = int(request.args.get('count', 1))
+    except ValueError:
+        return jsonify_status(HTTPStatus.BAD_REQUEST)
+    if count < 1 or count > app.config['MAX_BATCH_SIZE']:
+        return jsonify_status(HTTPStatus.BAD_REQUEST)
+    try:
+        priority = int(request.args.get('priority', 10))
+    except:
+        priority = 10
+    db = get_db()
+    submission_timestamp = datetime.now()
+    batch = bson.objectid.ObjectId()
+    result = db.cm_request.insert_many([{
+        'key': key,
+        'client': '{0} :: {1}'.format(request.remote_addr, request.url),
+        'submission_timestamp': submission_timestamp,
+        'priority': priority,
+        'status': CMRequest.SUBMITTED,
+        'batch': batch
+    } for _ in range(count)])
+
+    return _batch_ticket_status(db, result.inserted_ids)
+
+
+@app.route('/credential/batch/status', methods=['GET', 'POST'])
+@auth.login_required
+def credentials_batch_status():
+    try:
+        ids = _batch_ticket_ids(request.values.getlist('ticket'))
+    except (bson.errors.InvalidId, ValueError):
+        return jsonify_status(HTTPStatus.BAD_REQUEST)
+    return _batch_ticket_status(get_db(), ids)
+
+
+@app.route('/credential/batch/release', methods=['GET', 'POST'])
+@auth.login_required
+def credentials_batch_release():
+    try:
+        ids = _batch_ticket_ids(request.values.getlist('ticket'))
+    except (bson.errors.InvalidId, ValueError):
+        return jsonify_status(HTTPStatus.BAD_REQUEST)
+    db = get_db()
+    pending = ids
+    while pending:
+        pending = _release_batch(db, pending)
+    return _batch_ticket_status(db, ids)
+
+
+def _release_batch(db, ids):
+    # One pass of credentials_release() over `ids`: each request is only
+    # moved on from the status it was read in.  Returns the ones that
+    # changed in between (e.g. were given a credential) to go round again.
+    retry = []
+    groups = _release_groups(db.cm_request.find(filter={'_id': {'$in': ids}}, projection={'status': True}))
+    for status, group in groups.items():
+        result = db.cm_request.update_many(
+            {'_id': {'$in': group}, 'status': status},
+            {'$set': {'status': _release_status(status)}, '$inc': {'version': 1}}
+        )
+        if result.matched_count < len(group):
+            retry.extend(group)
+    return retry
+
+
+def _release_groups(cmrs):
+    # The ids of the cm_request documents that releasing would move on,
+    # by the status they're in
+    groups = {}
+    for cmr in cmrs:
+        if _release_status(cmr['status']) is not None:
+            groups.setdefault(cmr['status'], []).append(cmr['_id'])
+    return groups
+
+
+def _batch_ticket_status(db, ids):
+    # Same as credentials_ticket_status() for a list of tickets, answered in
+    # the order they were given.  A long-poll returns once none of them are
+    # still waiting for a credential.
+    poll, poll_interval, poll_timeout = _poll_args(request.args)
+    waiter = None
+    if poll:
+        if app.config['TICKET_NOTIFICATIONS']:
+            ticket_notifier.start(db)
+        waiter = threading.Event()
+        for id in ids:
+            ticket_notifier.subscribe(id, waiter)
+        LONG_POLLS.inc()
+    poll_start = time.time()
+    try:
+        start_time = datetime.now()
+        while True:
+            cm_requests = _load_tickets(db, ids)
+            waiting = any(cm_request.status in (CMRequest.SUBMITTED, CMRequest.QUEUING)
+                          for cm_request in cm_requests.values())
+            remaining = poll_timeout - (datetime.now() - start_time).total_seconds()
+            if not waiter or not waiting or remaining <= 0:
+                break
+            waiter.wait(max(0, min(poll_interval, remaining)))
+            waiter.clear()
+    finally:
+        if waiter:
+            for id in ids:
+                ticket_notifier.unsubscribe(id, waiter)
+            LONG_POLLS.dec()
+            LONG_POLL_DURATION.observe(time.time() - poll_start)
+
+    given_out = [cm_request.id for cm_request in cm_requests.values() if cm_request.status == CMRequest.GIVEN_OUT]
+    if given_out:
+        in_use = set(cm_request.id for cm_request in CMRequest.update_many(
+            db, {'_id': {'$in': given_out}, 'status': CMRequest.GIVEN_OUT}, status=CMRequest.IN_USE
+        ))
+        for id in in_use:
+            cm_requests[id].status = CMRequest.IN_USE
+            cm_requests[id].version += 1
+        # The rest timed out or were released in the meantime; go by what
+        # they are now
+        changed = [id for id in given_out if id not in in_use]
+        if changed:
+            cm_requests.update(_load_tickets(db, changed))
+    credential_ids = list(set(
+        cm_request.credential for cm_request in cm_requests.values() if _shows_credential(cm_request)
+    ))
+    if app.config['CREDENTIAL_NOTIFICATIONS']:
+        credential_cache.start(db)
+    credentials = credential_cache.get_many(db, credential_ids)
+
+    response = []
+    for id in ids:
+        response_data = {
+            'key': '',
+            'ticket': str(id),
+            'status': 0,
+        }
+        cm_request = cm_requests.get(id)
+        if cm_request:
+            _describe_ticket(response_data, cm_request, credentials.get(cm_request.credential))
+        response.append(response_data)
+    return JSONEncoder().encode(response)
+
+
+def _load_tickets(db, ids):
+    cm_requests = dict((cm_request.id, cm_request) for cm_request in CMRequest.find(db, filter={'_id': {'$in': ids}}))
+    missing = [id for id in ids if id not in cm_requests]
+    if missing:
+        cm_requests.update((cm_request.id, cm_request) for cm_request in CMRequest.find_archived_many(db, missing))
+    return cm_requests
+
+
+@app.route('/metrics', methods=['GET'])
+@auth.login_required
+def get_metrics():
+    # Only this worker process's numbers
+    response = make_response(metrics.REGISTRY.render())
+    response.headers['Content-Type'] = metrics.CONTENT_TYPE
+    return response
+
+
+@app.route('/health', methods=['GET'])
+def health():
+    if mongo.is_healthy(get_client()):
+        return jsonify_status()
+    return jsonify_status(HTTPStatus.SERVICE_UNAVAILABLE)
+
 
 @app.route('/')
 def hello_world():
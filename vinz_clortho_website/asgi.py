@@ -0,0 +1,527 @@
+__author__ = 'Steven Ogdahl'
+
+# Async serving mode for the website (run asgi:app under uvicorn; see
+# setup/vinz-clortho-asgi.service).  The routes scrapers hit all the time
+# (submitting, polling, heartbeating and releasing tickets) are served
+# here on the event loop through motor, so one process can hold thousands
+# of status requests and long-polls open at once.  Everything else
+# (credential admin, listings, metrics) falls through to the Flask app,
+# run in a thread pool.  Settings, users and URLs are all shared with it.
+
+import asyncio
+import base64
+import binascii
+import time
+from datetime import datetime, timedelta
+from http import HTTPStatus
+from urllib.parse import parse_qsl
+
+import bson.errors
+import bson.objectid
+import pymongo.errors
+from a2wsgi import WSGIMiddleware
+from pymongo import ReturnDocument
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response
+from starlette.routing import Mount, Route
+from werkzeug.http import parse_etags, quote_etag
+
+import mongo
+from models import Credential, CredentialKey, CMRequest
+from vinz_clortho_website import (
+    app as flask_app, JSONEncoder, verify_password, credential_cache,
+    REQUEST_DURATION, LONG_POLLS, LONG_POLL_DURATION, FAST_PATH_CHECKOUTS,
+    _poll_args, _shows_credential, _describe_ticket, _ticket_etag, _batch_ticket_ids,
+    _release_status, _release_groups
+)
+from vinz_clortho_website.notifier import AsyncTicketNotifier
+
+ticket_notifier = AsyncTicketNotifier()
+
+
+def get_db():
+    return mongo.get_async_db()
+
+
+def text_response(body, status=HTTPStatus.OK, headers=None):
+    # Same content type the Flask routes answer with
+    return Response(body, status_code=status, headers=headers, media_type='text/html')
+
+
+def jsonify_status(status=HTTPStatus.NO_CONTENT):
+    return Response(b'', status_code=status, media_type='application/json')
+
+
+def endpoint(login_required=True):
+    # Times the route like the Flask app's request hooks do and, unless
+    # told otherwise, wants the same HTTP Basic login as its routes
+    def decorator(route):
+        async def wrapper(request):
+            start = time.time()
+            if login_required and not await _authenticated(request):
+                response = text_response('Unauthorized Access', HTTPStatus.UNAUTHORIZED, {
+                    'WWW-Authenticate': 'Basic realm="Authentication Required"'
+                })
+            else:
+                try:
+                    response = await route(request)
+                except (bson.errors.InvalidId, ValueError):
+                    response = jsonify_status(HTTPStatus.BAD_REQUEST)
+            REQUEST_DURATION.observe(time.time() - start, endpoint=route.__name__, status=response.status_code)
+            return response
+        wrapper.__name__ = route.__name__
+        return wrapper
+    return decorator
+
+
+async def _authenticated(request):
+    authorization = request.headers.get('authorization', '')
+    if authorization[:6].lower() != 'basic ':
+        return False
+    try:
+        username, _, password = base64.b64decode(authorization[6:]).decode('utf-8').partition(':')
+    except (ValueError, binascii.Error):
+        return False
+    # Checking a password hash takes long enough that it shouldn't hold
+    # up the event loop (cached ones come straight back)
+    return bool(await run_in_threadpool(verify_password, username, password))
+
+
+async def _values(request):
+    # Query string and form parameters together, like Flask's request.values
+    # (only urlencoded bodies, which is what the clients send)
+    values = list(request.query_params.multi_items())
+    if request.method == 'POST' and \
+            request.headers.get('content-type', '').startswith('application/x-www-form-urlencoded'):
+        values.extend(parse_qsl((await request.body()).decode('utf-8'), keep_blank_values=True))
+    return values
+
+
+def _client(request):
+    return '{0} :: {1}'.format(request.client.host if request.client else '', request.url)
+
+
+def _with_etag(body, etag, if_none_match):
+    if not etag:
+        return text_response(body)
+    if if_none_match and if_none_match.contains(etag):
+        return _not_modified(etag)
+    return text_response(body, headers={'ETag': quote_etag(etag)})
+
+
+def _not_modified(etag):
+    return Response(status_code=HTTPStatus.NOT_MODIFIED, headers={'ETag': quote_etag(etag)})
+
+
+async def _find_ticket(db, id, projection=None, archived=True):
+    cmr = await db.cm_request.find_one({'_id': id}, projection)
+    if not cmr and archived:
+        cmr = await db.cm_request_history.find_one({'_id': id})
+        if cmr:
+            cmr.pop('archived_timestamp', None)
+    if cmr:
+        cmr = CMRequest(**cmr)
+    return cmr
+
+
+async def _find_tickets(db, ids):
+    cm_requests = {}
+    async for cmr in db.cm_request.find({'_id': {'$in': ids}}):
+        cm_requests[cmr['_id']] = CMRequest(**cmr)
+    missing = [id for id in ids if id not in cm_requests]
+    if missing:
+        async for cmr in db.cm_request_history.find({'_id': {'$in': missing}}):
+            cmr.pop('archived_timestamp', None)
+            cm_requests[cmr['_id']] = CMRequest(**cmr)
+    return cm_requests
+
+
+async def _get_credentials(db, credential_ids):
+    # Through the same cache as the Flask app (which also keeps it in line
+    # with edits)
+    if flask_app.config['CREDENTIAL_NOTIFICATIONS']:
+        await run_in_threadpool(credential_cache.start, mongo.get_db())
+    credentials = {}
+    missing = []
+    for credential_id in credential_ids:
+        credential = credential_cache.lookup(credential_id)
+        if credential is None:
+            missing.append(credential_id)
+        else:
+            credentials[credential_id] = credential
+    if credentials and not credential_cache.watching:
+        current = [c async for c in db.credential.find(
+            {'_id': {'$in': list(credentials)}}, projection={'version': True})]
+        for credential_id in credential_cache.stale(credentials, current):
+            del credentials[credential_id]
+            missing.append(credential_id)
+    if missing:
+        generation = credential_cache.generation
+        async for c in db.credential.find({'_id': {'$in': missing}}):
+            credential = Credential(**c)
+            credentials[credential.id] = credential
+            credential_cache.store(credential, generation)
+    return credentials
+
+
+async def _get_credential(db, credential_id):
+    return (await _get_credentials(db, [credential_id])).get(credential_id)
+
+
+@endpoint()
+async def credentials_request(request):
+    key = request.path_params['key']
+    db = get_db()
+    try:
+        priority = int(request.query_params.get('priority', 10))
+    except:
+        priority = 10
+    if flask_app.config['FAST_PATH']:
+        ticket = await _fast_path_request(request, db, key, priority)
+        if ticket:
+            return await _ticket_status(request, db, str(ticket))
+    result = await db.cm_request.insert_one({
+        'key': key,
+        'client': _client(request),
+        'submission_timestamp': datetime.now(),
+        'priority': priority,
+        'status': CMRequest.SUBMITTED
+    })
+
+    return await _ticket_status(request, db, str(result.inserted_id))
+
+
+async def _fast_path_request(request, db, key, priority):
+    # See the Flask app's _fast_path_request()
+    if await db.cm_request.find_one({
+        'key': key, 'status': {'$in': [CMRequest.SUBMITTED, CMRequest.QUEUING]}
+    }, {'_id': True}):
+        return None
+    now = datetime.now()
+    async for c in db.credential.find({'key': key}, sort=[('checkouts', mongo.ASCENDING)]):
+        credential = Credential(**c)
+        if credential.checkouts is None:
+            continue
+        if credential.max_checkouts and credential.checkouts >= credential.max_checkouts:
+            continue
+        if credential.throttle_seconds > 0 and credential.last_checkout_timestamp and \
+                now - credential.last_checkout_timestamp < credential.throttle_timespan:
+            continue
+        filter, update = Credential.claim_query(credential, now)
+        if not await db.credential.find_one_and_update(filter, update, return_document=ReturnDocument.AFTER):
+            continue
+
+        credential_key = await db.credential_key.find_one({'_id': key})
+        lease_seconds = (credential_key and CredentialKey(**credential_key).lease_seconds) or \
+            flask_app.config['DEFAULT_LEASE_SECONDS']
+        try:
+            result = await db.cm_request.insert_one({
+                'key': key,
+                'client': _client(request),
+                'submission_timestamp': now,
+                'priority': priority,
+                'status': CMRequest.GIVEN_OUT,
+                'credential': credential.id,
+                'checkout_timestamp': now,
+                'deadline': now + timedelta(seconds=lease_seconds),
+                'lease_seconds': lease_seconds
+            })
+        except pymongo.errors.PyMongoError:
+            for filter, update in Credential.unclaim_queries(credential, now):
+                await db.credential.update_one(filter, update)
+            raise
+        FAST_PATH_CHECKOUTS.inc()
+        return result.inserted_id
+    return None
+
+
+@endpoint()
+async def credentials_ticket_status(request):
+    return await _ticket_status(request, get_db(), request.path_params['ticket'])
+
+
+async def _ticket_status(request, db, ticket):
+    poll, poll_interval, poll_timeout = _poll_args(request.query_params)
+
+    response_data = {
+        'key': '',
+        'ticket': ticket,
+        'status': 0,
+    }
+
+    id = bson.objectid.ObjectId(ticket)
+    if_none_match = parse_etags(request.headers.get('if-none-match'))
+    if if_none_match and not poll:
+        cm_request = await _find_ticket(db, id, projection={'status': True, 'credential': True, 'version': True})
+        credential = None
+        if cm_request and _shows_credential(cm_request):
+            credential = await _get_credential(db, cm_request.credential)
+        etag = _ticket_etag(cm_request, credential)
+        if etag and if_none_match.contains(etag):
+            return _not_modified(etag)
+
+    waiter = None
+    cm_request = credential = None
+    if poll:
+        # Subscribe before the first read so that a change in between
+        # isn't missed
+        if flask_app.config['TICKET_NOTIFICATIONS']:
+            ticket_notifier.start(db)
+        waiter = ticket_notifier.subscribe(id)
+        LONG_POLLS.inc()
+    poll_start = time.time()
+    try:
+        cm_request = await _find_ticket(db, id)
+        if cm_request:
+            cm_request, credential = await _wait_for_ticket(
+                db, id, cm_request, response_data, waiter, poll_interval, poll_timeout)
+    finally:
+        if waiter:
+            ticket_notifier.unsubscribe(id, waiter)
+            LONG_POLLS.dec()
+            LONG_POLL_DURATION.observe(time.time() - poll_start)
+
+    return _with_etag(JSONEncoder().encode(response_data), _ticket_etag(cm_request, credential), if_none_match)
+
+
+async def _wait_for_ticket(db, id, cm_request, response_data, waiter, poll_interval, poll_timeout):
+    start_time = datetime.now()
+    while True:
+
+        if cm_request.status == CMRequest.GIVEN_OUT:
+            result = await db.cm_request.update_one(
+                {'_id': cm_request.id, 'status': CMRequest.GIVEN_OUT},
+                {'$set': {'status': CMRequest.IN_USE}, '$inc': {'version': 1}}
+            )
+            if result.matched_count:
+                cm_request.status = CMRequest.IN_USE
+                cm_request.version += 1
+            else:
+                # Timed out or released in the meantime; go by what it is now
+                cm_request = await _find_ticket(db, id, archived=False) or cm_request
+
+        credential = None
+        if _shows_credential(cm_request):
+            credential = await _get_credential(db, cm_request.credential)
+        _describe_ticket(response_data, cm_request, credential)
+        result = cm_request, credential
+
+        if datetime.now() - start_time >= timedelta(seconds=poll_timeout):
+            break
+
+        elif waiter and cm_request.status in (
+                CMRequest.SUBMITTED,
+                CMRequest.QUEUING
+            ):
+            remaining = poll_timeout - (datetime.now() - start_time).total_seconds()
+            await _wait(waiter, max(0, min(poll_interval, remaining)))
+            cm_request = await _find_ticket(db, id, archived=False)
+            if not cm_request:
+                break
+
+        else:
+            break
+    return result
+
+
+async def _wait(waiter, timeout):
+    try:
+        await asyncio.wait_for(waiter.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    waiter.clear()
+
+
+@endpoint()
+async def credentials_release(request):
+    db = get_db()
+    ticket = request.path_params['ticket']
+    id = bson.objectid.ObjectId(ticket)
+    cm_request = await _find_ticket(db, id, archived=False)
+
+    # See the Flask app's credentials_release()
+    while cm_request:
+        status = _release_status(cm_request.status)
+        if status is None:
+            break
+        result = await db.cm_request.update_one(
+            {'_id': id, 'status': cm_request.status}, {'$set': {'status': status}, '$inc': {'version': 1}})
+        if result.matched_count:
+            break
+        cm_request = await _find_ticket(db, id, archived=False)
+
+    return await _ticket_status(request, db, ticket)
+
+
+@endpoint()
+async def credentials_heartbeat(request):
+    # See the Flask app's credentials_heartbeat()
+    db = get_db()
+    ticket = request.path_params['ticket']
+    id = bson.objectid.ObjectId(ticket)
+    cm_request = await _find_ticket(db, id, archived=False)
+    if cm_request and cm_request.status == CMRequest.IN_USE and cm_request.lease_seconds:
+        try:
+            seconds = int(dict(await _values(request)).get('seconds', cm_request.lease_seconds))
+        except ValueError:
+            return jsonify_status(HTTPStatus.BAD_REQUEST)
+        deadline = datetime.now() + timedelta(seconds=max(0, min(seconds, cm_request.lease_seconds)))
+        if not cm_request.deadline or deadline > cm_request.deadline:
+            await db.cm_request.update_one(
+                {'_id': id, 'status': CMRequest.IN_USE},
+                {'$set': {'deadline': deadline}, '$inc': {'version': 1}}
+            )
+
+    return await _ticket_status(request, db, ticket)
+
+
+@endpoint()
+async def credentials_batch_request(request):
+    key = request.path_params['key']
+    count = int(request.query_params.get('count', 1))
+    if count < 1 or count > flask_app.config['MAX_BATCH_SIZE']:
+        return jsonify_status(HTTPStatus.BAD_REQUEST)
+    try:
+        priority = int(request.query_params.get('priority', 10))
+    except:
+        priority = 10
+    db = get_db()
+    submission_timestamp = datetime.now()
+    batch = bson.objectid.ObjectId()
+    result = await db.cm_request.insert_many([{
+        'key': key,
+        'client': _client(request),
+        'submission_timestamp': submission_timestamp,
+        'priority': priority,
+        'status': CMRequest.SUBMITTED,
+        'batch': batch
+    } for _ in range(count)])
+
+    return await _batch_ticket_status(request, db, result.inserted_ids)
+
+
+@endpoint()
+async def credentials_batch_status(request):
+    ids = _batch_ticket_ids([value for name, value in await _values(request) if name == 'ticket'])
+    return await _batch_ticket_status(request, get_db(), ids)
+
+
+@endpoint()
+async def credentials_batch_release(request):
+    ids = _batch_ticket_ids([value for name, value in await _values(request) if name == 'ticket'])
+    db = get_db()
+    pending = ids
+    while pending:
+        pending = await _release_batch(db, pending)
+    return await _batch_ticket_status(request, db, ids)
+
+
+async def _release_batch(db, ids):
+    # See the Flask app's _release_batch()
+    retry = []
+    groups = _release_groups([
+        cmr async for cmr in db.cm_request.find({'_id': {'$in': ids}}, projection={'status': True})
+    ])
+    for status, group in groups.items():
+        result = await db.cm_request.update_many(
+            {'_id': {'$in': group}, 'status': status},
+            {'$set': {'status': _release_status(status)}, '$inc': {'version': 1}}
+        )
+        if result.matched_count < len(group):
+            retry.extend(group)
+    return retry
+
+
+async def _batch_ticket_status(request, db, ids):
+    # See the Flask app's _batch_ticket_status()
+    poll, poll_interval, poll_timeout = _poll_args(request.query_params)
+    waiter = None
+    if poll:
+        if flask_app.config['TICKET_NOTIFICATIONS']:
+            ticket_notifier.start(db)
+        waiter = asyncio.Event()
+        for id in ids:
+            ticket_notifier.subscribe(id, waiter)
+        LONG_POLLS.inc()
+    poll_start = time.time()
+    try:
+        start_time = datetime.now()
+        while True:
+            cm_requests = await _find_tickets(db, ids)
+            waiting = any(cm_request.status in (CMRequest.SUBMITTED, CMRequest.QUEUING)
+                          for cm_request in cm_requests.values())
+            remaining = poll_timeout - (datetime.now() - start_time).total_seconds()
+            if not waiter or not waiting or remaining <= 0:
+                break
+            await _wait(waiter, max(0, min(poll_interval, remaining)))
+    finally:
+        if waiter:
+            for id in ids:
+                ticket_notifier.unsubscribe(id, waiter)
+            LONG_POLLS.dec()
+            LONG_POLL_DURATION.observe(time.time() - poll_start)
+
+    given_out = [cm_request.id for cm_request in cm_requests.values() if cm_request.status == CMRequest.GIVEN_OUT]
+    if given_out:
+        result = await db.cm_request.update_many(
+            {'_id': {'$in': given_out}, 'status': CMRequest.GIVEN_OUT},
+            {'$set': {'status': CMRequest.IN_USE}, '$inc': {'version': 1}}
+        )
+        if result.matched_count == len(given_out):
+            for id in given_out:
+                cm_requests[id].status = CMRequest.IN_USE
+                cm_requests[id].version += 1
+        else:
+            # Some timed out or were released in the meantime; go by what
+            # they all are now
+            cm_requests.update(await _find_tickets(db, given_out))
+    credentials = await _get_credentials(db, list(set(
+        cm_request.credential for cm_request in cm_requests.values() if _shows_credential(cm_request)
+    )))
+
+    response = []
+    for id in ids:
+        response_data = {
+            'key': '',
+            'ticket': str(id),
+            'status': 0,
+        }
+        cm_request = cm_requests.get(id)
+        if cm_request:
+            _describe_ticket(response_data, cm_request, credentials.get(cm_request.credential))
+        response.append(response_data)
+    return text_response(JSONEncoder().encode(response))
+
+
+@endpoint(login_required=False)
+async def health(request):
+    try:
+        await mongo.get_async_client().admin.command('ping')
+        return jsonify_status()
+    except pymongo.errors.PyMongoError:
+        return jsonify_status(HTTPStatus.SERVICE_UNAVAILABLE)
+
+
+flask_wsgi = WSGIMiddleware(flask_app)
+
+app = Starlette(routes=[
+    # Flask gives this one precedence over /credential/request/<key>
+    Route('/credential/request/list', flask_wsgi),
+    Route('/credential/request/{key}', credentials_request, methods=['GET']),
+    Route('/credential/status/{ticket}', credentials_ticket_status, methods=['GET']),
+    Route('/credential/release/{ticket}', credentials_release, methods=['GET']),
+    Route('/credential/heartbeat/{ticket}', credentials_heartbeat, methods=['GET', 'POST']),
+    Route('/credential/batch/request/{key}', credentials_batch_request, methods=['GET']),
+    Route('/credential/batch/status', credentials_batch_status, methods=['GET', 'POST']),
+    Route('/credential/batch/release', credentials_batch_release, methods=['GET', 'POST']),
+    Route('/health', health, methods=['GET']),
+    # Everything else is the Flask app's
+    Mount('', flask_wsgi),
+], middleware=[
+    # Same as the Flask app's CORS(); its headers on the mounted routes are
+    # overwritten rather than doubled, and preflights are answered here
+    Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*']),
+])
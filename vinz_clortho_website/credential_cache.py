@@ -0,0 +1,112 @@
+__author__ = 'Steven Ogdahl'
+
+import os
+import threading
+
+from cache import TTLCache
+from models import Credential
+from watcher import ChangeWatcher
+
+
+class CredentialCache(object):
+    # Read-through cache of credential documents, so that status requests
+    # (and every round of a long-poll) don't have to go back to the
+    # credential collection for the username and password.  Only a
+    # credential's definition is worth reading from here: its checkouts and
+    # statistics are as of whenever it was cached.
+    #
+    # Edits through update() bump a credential's version, and a change
+    # stream on the collection drops the entry for anything edited or
+    # deleted, in every process.  While no change stream is open (a
+    # standalone mongod, the embedded backend, or notifications turned off)
+    # every hit is checked against the credential's stored version instead,
+    # so an edit made through another process is never served stale.
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        self._watcher = None
+        self._pid = None
+        # Bumped on every invalidation, so that a read that was already
+        # under way when a credential changed doesn't get cached
+        self._generation = 0
+
+    @property
+    def watching(self):
+        return self._watcher is not None and self._watcher.watching
+
+    def start(self, db):
+        # Watchers don't survive a fork, so (re)start one per process
+        with self._lock:
+            if self._pid == os.getpid() and self._watcher is not None:
+                return
+            self._pid = os.getpid()
+            self._cache.clear()
+            self._watcher = ChangeWatcher(db.credential, self._on_change, pipeline=[
+                {'$match': {'$or': [
+                    {'operationType': {'$in': ['replace', 'delete']}},
+                    {'operationType': 'update', 'updateDescription.updatedFields.version': {'$exists': True}}
+                ]}}
+            ], name='credential-cache')
+            self._watcher.start()
+
+    def get(self, db, credential_id):
+        return self.get_many(db, [credential_id]).get(credential_id)
+
+    def get_many(self, db, credential_ids):
+        # Returns {id: Credential} for the ones that exist
+        credentials = {}
+        missing = []
+        for credential_id in credential_ids:
+            credential = self.lookup(credential_id)
+            if credential is None:
+                missing.append(credential_id)
+            else:
+                credentials[credential_id] = credential
+        if credentials and not self.watching:
+            for credential_id in self.stale(credentials, db.credential.find(
+                filter={'_id': {'$in': list(credentials)}}, projection={'version': True}
+            )):
+                del credentials[credential_id]
+                missing.append(credential_id)
+        if missing:
+            generation = self.generation
+            for credential in Credential.find(db, filter={'_id': {'$in': missing}}):
+                credentials[credential.id] = credential
+                self.store(credential, generation)
+        return credentials
+
+    # lookup(), stale(), generation and store() are the pieces of get() for
+    # callers that read the database some other way (e.g. through motor)
+
+    def lookup(self, credential_id):
+        return self._cache.get(credential_id)
+
+    def stale(self, credentials, current):
+        # Drops the cached `credentials` ({id: Credential}) whose `current`
+        # documents (_id and version) show them edited or deleted since, and
+        # returns their ids
+        versions = dict((c['_id'], c.get('version', 0)) for c in current)
+        stale = [credential_id for credential_id, credential in credentials.items()
+                 if versions.get(credential_id) != credential.version]
+        for credential_id in stale:
+            self._cache.pop(credential_id)
+        return stale
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def store(self, credential, generation):
+        # Caches `credential`, read after `generation` was taken, unless
+        # something has been invalidated since
+        if credential is not None and generation == self._generation:
+            self._cache.set(credential.id, credential)
+
+    def invalidate(self, credential_id):
+        with self._lock:
+            self._generation += 1
+        self._cache.pop(credential_id)
+
+    def _on_change(self, change):
+        self.invalidate(change['documentKey']['_id'])
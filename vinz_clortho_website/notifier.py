@@ -0,0 +1,122 @@
+__author__ = 'Steven Ogdahl'
+
+import asyncio
+import logging
+import os
+import threading
+
+import pymongo.errors
+
+from watcher import ChangeWatcher, RETRY_INTERVAL
+
+# Ticket changes worth waking a long-poll for
+TICKET_CHANGES = [
+    {'$match': {'$or': [
+        {'operationType': {'$in': ['replace', 'delete']}},
+        {'operationType': 'update', 'updateDescription.updatedFields.status': {'$exists': True}}
+    ]}}
+]
+
+
+class TicketNotifier(object):
+    # Lets long-polling requests sleep until their ticket changes instead of
+    # re-reading it on a timer.  One change stream per process watches
+    # cm_request for status changes and wakes whoever is waiting on that
+    # ticket.  Under gunicorn's gevent worker the waiters are greenlets, so
+    # parked requests don't tie up a worker.
+    #
+    # If change streams aren't available (standalone mongod), wait() simply
+    # times out and callers go back to re-reading every poll interval.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiters = {}
+        self._watcher = None
+        self._pid = None
+
+    @property
+    def supported(self):
+        return self._watcher is not None and self._watcher.supported
+
+    def start(self, db):
+        # Watchers don't survive a fork, so (re)start one per process
+        with self._lock:
+            if self._pid == os.getpid() and self._watcher is not None:
+                return
+            self._pid = os.getpid()
+            self._watcher = ChangeWatcher(
+                db.cm_request, self._on_change, pipeline=TICKET_CHANGES, name='ticket-notifier')
+            self._watcher.start()
+
+    def subscribe(self, ticket_id, event=None):
+        # Pass the same event for several tickets to be woken by any of them
+        event = event or threading.Event()
+        with self._lock:
+            self._waiters.setdefault(ticket_id, set()).add(event)
+        return event
+
+    def unsubscribe(self, ticket_id, event):
+        with self._lock:
+            waiters = self._waiters.get(ticket_id)
+            if waiters is not None:
+                waiters.discard(event)
+                if not waiters:
+                    del self._waiters[ticket_id]
+
+    def _on_change(self, change):
+        ticket_id = change['documentKey']['_id']
+        with self._lock:
+            waiters = list(self._waiters.get(ticket_id, ()))
+        for event in waiters:
+            event.set()
+
+
+
+class AsyncTicketNotifier(object):
+    # TicketNotifier for the async web tier: the change stream is followed
+    # by a task on the event loop (through motor) and waiters are
+    # asyncio.Events, so a parked long-poll costs next to nothing.
+
+    def __init__(self):
+        self._waiters = {}
+        self._task = None
+        self.supported = True
+
+    def start(self, db):
+        # Has to be called from inside the running event loop
+        if self.supported and (self._task is None or self._task.done()):
+            self._task = asyncio.get_running_loop().create_task(self._watch(db.cm_request))
+
+    def subscribe(self, ticket_id, event=None):
+        event = event or asyncio.Event()
+        self._waiters.setdefault(ticket_id, set()).add(event)
+        return event
+
+    def unsubscribe(self, ticket_id, event):
+        waiters = self._waiters.get(ticket_id)
+        if waiters is not None:
+            waiters.discard(event)
+            if not waiters:
+                del self._waiters[ticket_id]
+
+    async def _watch(self, collection):
+        resume_token = None
+        while True:
+            try:
+                async with collection.watch(TICKET_CHANGES, resume_after=resume_token) as stream:
+                    async for change in stream:
+                        resume_token = stream.resume_token
+                        for event in self._waiters.get(change['documentKey']['_id'], ()):
+                            event.set()
+            except pymongo.errors.OperationFailure as e:
+                if e.code in (40573, 40324):
+                    logging.log(logging.WARNING, "Change streams are not supported on {0}; falling back to polling".format(
+                        collection.name))
+                    self.supported = False
+                    return
+                logging.log(logging.ERROR, "Change stream on {0} failed: {1}".format(collection.name, e))
+                resume_token = None
+                await asyncio.sleep(RETRY_INTERVAL)
+            except pymongo.errors.PyMongoError as e:
+                logging.log(logging.ERROR, "Change stream on {0} failed: {1}".format(collection.name, e))
+                await asyncio.sleep(RETRY_INTERVAL)
@@ -0,0 +1,74 @@
+__author__ = 'Steven Ogdahl'
+
+import logging
+import threading
+import time
+
+import pymongo.errors
+
+# Seconds to wait before re-opening a change stream that errored out
+RETRY_INTERVAL = 5
+
+
+class ChangeWatcher(threading.Thread):
+    # Follows a MongoDB change stream on a collection in the background and
+    # calls `callback` with every change document that makes it through
+    # `pipeline`.  Change streams need a replica set (or sharded cluster);
+    # on a standalone mongod the watcher notes that it isn't supported and
+    # quietly stops, leaving callers to fall back to polling.
+
+    def __init__(self, collection, callback, pipeline=None, name=None):
+        super(ChangeWatcher, self).__init__(name=name or 'watch-{0}'.format(collection.name), daemon=True)
+        self.collection = collection
+        self.callback = callback
+        self.pipeline = pipeline or []
+        self.supported = True
+        self.resume_token = None
+        self._should_be_running = True
+        self._stream = None
+
+    def run(self):
+        while self._should_be_running:
+            try:
+                with self.collection.watch(self.pipeline, resume_after=self.resume_token) as stream:
+                    self._stream = stream
+                    for change in stream:
+                        self.resume_token = stream.resume_token
+                        self.callback(change)
+                        if not self._should_be_running:
+                            break
+            except pymongo.errors.OperationFailure as e:
+                if not self._should_be_running:
+                    break
+                # 40573: "The $changeStream stage is only supported on replica sets"
+                if e.code in (40573, 40324):
+                    logging.log(logging.WARNING, "Change streams are not supported on {0}; falling back to polling".format(
+                        self.collection.name))
+                    self.supported = False
+                    break
+                # The resume token may have rolled off the oplog; start over from "now"
+                logging.log(logging.ERROR, "Change stream on {0} failed: {1}".format(self.collection.name, e))
+                self.resume_token = None
+                time.sleep(RETRY_INTERVAL)
+            except pymongo.errors.PyMongoError as e:
+                if not self._should_be_running:
+                    break
+                logging.log(logging.ERROR, "Change stream on {0} failed: {1}".format(self.collection.name, e))
+                time.sleep(RETRY_INTERVAL)
+            finally:
+                self._stream = None
+
+    @property
+    def watching(self):
+        # Whether a change stream is open right now, i.e. changes from here
+        # on will reach `callback`
+        return self._stream is not None
+
+    def stop(self):
+        self._should_be_running = False
+        stream = self._stream
+        if stream is not None:
+            try:
+                stream.close()
+            except pymongo.errors.PyMongoError:
+                pass